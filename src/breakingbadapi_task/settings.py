@@ -133,3 +133,54 @@ REST_FRAMEWORK = {
     #     'rest_framework.permissions.IsAuthenticated',
     # ],
 }
+
+
+# Locations configuration
+
+# Use the SQLite R*Tree index as candidate generator for near queries when it is available
+LOCATIONS_RTREE_INDEX = True
+
+# How the distances of near queries are computed:
+#   "sql": in the database, with the spherical law of cosines
+#   "numpy": in Python with NumPy, over the candidates found by the spatial indexes
+#   "kdtree": from an in-process KD-tree of every location. Writes made by other processes are
+#     picked up when the tree is reloaded, every LOCATIONS_MEMORY_INDEX_MAX_AGE seconds
+LOCATIONS_DISTANCE_ENGINE = "sql"
+LOCATIONS_MEMORY_INDEX_MAX_AGE = 300
+
+# Queue the locations created through the API and write them in batches from a background thread,
+# the API answers 202 once a location is queued and 429 when LOCATIONS_WRITE_BEHIND_MAX_SIZE are
+# waiting. With LOCATIONS_WRITE_BEHIND_LOG_DIR they are first appended to a log in a subdirectory of
+# it per process, fsync'd with LOCATIONS_WRITE_BEHIND_FSYNC, and what a crashed process left there is
+# written on start
+LOCATIONS_WRITE_BEHIND = False
+LOCATIONS_WRITE_BEHIND_MAX_SIZE = 10_000
+LOCATIONS_WRITE_BEHIND_BATCH_SIZE = 500
+LOCATIONS_WRITE_BEHIND_FLUSH_INTERVAL = 0.05
+LOCATIONS_WRITE_BEHIND_LOG_DIR = None
+LOCATIONS_WRITE_BEHIND_FSYNC = True
+
+# Locations are clustered for map clients in cells of LOCATIONS_CLUSTER_RADIUS pixels of the map at
+# each zoom up to LOCATIONS_CLUSTER_MAX_ZOOM, from an in-process index reloaded every
+# LOCATIONS_CLUSTER_INDEX_MAX_AGE seconds to pick up the writes of other processes
+LOCATIONS_CLUSTER_RADIUS = 60
+LOCATIONS_CLUSTER_MAX_ZOOM = 16
+LOCATIONS_CLUSTER_INDEX_MAX_AGE = 300
+
+# Encoded vector tiles are kept in an in-process LRU cache of LOCATIONS_TILE_CACHE_SIZE tiles, 0 to
+# disable it. The writes of this process evict the tiles they touch, the tiles are dropped after
+# LOCATIONS_TILE_CACHE_MAX_AGE seconds to pick up the writes of other processes
+LOCATIONS_TILE_CACHE_SIZE = 1000
+LOCATIONS_TILE_CACHE_MAX_AGE = 300
+
+# Characters are in contact when they have locations within LOCATIONS_CONTACT_DISTANCE meters and
+# LOCATIONS_CONTACT_TIME_WINDOW seconds of each other. Contacts are recorded as locations are written
+# when LOCATIONS_CONTACTS is set, which probes the neighbours of every written location and so slows
+# ingestion down about threefold. They are recomputed by the rebuild_contacts command
+LOCATIONS_CONTACTS = False
+LOCATIONS_CONTACT_DISTANCE = 50
+LOCATIONS_CONTACT_TIME_WINDOW = 300
+
+# Seconds the in-process index of the geofences is kept before being reloaded, to pick up the
+# fences written by other processes
+LOCATIONS_GEOFENCE_INDEX_MAX_AGE = 60
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.1 on 2026-10-15 14:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Character',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255)),
+                ('date_of_birth', models.DateField()),
+                ('occupation', models.CharField(max_length=255)),
+                ('is_suspect', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
@@ -1,9 +1,52 @@
 from rest_framework import serializers
 
+from locations.colocation import MAX_COLOCATION_DISTANCE, MAX_COLOCATION_WINDOW
+from locations.serializers import LocationSerializer, parse_date_range
+
 from .models import Character
 
 
 class CharacterSerializer(serializers.ModelSerializer):
+    """
+    Character, with its latest known location embedded unless the 'with_last_location' context
+    flag is off
+    """
+
+    last_location = LocationSerializer(source="last_location.location", read_only=True, allow_null=True)
+
     class Meta:
         model = Character
-        fields = ("id", "name", "date_of_birth", "occupation", "is_suspect")
+        fields = ("id", "name", "date_of_birth", "occupation", "is_suspect", "last_location")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.context.get("with_last_location", True):
+            self.fields.pop("last_location")
+
+
+class SuspectPropagationSerializer(serializers.Serializer):
+    """
+    Parameters of a propagation of the suspicion from 'seeds' to the characters who met them. Without
+    'distance', 'time_window' and 'date_range' the recorded contacts are followed
+    """
+
+    MAX_DEPTH = 10
+
+    seeds = serializers.ListField(child=serializers.IntegerField(), min_length=1)
+    distance = serializers.FloatField(min_value=0, max_value=MAX_COLOCATION_DISTANCE, required=False)
+    time_window = serializers.IntegerField(
+        min_value=0, max_value=int(MAX_COLOCATION_WINDOW.total_seconds() // 60), required=False, help_text="Minutes"
+    )
+    date_range = serializers.CharField(required=False)
+    depth = serializers.IntegerField(min_value=1, max_value=MAX_DEPTH, default=1)
+    dry_run = serializers.BooleanField(default=True)
+
+    def validate_seeds(self, value):
+        seeds = set(value)
+        found = set(Character.objects.filter(id__in=seeds).values_list("id", flat=True))
+        if found != seeds:
+            raise serializers.ValidationError(f"Unknown characters: {sorted(seeds - found)}")
+        return sorted(seeds)
+
+    def validate_date_range(self, value):
+        return parse_date_range(value)
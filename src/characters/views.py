@@ -1,13 +1,27 @@
-from typing import Any
+import json
+from datetime import timedelta
+from typing import Any, Iterator
 
 from django.db.models import Q
+from django.http import StreamingHttpResponse
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import serializers, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.generics import get_object_or_404
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
 from characters.models import Character
-from characters.serializers import CharacterSerializer
+from characters.serializers import CharacterSerializer, SuspectPropagationSerializer
+from locations.colocation import breadth_first, contact_graph, find_colocations, points_of
+from locations.models import Contact, LastLocation, Location
+from locations.pagination import TimestampCursorPagination
+from locations.renderers import NDJSONRenderer
+from locations.serializers import ContactSerializer, LocationPageSerializer, LocationSerializer, parse_date_range
+
+# Rows fetched at once while a trajectory is streamed
+TRAJECTORY_CHUNK_SIZE = 2000
 
 
 class CharacterViewSet(viewsets.ModelViewSet):
@@ -37,8 +51,17 @@ class CharacterViewSet(viewsets.ModelViewSet):
 
             queryset = queryset.filter(query)
 
+        if self.with_last_location():
+            queryset = queryset.select_related("last_location__location")
+
         return queryset
 
+    def with_last_location(self) -> bool:
+        return self.request.query_params.get("with_last_location", "0") == "1"
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), "with_last_location": self.with_last_location()}
+
     @staticmethod
     def validate_ordering_params(order_by: str, ascending: str):
         if not (order_by in ("name", "date_of_birth") and ascending in ("0", "1")):
@@ -64,12 +87,18 @@ class CharacterViewSet(viewsets.ModelViewSet):
                 "is_suspect", openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN
             ),
             openapi.Parameter("occupation", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter(
+                "with_last_location",
+                openapi.IN_QUERY,
+                type=openapi.TYPE_INTEGER,
+                description="`1` to embed the latest known location of every character",
+            ),
         ],
     )
     def list(self, request: Any) -> Response:
         """
         Get a list of all characters, you can filter optionally by name, is_suspect and occupation
-        and get partial and case-insensitive matches
+        and get partial and case-insensitive matches, and embed their latest known location
         """
         order_by = request.query_params.get("orderBy")
         ascending = request.query_params.get("ascending")
@@ -88,5 +117,148 @@ class CharacterViewSet(viewsets.ModelViewSet):
             order_by = order_by if ascending == "1" else f"-{order_by}"
             filtered_queryset = filtered_queryset.order_by(order_by)
 
-        serializer = self.serializer_class(filtered_queryset, many=True)
+        serializer = self.get_serializer(filtered_queryset, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
+
+    @swagger_auto_schema(responses={200: LocationSerializer, 404: "Error: Not Found"})
+    @action(detail=True, methods=["get"])
+    def last_location(self, request: Any, pk=None) -> Response:
+        """
+        Get the latest known location of a character, the one with the most recent timestamp
+        """
+        last_location = get_object_or_404(LastLocation.objects.select_related("location"), character_id=pk)
+        return Response(LocationSerializer(last_location.location).data, status=status.HTTP_200_OK)
+
+    @swagger_auto_schema(responses={200: ContactSerializer(many=True), 404: "Error: Not Found"})
+    @action(detail=True, methods=["get"])
+    def contacts(self, request: Any, pk=None) -> Response:
+        """
+        Get the characters this one was in contact with, the most recent contacts first, with the
+        first and last time they met and the number of times their locations were close
+        """
+        character = get_object_or_404(Character.objects.only("id"), pk=pk)
+        contacts = Contact.objects.filter(character=character).order_by("-last_seen", "contact_id")
+        return Response(ContactSerializer(contacts, many=True).data, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def contact_neighbours(parameters: dict):
+        """
+        How the characters met by a set of characters are found: a read of the recorded contacts
+        per level, or a co-location sweep over the locations when the contact definition or the
+        time range differ from the recorded ones
+        """
+        if not ({"distance", "time_window", "date_range"} & set(parameters)):
+            return lambda characters: set(
+                Contact.objects.filter(character_id__in=characters).values_list("contact_id", flat=True)
+            )
+
+        locations = Location.objects.all()
+        if "date_range" in parameters:
+            date_range = parameters["date_range"]
+            locations = locations.filter(timestamp__range=date_range)
+        distance = parameters.get("distance", Contact.objects.distance())
+        window = timedelta(minutes=parameters["time_window"]) if "time_window" in parameters else Contact.objects.window()
+        graph = contact_graph(find_colocations(points_of(locations), distance, window))
+        return lambda characters: set().union(*(graph.get(character, set()) for character in characters))
+
+    @swagger_auto_schema(
+        request_body=SuspectPropagationSerializer,
+        responses={200: "The characters reached with their number of `hops` from the seeds, and the number `updated`"},
+    )
+    @action(detail=False, methods=["post"])
+    def propagate_suspects(self, request: Any) -> Response:
+        """
+        Marks as suspects the characters who met the 'seeds' characters, up to 'depth' hops away,
+        following the recorded contacts or the locations within 'distance' meters and 'time_window'
+        minutes of each other in the 'date_range'. With 'dry_run', the default, the characters are
+        only reported. Otherwise they are all updated with a single query
+        """
+        serializer = SuspectPropagationSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        parameters = serializer.validated_data
+
+        hops = breadth_first(parameters["seeds"], self.contact_neighbours(parameters), parameters["depth"])
+        reached = sorted(hops, key=lambda character: (hops[character], character))
+        updated = 0
+        if not parameters["dry_run"]:
+            updated = Character.objects.filter(id__in=reached, is_suspect=False).update(is_suspect=True)
+        return Response(
+            {
+                "characters": [{"id": character, "hops": hops[character]} for character in reached],
+                "updated": updated,
+                "dry_run": parameters["dry_run"],
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    def get_trajectory_queryset(self, character: Character, date_range, position):
+        queryset = Location.objects.filter(character=character)
+        if date_range is not None:
+            queryset = queryset.filter(timestamp__range=date_range)
+        if position is not None:
+            timestamp, location_id = position
+            queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=location_id))
+        return queryset.order_by("timestamp", "id").only(*LocationSerializer.Meta.fields)
+
+    @staticmethod
+    def stream_locations(queryset) -> Iterator[str]:
+        """
+        Serializes the locations one by one as they are read in chunks, so memory does not grow with
+        the length of the trajectory
+        """
+        serializer = LocationSerializer()
+        for location in queryset.iterator(chunk_size=TRAJECTORY_CHUNK_SIZE):
+            yield json.dumps(serializer.to_representation(location))
+
+    @swagger_auto_schema(
+        responses={200: LocationPageSerializer, 404: "Error: Not Found"},
+        manual_parameters=[
+            openapi.Parameter("date_range", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter("page_size", openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+            openapi.Parameter("cursor", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+        ],
+    )
+    @action(detail=True, methods=["get"], renderer_classes=[JSONRenderer, NDJSONRenderer])
+    def trajectory(self, request: Any, pk=None):
+        """
+        Streams the locations of a character in timestamp order, filters optionally by 'date_range'.
+        Everything is returned unless a 'page_size' is given, then the 'next' link holds the cursor
+        of the next page. With the `ndjson` format, or an `application/x-ndjson` Accept header, each
+        location is a line and the next page is in the Link header
+        """
+        character = get_object_or_404(Character.objects.all(), pk=pk)
+        paginator = TimestampCursorPagination(request)
+
+        try:
+            page_size = paginator.get_page_size()
+            position = paginator.get_position()
+            date_range = request.query_params.get("date_range")
+            date_range = parse_date_range(date_range) if date_range is not None else None
+        except serializers.ValidationError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.get_trajectory_queryset(character, date_range, position)
+        next_link = None
+        if page_size is not None:
+            # The last position of the page and whether anything follows it, from the index alone
+            bounds = list(queryset.values_list("timestamp", "id")[page_size - 1:page_size + 1])
+            if len(bounds) == 2:
+                next_link = paginator.get_next_link(bounds[0])
+            queryset = queryset[:page_size]
+
+        if request.accepted_renderer.format == NDJSONRenderer.format:
+            response = StreamingHttpResponse(
+                (f"{line}\n" for line in self.stream_locations(queryset)), content_type=NDJSONRenderer.media_type
+            )
+            if next_link is not None:
+                response["Link"] = f'<{next_link}>; rel="next"'
+            return response
+
+        def stream_page():
+            yield f'{{"next": {json.dumps(next_link)}, "results": ['
+            for index, line in enumerate(self.stream_locations(queryset)):
+                yield f",{line}" if index else line
+            yield "]}"
+
+        return StreamingHttpResponse(stream_page(), content_type="application/json")
@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class LocationsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'locations'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .rtree import repair_rtree_after_migrate
+
+        post_migrate.connect(repair_rtree_after_migrate, sender=self)
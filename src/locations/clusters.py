@@ -0,0 +1,276 @@
+import math
+import threading
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .geo import BoundingBox
+
+# Size in pixels of a web map tile, a zoom level z spans 2^z tiles in each direction
+TILE_SIZE = 256
+MAX_ZOOM = 24
+# Latitude limit of the web mercator projection
+MAX_MERCATOR_LAT = 85.0511287798
+
+# (count, sum of x, sum of y, sum of the ids) of the points of a cell, the sum of the ids being the
+# id of the point when there is only one left
+Cluster = List
+
+
+def mercator(lat: float, lon: float) -> Tuple[float, float]:
+    """
+    Web mercator coordinates of a point, both within [0, 1] with y growing southwards
+    """
+    lat = max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat))
+    sin_lat = math.sin(math.radians(lat))
+    return (lon + 180) / 360, 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+
+
+def mercator_arrays(lats, lons) -> tuple:
+    """
+    Web mercator coordinates of the points of NumPy arrays 'lats' and 'lons'
+    """
+    import numpy
+
+    sin_lats = numpy.sin(numpy.radians(numpy.clip(lats, -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT)))
+    return (lons + 180) / 360, 0.5 - numpy.log((1 + sin_lats) / (1 - sin_lats)) / (4 * math.pi)
+
+
+def inverse_mercator(x: float, y: float) -> Tuple[float, float]:
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y)))), x * 360 - 180
+
+
+class ClusterIndex:
+    """
+    In-process hierarchy of point clusters for map clients, one level per zoom. At zoom z a cluster
+    gathers the locations within a cell of LOCATIONS_CLUSTER_RADIUS pixels of the map at that zoom,
+    and is placed at their centroid, so a screen never shows more clusters than it has cells. Each
+    level only keeps the count and coordinate sums of its cells: it is built on first use and then
+    updated in constant time per write made by this process. Like the LocationIndex, everything is
+    reloaded in a background thread after LOCATIONS_CLUSTER_INDEX_MAX_AGE seconds to pick up the
+    writes of other processes
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._points: Optional[Dict[int, Tuple[float, float]]] = None
+        self._levels: Dict[int, Dict[Tuple[int, int], Cluster]] = {}
+        self._loaded_at = 0.0
+        # Writes made since the points being reloaded were read, None when no reload is running
+        self._changes: Optional[Dict[int, Optional[Tuple[float, float]]]] = None
+        self._builder: Optional[threading.Thread] = None
+        # Bumped by clear, so a reload started before it is dropped
+        self._generation = 0
+
+    @staticmethod
+    def max_zoom() -> int:
+        return getattr(settings, "LOCATIONS_CLUSTER_MAX_ZOOM", 16)
+
+    @staticmethod
+    def cell_size(zoom: int) -> float:
+        return getattr(settings, "LOCATIONS_CLUSTER_RADIUS", 60) / (TILE_SIZE * 2 ** zoom)
+
+    def clear(self):
+        with self._lock:
+            self._points = None
+            self._levels = {}
+            self._changes = None
+            self._generation += 1
+
+    def wait(self, timeout: Optional[float] = None):
+        """
+        Waits for the reload running in the background, if any
+        """
+        builder = self._builder
+        if builder is not None:
+            builder.join(timeout)
+
+    def _ensure_loaded(self):
+        max_age = getattr(settings, "LOCATIONS_CLUSTER_INDEX_MAX_AGE", 300)
+        if self._points is None:
+            # Nothing to answer with yet
+            self._swap(*self._read(()))
+        elif time.monotonic() - self._loaded_at > max_age and self._builder is None:
+            self._reload()
+
+    def _read(self, zooms: Iterable[int]) -> tuple:
+        """
+        The points of every location in the database, and the levels of 'zooms' built from them
+        """
+        import numpy
+
+        from .models import Location
+
+        self._loaded_at = time.monotonic()
+        ids, lats, lons = array("q"), array("d"), array("d")
+        for location_id, lat, lon in Location.objects.values_list("id", "lat", "lon").iterator():
+            ids.append(location_id)
+            lats.append(lat)
+            lons.append(lon)
+        ids = numpy.frombuffer(ids, dtype=numpy.int64)
+        xs, ys = mercator_arrays(numpy.frombuffer(lats, dtype=numpy.float64), numpy.frombuffer(lons, dtype=numpy.float64))
+        points = dict(zip(ids.tolist(), zip(xs.tolist(), ys.tolist())))
+        return points, {zoom: self._cells(ids, xs, ys, self.cell_size(zoom)) for zoom in zooms}
+
+    def _reload(self):
+        """
+        Reads the points and the levels in use in a background thread, and swaps them in under
+        the lock
+        """
+        self._changes = {}
+        generation, zooms = self._generation, list(self._levels)
+
+        def reload():
+            try:
+                points, levels = self._read(zooms)
+                with self._lock:
+                    if generation == self._generation:
+                        self._swap(points, levels)
+            finally:
+                with self._lock:
+                    if self._builder is threading.current_thread():
+                        self._builder = None
+                    if generation == self._generation:
+                        self._changes = None
+                connections.close_all()
+
+        self._builder = threading.Thread(target=reload, name="cluster-index-reload", daemon=True)
+        self._builder.start()
+
+    def _swap(self, points: Dict[int, Tuple[float, float]], levels: Dict[int, Dict[Tuple[int, int], Cluster]]):
+        """
+        Replaces the points and the levels, replaying the writes made since they were read
+        """
+        changes = self._changes or {}
+        self._points, self._levels, self._changes = points, levels, None
+        for location_id, point in changes.items():
+            self._move(location_id, point)
+
+    def _level(self, zoom: int) -> Dict[Tuple[int, int], Cluster]:
+        level = self._levels.get(zoom)
+        if level is None:
+            import numpy
+
+            ids = numpy.fromiter(self._points, dtype=numpy.int64, count=len(self._points))
+            coordinates = numpy.array(list(self._points.values()), dtype=numpy.float64).reshape(-1, 2)
+            level = self._levels[zoom] = self._cells(ids, coordinates[:, 0], coordinates[:, 1], self.cell_size(zoom))
+        return level
+
+    @staticmethod
+    def _cells(ids, xs, ys, size: float) -> Dict[Tuple[int, int], Cluster]:
+        """
+        The clusters of the points of NumPy arrays 'ids', 'xs' and 'ys' in cells of 'size'
+        """
+        import numpy
+
+        columns, rows = numpy.floor(xs / size).astype(numpy.int64), numpy.floor(ys / size).astype(numpy.int64)
+        # Coordinates are within [0, 1], so every row fits below the stride
+        stride = math.floor(1 / size) + 2
+        keys, inverse = numpy.unique(columns * stride + rows, return_inverse=True)
+        counts = numpy.bincount(inverse, minlength=len(keys))
+        sums_x = numpy.bincount(inverse, weights=xs, minlength=len(keys))
+        sums_y = numpy.bincount(inverse, weights=ys, minlength=len(keys))
+        sums_ids = numpy.zeros(len(keys), dtype=numpy.int64)
+        numpy.add.at(sums_ids, inverse, ids)
+        return {
+            (key // stride, key % stride): [count, sum_x, sum_y, sum_ids]
+            for key, count, sum_x, sum_y, sum_ids in zip(
+                keys.tolist(), counts.tolist(), sums_x.tolist(), sums_y.tolist(), sums_ids.tolist()
+            )
+        }
+
+    @staticmethod
+    def _add(level: Dict[Tuple[int, int], Cluster], size: float, location_id: int, x: float, y: float, sign: int):
+        cell = (math.floor(x / size), math.floor(y / size))
+        cluster = level.get(cell)
+        if cluster is None:
+            cluster = level[cell] = [0, 0.0, 0.0, 0]
+        cluster[0] += sign
+        cluster[1] += sign * x
+        cluster[2] += sign * y
+        cluster[3] += sign * location_id
+        if cluster[0] <= 0:
+            del level[cell]
+
+    def _move(self, location_id: int, point: Optional[Tuple[float, float]]):
+        previous = self._points.pop(location_id, None)
+        if point is not None:
+            self._points[location_id] = point
+        for zoom, level in self._levels.items():
+            size = self.cell_size(zoom)
+            if previous is not None:
+                self._add(level, size, location_id, *previous, -1)
+            if point is not None:
+                self._add(level, size, location_id, *point, 1)
+
+    def upsert(self, location_id: int, lat: float, lon: float):
+        with self._lock:
+            if self._points is not None:
+                point = mercator(lat, lon)
+                self._move(location_id, point)
+                if self._changes is not None:
+                    self._changes[location_id] = point
+
+    def remove(self, location_id: int):
+        with self._lock:
+            if self._points is not None:
+                self._move(location_id, None)
+                if self._changes is not None:
+                    self._changes[location_id] = None
+
+    def upsert_on_commit(self, locations, using: Optional[str] = None):
+        """
+        Moves the 'locations' to their new coordinates once the current transaction commits, when
+        the index is loaded. Otherwise they are read from the database on first use
+        """
+        if self._points is None:
+            return
+
+        points = [(location.id, float(location.lat), float(location.lon)) for location in locations]
+        transaction.on_commit(lambda: [self.upsert(*point) for point in points], using=using)
+
+    def remove_on_commit(self, location_id: int, using: Optional[str] = None):
+        if self._points is None:
+            return
+
+        transaction.on_commit(lambda: self.remove(location_id), using=using)
+
+    def clusters(self, boxes: List[BoundingBox], zoom: int) -> List[dict]:
+        """
+        The clusters at 'zoom' whose cell overlaps the (south, north, west, east) 'boxes', with
+        their centroid, their number of locations and the id of the location of single point
+        clusters. Zooms past LOCATIONS_CLUSTER_MAX_ZOOM are answered at that zoom
+        """
+        zoom = min(zoom, self.max_zoom())
+        size = self.cell_size(zoom)
+        found = []
+        with self._lock:
+            self._ensure_loaded()
+            level = self._level(zoom)
+            for south, north, west, east in boxes:
+                (x0, y0), (x1, y1) = mercator(north, west), mercator(south, east)
+                columns = range(math.floor(x0 / size), math.floor(x1 / size) + 1)
+                rows = range(math.floor(y0 / size), math.floor(y1 / size) + 1)
+                if len(columns) * len(rows) <= len(level):
+                    cells = ((cell, level.get(cell)) for cell in ((column, row) for row in rows for column in columns))
+                else:
+                    cells = level.items()
+                for (column, row), cluster in cells:
+                    if cluster is not None and column in columns and row in rows:
+                        found.append(self._describe(cluster))
+        return sorted(found, key=lambda cluster: (cluster["lat"], cluster["lon"]))
+
+    @staticmethod
+    def _describe(cluster: Cluster) -> dict:
+        count, sum_x, sum_y, sum_ids = cluster
+        lat, lon = inverse_mercator(sum_x / count, sum_y / count)
+        described = {"lat": round(lat, 6), "lon": round(lon, 6), "count": count}
+        if count == 1:
+            described["id"] = sum_ids
+        return described
+
+
+cluster_index = ClusterIndex()
@@ -0,0 +1,149 @@
+import math
+from collections import deque
+from datetime import datetime, timedelta
+from itertools import product
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .geo import EARTH_RADIUS, chord_length
+
+MAX_COLOCATION_DISTANCE = 10_000
+MAX_COLOCATION_WINDOW = timedelta(days=1)
+COLOCATION_CHUNK_SIZE = 2000
+
+Vector = Tuple[float, float, float]
+# (id, character id, timestamp, unit vector) of a location
+Point = Tuple[int, int, datetime, Vector]
+
+
+def great_circle_distance(a: Vector, b: Vector) -> float:
+    """
+    Distance in meters between two points given as unit vectors
+    """
+    chord = math.dist(a, b)
+    return 2 * EARTH_RADIUS * math.asin(min(chord / 2, 1.0))
+
+
+class SpatialHash:
+    """
+    Points hashed in cubic cells of the 3D space of unit vectors, as wide as the chord of
+    'distance' meters, so the points within that distance of any point are in the 27 cells around
+    it, at the poles and across the antimeridian alike
+    """
+
+    def __init__(self, distance: float):
+        self.distance = distance
+        self.size = max(chord_length(distance), 1e-12)
+        self.cells: Dict[Tuple[int, int, int], Dict[int, Point]] = {}
+
+    def cell(self, vector: Vector) -> Tuple[int, int, int]:
+        return tuple(math.floor(axis / self.size) for axis in vector)
+
+    def add(self, point: Point):
+        self.cells.setdefault(self.cell(point[3]), {})[point[0]] = point
+
+    def remove(self, point: Point):
+        cell = self.cell(point[3])
+        points = self.cells.get(cell)
+        if points is not None:
+            points.pop(point[0], None)
+            if not points:
+                del self.cells[cell]
+
+    def near(self, vector: Vector) -> Iterator[Tuple[Point, float]]:
+        """
+        The points within 'distance' meters of 'vector', with their distance
+        """
+        x, y, z = self.cell(vector)
+        for offset in product((-1, 0, 1), repeat=3):
+            for point in self.cells.get((x + offset[0], y + offset[1], z + offset[2]), {}).values():
+                distance = great_circle_distance(vector, point[3])
+                if distance <= self.distance:
+                    yield point, distance
+
+
+def points_of(queryset, chunk_size: int = COLOCATION_CHUNK_SIZE) -> Iterator[Point]:
+    """
+    The locations of the queryset ordered by timestamp, their unit vector read from the stored
+    trigonometric columns
+    """
+    rows = (
+        queryset.order_by("timestamp", "id")
+        .values_list("id", "character_id", "timestamp", "sin_lat", "cos_lat", "sin_lon", "cos_lon")
+        .iterator(chunk_size=chunk_size)
+    )
+    for location_id, character_id, timestamp, sin_lat, cos_lat, sin_lon, cos_lon in rows:
+        yield location_id, character_id, timestamp, (cos_lat * cos_lon, cos_lat * sin_lon, sin_lat)
+
+
+def find_colocations(
+    points: Iterator[Point], distance: float, window: timedelta, character: Optional[int] = None
+) -> List[dict]:
+    """
+    Finds the pairs of characters with locations within 'distance' meters and 'window' of each
+    other, only those of 'character' when given, in a single sweep over the points ordered by
+    timestamp. Only the points of the last 'window' are kept, hashed by SpatialHash, so each point
+    is only compared with the points near it in space and time. Each pair comes with the first and
+    last time they met, their number of meetings and the smallest distance between them
+    """
+    recent: Deque[Point] = deque()
+    spatial_hash = SpatialHash(distance)
+    pairs: Dict[Tuple[int, int], dict] = {}
+    for point in points:
+        _, character_id, timestamp, vector = point
+        while recent and recent[0][2] < timestamp - window:
+            spatial_hash.remove(recent.popleft())
+
+        for other, other_distance in spatial_hash.near(vector):
+            other_character = other[1]
+            if other_character == character_id:
+                continue
+            if character is not None and character not in (character_id, other_character):
+                continue
+            key = (min(character_id, other_character), max(character_id, other_character))
+            pair = pairs.get(key)
+            if pair is None:
+                pairs[key] = {
+                    "character_a": key[0],
+                    "character_b": key[1],
+                    "first_seen": other[2],
+                    "last_seen": timestamp,
+                    "meetings": 1,
+                    "closest": other_distance,
+                }
+            else:
+                pair["first_seen"] = min(pair["first_seen"], other[2])
+                pair["last_seen"] = timestamp
+                pair["meetings"] += 1
+                pair["closest"] = min(pair["closest"], other_distance)
+
+        recent.append(point)
+        spatial_hash.add(point)
+    return [pairs[key] for key in sorted(pairs)]
+
+
+def contact_graph(pairs: Iterable[dict]) -> Dict[int, Set[int]]:
+    """
+    The characters each character met, from the pairs found by 'find_colocations'
+    """
+    graph: Dict[int, Set[int]] = {}
+    for pair in pairs:
+        graph.setdefault(pair["character_a"], set()).add(pair["character_b"])
+        graph.setdefault(pair["character_b"], set()).add(pair["character_a"])
+    return graph
+
+
+def breadth_first(seeds: Iterable[int], neighbours: Callable[[Set[int]], Set[int]], depth: int) -> Dict[int, int]:
+    """
+    The characters reached from the 'seeds' within 'depth' hops, with their number of hops. The
+    'neighbours' of a whole level are asked for at once, so a level costs a single query when they
+    are read from the database
+    """
+    hops = {seed: 0 for seed in seeds}
+    frontier = set(hops)
+    for hop in range(1, depth + 1):
+        frontier = {character for character in neighbours(frontier) if character not in hops}
+        if not frontier:
+            break
+        for character in frontier:
+            hops[character] = hop
+    return hops
@@ -0,0 +1,388 @@
+import math
+from decimal import ROUND_CEILING, ROUND_FLOOR, Decimal
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Case, ExpressionWrapper, F, FloatField, Q, QuerySet, When
+from django.db.models.functions import (
+    ACos,
+    ASin,
+    ATan2,
+    Cast,
+    Degrees,
+    Greatest,
+    Least,
+    Mod,
+    Round,
+    Sqrt,
+)
+from django.db.models.lookups import GreaterThan, LessThan
+
+from .geo import (
+    DEFAULT_FORMULA,
+    EARTH_RADIUS,
+    BoundingBox,
+    bounding_boxes,
+    geohash_covering,
+    initial_bearing,
+    search_distance,
+    vincenty,
+)
+from .memory_index import location_index
+from .models import Location
+from .rtree import rtree_available, rtree_candidates
+
+COORDINATE_STEP = Decimal("0.000001")
+# Decimals of the distances returned, a micrometer
+DISTANCE_DECIMALS = 6
+
+# (distance_key, id) of the last location of a page
+Position = Tuple[float, int]
+# Bounding boxes OR-ed in a single query, SQLite limits the depth of an expression
+BOXES_PER_QUERY = 200
+
+
+def filter_by_bounding_box(queryset, boxes: List[BoundingBox]):
+    """
+    Restricting the candidates to the latitude/longitude boxes enclosing the search circle, so the
+    (lat, lon) index is used and the exact distance is only computed for the rows inside them
+    """
+    query = Q()
+    for min_lat, max_lat, min_lon, max_lon in boxes:
+        # Widening the edges to the stored precision so no row on the border is left out
+        query |= Q(
+            lat__range=(
+                Decimal(min_lat).quantize(COORDINATE_STEP, rounding=ROUND_FLOOR),
+                Decimal(max_lat).quantize(COORDINATE_STEP, rounding=ROUND_CEILING),
+            ),
+            lon__range=(
+                Decimal(min_lon).quantize(COORDINATE_STEP, rounding=ROUND_FLOOR),
+                Decimal(max_lon).quantize(COORDINATE_STEP, rounding=ROUND_CEILING),
+            ),
+        )
+    return queryset.filter(query)
+
+
+def filter_by_geohash(queryset, boxes: List[BoundingBox]):
+    """
+    Restricting the candidates to the geohash cells covering the search circle. Each cell is a
+    prefix, queried as a range over the geohash index
+    """
+    cells = geohash_covering(boxes)
+    if cells is None:
+        return queryset
+
+    query = Q()
+    for cell in cells:
+        # "{" sorts right after "z", the last character of the geohash alphabet
+        query |= Q(geohash__gte=cell, geohash__lt=f"{cell}{{")
+    return queryset.filter(query)
+
+
+def filter_by_rtree(queryset, boxes: List[BoundingBox]):
+    """
+    Restricting the candidates to the ids the SQLite R*Tree index finds inside the search boxes
+    """
+    return queryset.filter(id__in=rtree_candidates(boxes))
+
+
+def filter_by_spatial_index(queryset, boxes: List[BoundingBox]):
+    """
+    Restricting the candidates with the best spatial index available: the R*Tree when it exists,
+    the geohash otherwise, and always the bounding boxes
+    """
+    if rtree_available(queryset.db):
+        queryset = filter_by_rtree(queryset, boxes)
+    else:
+        queryset = filter_by_geohash(queryset, boxes)
+    return filter_by_bounding_box(queryset, boxes)
+
+
+def filter_by_box_chunks(
+    queryset, boxes: List[BoundingBox], box_filter: Callable = filter_by_spatial_index
+) -> Iterator[QuerySet]:
+    """
+    Yields the queryset restricted by 'box_filter' to every chunk of BOXES_PER_QUERY of the boxes,
+    so any number of them can be searched
+    """
+    for start in range(0, len(boxes), BOXES_PER_QUERY):
+        yield box_filter(queryset, boxes[start:start + BOXES_PER_QUERY])
+
+
+def hydrate(queryset, found) -> List[Location]:
+    """
+    Loads the locations of the (id, distance) pairs 'found' with a single query, keeping their
+    order and setting their 'distance' attribute. Ids the queryset filters out are skipped
+    """
+    found = list(found)
+    locations_by_id = queryset.in_bulk([location_id for location_id, _ in found])
+
+    locations = []
+    for location_id, distance in found:
+        location = locations_by_id.get(location_id)
+        if location is not None:
+            # Rounded like the distances computed in SQL, the cursor keeps the exact one
+            location.distance, location.distance_key = round(distance, DISTANCE_DECIMALS), distance
+            locations.append(location)
+    return locations
+
+
+def set_bearings(locations: List[Location], lat: float, lon: float) -> List[Location]:
+    """
+    Sets the 'bearing' attribute of the 'locations' to their initial bearing from ('lat', 'lon')
+    """
+    lat, lon = math.radians(lat), math.radians(lon)
+    for location in locations:
+        location.bearing = initial_bearing(lat, lon, math.radians(location.lat), math.radians(location.lon))
+    return locations
+
+
+def bearing_annotation(lat: float, lon: float):
+    """
+    Initial bearing from ('lat', 'lon'), in radians, to every row, from the precomputed sines and
+    cosines so only one arc tangent is computed per row
+    """
+    # sin and cos of the longitude difference, expanded with the angle difference identities
+    sin_lon_difference = F("sin_lon") * math.cos(lon) - F("cos_lon") * math.sin(lon)
+    cos_lon_difference = F("cos_lon") * math.cos(lon) + F("sin_lon") * math.sin(lon)
+    bearing = Degrees(
+        ATan2(
+            F("cos_lat") * sin_lon_difference,
+            math.cos(lat) * F("sin_lat") - math.sin(lat) * F("cos_lat") * cos_lon_difference,
+        )
+    )
+    return Round(Mod(bearing + 360, 360), precision=6, output_field=FloatField())
+
+
+def as_float(field: str) -> Cast:
+    # The coordinates are decimals, which Django refuses to combine with floats
+    return Cast(field, FloatField())
+
+
+def select_within(found, distance: float, ascending: bool, limit: Optional[int], after: Optional[Position] = None):
+    """
+    Keeps the (id, distance) pairs within 'distance' meters that come after the 'after' position,
+    ordered by (distance, id) and limited
+    """
+    found = [pair for pair in found if pair[1] <= distance]
+    if after is not None:
+        after_distance, after_id = after
+        if ascending:
+            found = [pair for pair in found if (pair[1], pair[0]) > (after_distance, after_id)]
+        else:
+            found = [pair for pair in found if (pair[1], pair[0]) < (after_distance, after_id)]
+    found.sort(key=lambda pair: (pair[1], pair[0]), reverse=not ascending)
+    return found if limit is None else found[:limit]
+
+
+class DistanceEngine:
+    """
+    Finds the locations of a queryset that are within a distance of a point, ordered by distance,
+    each of them with its distance in meters, computed with 'formula', in a 'distance' attribute.
+    Ties are ordered by id and results can start 'after' a position, the (distance_key, id) of the
+    last location of a previous page, where 'distance_key' is an attribute growing with the distance.
+    When 'bearing' is set, the initial bearing from the point is set in a 'bearing' attribute
+    """
+
+    def near(
+        self,
+        queryset,
+        lat: float,
+        lon: float,
+        distance: float,
+        ascending: bool = True,
+        limit: Optional[int] = None,
+        formula: str = DEFAULT_FORMULA,
+        after: Optional[Position] = None,
+        bearing: bool = False,
+    ) -> Sequence[Location]:
+        raise NotImplementedError
+
+
+class SQLDistanceEngine(DistanceEngine):
+    """
+    Computes the distances in the database. Each formula is filtered and ordered on a key that grows
+    with the distance and needs no inverse trigonometric function, which is only applied to the rows
+    returned. Vincenty's formula is not expressible in SQL, it is computed in Python over the
+    candidates of a widened haversine search
+    """
+
+    @staticmethod
+    def cosines_key(lat: float, lon: float, distance: float):
+        # Spherical law of cosines on the precomputed sines and cosines, as a plain multiply-add
+        key = -(
+            F("cos_lat") * (math.cos(lat) * math.cos(lon) * F("cos_lon") + math.cos(lat) * math.sin(lon) * F("sin_lon"))
+            + math.sin(lat) * F("sin_lat")
+        )
+        bound = -math.cos(min(distance / EARTH_RADIUS, math.pi))
+        to_distance = ACos(Greatest(Least(-F("distance_key"), 1.0), -1.0)) * EARTH_RADIUS
+        return key, bound, to_distance
+
+    @staticmethod
+    def haversine_key(lat: float, lon: float, distance: float):
+        # Haversine of the angle, (1 - cos) / 2, with the cosine taken from the precomputed sines and cosines
+        key = 0.5 - 0.5 * (
+            F("cos_lat") * (math.cos(lat) * math.cos(lon) * F("cos_lon") + math.cos(lat) * math.sin(lon) * F("sin_lon"))
+            + math.sin(lat) * F("sin_lat")
+        )
+        bound = math.sin(min(distance / EARTH_RADIUS, math.pi) / 2) ** 2
+        to_distance = 2 * EARTH_RADIUS * ASin(Sqrt(Greatest(Least(F("distance_key"), 1.0), 0.0)))
+        return key, bound, to_distance
+
+    @staticmethod
+    def equirectangular_key(lat: float, lon: float, distance: float):
+        # Squared distance in the plane tangent at the searched latitude, without any trigonometry
+        lon_difference = as_float("lon") * (math.pi / 180) - lon
+        wrapped = Case(
+            When(GreaterThan(lon_difference, math.pi), then=lon_difference - 2 * math.pi),
+            When(LessThan(lon_difference, -math.pi), then=lon_difference + 2 * math.pi),
+            default=lon_difference,
+            output_field=FloatField(),
+        )
+        lat_difference = as_float("lat") * (math.pi / 180) - lat
+        key = wrapped * wrapped * math.cos(lat) ** 2 + lat_difference * lat_difference
+        bound = (distance / EARTH_RADIUS) ** 2
+        to_distance = Sqrt(F("distance_key")) * EARTH_RADIUS
+        return key, bound, to_distance
+
+    def near(
+        self, queryset, lat, lon, distance, ascending=True, limit=None, formula=DEFAULT_FORMULA, after=None, bearing=False
+    ):
+        if formula == "vincenty":
+            candidates = self.near(queryset, lat, lon, search_distance(distance, formula, lat), formula="haversine")
+            lat_rad, lon_rad = math.radians(lat), math.radians(lon)
+            found = (
+                (location_id, vincenty(lat_rad, lon_rad, math.radians(point_lat), math.radians(point_lon)))
+                for location_id, point_lat, point_lon in candidates.values_list("id", "lat", "lon")
+            )
+            locations = hydrate(queryset, select_within(found, distance, ascending, limit, after))
+            return set_bearings(locations, lat, lon) if bearing else locations
+
+        queryset = filter_by_spatial_index(queryset, bounding_boxes(lat, lon, search_distance(distance, formula, lat)))
+        key, bound, to_distance = getattr(self, f"{formula}_key")(math.radians(lat), math.radians(lon), distance)
+        queryset = (
+            queryset.annotate(distance_key=ExpressionWrapper(key, output_field=FloatField()))
+            .filter(distance_key__lte=bound)
+            .annotate(distance=Round(to_distance, precision=DISTANCE_DECIMALS, output_field=FloatField()))
+            .order_by(*(("distance_key", "id") if ascending else ("-distance_key", "-id")))
+        )
+        if after is not None:
+            after_key, after_id = after
+            if ascending:
+                queryset = queryset.filter(Q(distance_key__gt=after_key) | Q(distance_key=after_key, id__gt=after_id))
+            else:
+                queryset = queryset.filter(Q(distance_key__lt=after_key) | Q(distance_key=after_key, id__lt=after_id))
+
+        if bearing:
+            queryset = queryset.annotate(bearing=bearing_annotation(math.radians(lat), math.radians(lon)))
+
+        return queryset if limit is None else queryset[:limit]
+
+
+class NumpyDistanceEngine(DistanceEngine):
+    """
+    Reads the (id, lat, lon) of the candidates found by the spatial indexes and computes their
+    distances in one vectorized pass, only the matching rows are loaded as models
+    """
+
+    def __init__(self):
+        try:
+            import numpy
+        except ImportError:
+            raise ImproperlyConfigured("The `numpy` distance engine requires NumPy to be installed")
+        self.numpy = numpy
+
+    def distances(self, formula: str, lat: float, lon: float, lats, lons):
+        numpy = self.numpy
+        if formula == "equirectangular":
+            lon_differences = (lons - lon + numpy.pi) % (2 * numpy.pi) - numpy.pi
+            return EARTH_RADIUS * numpy.hypot(lon_differences * math.cos(lat), lats - lat)
+        if formula == "cosines":
+            cos_angles = math.sin(lat) * numpy.sin(lats) + math.cos(lat) * numpy.cos(lats) * numpy.cos(lons - lon)
+            return EARTH_RADIUS * numpy.arccos(numpy.clip(cos_angles, -1.0, 1.0))
+        if formula == "haversine":
+            a = numpy.sin((lats - lat) / 2) ** 2 + math.cos(lat) * numpy.cos(lats) * numpy.sin((lons - lon) / 2) ** 2
+            return 2 * EARTH_RADIUS * numpy.arcsin(numpy.minimum(numpy.sqrt(a), 1.0))
+        return numpy.fromiter(
+            (vincenty(lat, lon, point_lat, point_lon) for point_lat, point_lon in zip(lats, lons)),
+            dtype=numpy.float64,
+            count=len(lats),
+        )
+
+    def near(
+        self, queryset, lat, lon, distance, ascending=True, limit=None, formula=DEFAULT_FORMULA, after=None, bearing=False
+    ):
+        numpy = self.numpy
+        candidates = filter_by_spatial_index(queryset, bounding_boxes(lat, lon, search_distance(distance, formula, lat)))
+        rows = list(candidates.values_list("id", "lat", "lon"))
+        if not rows:
+            return []
+
+        ids = numpy.fromiter((row[0] for row in rows), dtype=numpy.int64, count=len(rows))
+        lats = numpy.radians(numpy.fromiter((row[1] for row in rows), dtype=numpy.float64, count=len(rows)))
+        lons = numpy.radians(numpy.fromiter((row[2] for row in rows), dtype=numpy.float64, count=len(rows)))
+        distances = self.distances(formula, math.radians(lat), math.radians(lon), lats, lons)
+
+        # Sorting on (key, tie) in ascending order gives the requested (distance, id) order
+        keys, ties = (distances, ids) if ascending else (-distances, -ids)
+        selected = distances <= distance
+        if after is not None:
+            after_key, after_tie = (after[0], after[1]) if ascending else (-after[0], -after[1])
+            selected &= (keys > after_key) | ((keys == after_key) & (ties > after_tie))
+        matching = numpy.flatnonzero(selected)
+
+        if limit is not None and limit < len(matching):
+            # Only the rows that can make it into the result are fully sorted
+            kth_key = numpy.partition(keys[matching], limit - 1)[limit - 1]
+            matching = matching[keys[matching] <= kth_key]
+        matching = matching[numpy.lexsort((ties[matching], keys[matching]))][:limit]
+
+        locations = hydrate(queryset, zip(ids[matching].tolist(), distances[matching].tolist()))
+        return set_bearings(locations, lat, lon) if bearing else locations
+
+
+class KDTreeDistanceEngine(DistanceEngine):
+    """
+    Searches the radius in the in-process KD-tree of every location and hydrates the matching rows
+    of the queryset, the closest first and only as many as the limit needs
+    """
+
+    def __init__(self):
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            raise ImproperlyConfigured("The `kdtree` distance engine requires NumPy to be installed")
+
+    def near(
+        self, queryset, lat, lon, distance, ascending=True, limit=None, formula=DEFAULT_FORMULA, after=None, bearing=False
+    ):
+        found = select_within(location_index.radius(lat, lon, distance, formula), distance, ascending, None, after)
+        if limit is None:
+            locations = hydrate(queryset, found)
+        else:
+            # The queryset can filter out some of the closest points, so they are hydrated in chunks
+            # of doubling size until 'limit' of them remain
+            locations, start, chunk = [], 0, limit
+            while start < len(found) and len(locations) < limit:
+                locations += hydrate(queryset, found[start:start + chunk])
+                start, chunk = start + chunk, chunk * 2
+            locations = locations[:limit]
+        return set_bearings(locations, lat, lon) if bearing else locations
+
+
+DISTANCE_ENGINES = {
+    "sql": SQLDistanceEngine,
+    "numpy": NumpyDistanceEngine,
+    "kdtree": KDTreeDistanceEngine,
+}
+
+
+def get_distance_engine() -> DistanceEngine:
+    name = getattr(settings, "LOCATIONS_DISTANCE_ENGINE", "sql")
+    try:
+        return DISTANCE_ENGINES[name]()
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"Unknown LOCATIONS_DISTANCE_ENGINE `{name}`, it accepts {', '.join(DISTANCE_ENGINES)}"
+        )
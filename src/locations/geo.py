@@ -0,0 +1,295 @@
+import math
+from typing import List, Optional, Tuple
+
+EARTH_RADIUS = 6_371_000
+# Distance between antipodal points, no two points on the globe are further apart
+MAX_DISTANCE = math.pi * EARTH_RADIUS
+
+MIN_LAT = -90.0
+MAX_LAT = 90.0
+MIN_LON = -180.0
+MAX_LON = 180.0
+
+BoundingBox = Tuple[float, float, float, float]
+
+
+def bbox_boxes(south: float, west: float, north: float, east: float) -> List[BoundingBox]:
+    """
+    The bounding boxes of a (south, west, north, east) box, split in two when it crosses the
+    antimeridian, its west edge then being east of its east edge
+    """
+    if west <= east:
+        return [(south, north, west, east)]
+    return [(south, north, west, MAX_LON), (south, north, MIN_LON, east)]
+
+
+def bounding_boxes(lat: float, lon: float, distance: float) -> List[BoundingBox]:
+    """
+    Returns the (min_lat, max_lat, min_lon, max_lon) boxes that enclose every point within
+    'distance' meters of ('lat', 'lon'). A single box is returned unless the circle crosses the
+    antimeridian, in which case it is split in two. When the circle contains a pole the box spans
+    every longitude
+    """
+    angular_radius = distance / EARTH_RADIUS
+    lat_rad = math.radians(lat)
+
+    min_lat = lat_rad - angular_radius
+    max_lat = lat_rad + angular_radius
+
+    if min_lat <= math.radians(MIN_LAT) or max_lat >= math.radians(MAX_LAT):
+        return [
+            (
+                max(math.degrees(min_lat), MIN_LAT),
+                min(math.degrees(max_lat), MAX_LAT),
+                MIN_LON,
+                MAX_LON,
+            )
+        ]
+
+    delta_lon = math.degrees(math.asin(min(math.sin(angular_radius) / math.cos(lat_rad), 1.0)))
+    min_lat, max_lat = math.degrees(min_lat), math.degrees(max_lat)
+    min_lon, max_lon = lon - delta_lon, lon + delta_lon
+
+    if min_lon < MIN_LON:
+        return [(min_lat, max_lat, min_lon + 360, MAX_LON), (min_lat, max_lat, MIN_LON, max_lon)]
+    if max_lon > MAX_LON:
+        return [(min_lat, max_lat, min_lon, MAX_LON), (min_lat, max_lat, MIN_LON, max_lon - 360)]
+    return [(min_lat, max_lat, min_lon, max_lon)]
+
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 9
+MAX_COVERING_CELLS = 16
+COORDINATE_PRECISION = 1e-6
+
+
+def encode_geohash(lat: float, lon: float, precision: int = GEOHASH_PRECISION) -> str:
+    """
+    Encodes a point as a geohash of 'precision' characters
+    """
+    lat_interval = [MIN_LAT, MAX_LAT]
+    lon_interval = [MIN_LON, MAX_LON]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even_bit = True
+
+    while len(geohash) < precision:
+        interval, value = (lon_interval, lon) if even_bit else (lat_interval, lat)
+        middle = (interval[0] + interval[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even_bit = not even_bit
+        bit_count += 1
+
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(geohash)
+
+
+def geohash_cell_size(precision: int) -> Tuple[float, float]:
+    """
+    Returns the (height, width) in degrees of a geohash cell of 'precision' characters
+    """
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180 / 2 ** lat_bits, 360 / 2 ** lon_bits
+
+
+def _cell_range(low: float, high: float, origin: float, size: float, count: int) -> range:
+    # Padding by the stored coordinate precision so rounding never drops a cell on the border
+    first = int((low - COORDINATE_PRECISION - origin) // size)
+    last = int((high + COORDINATE_PRECISION - origin) // size)
+    return range(max(first, 0), min(last, count - 1) + 1)
+
+
+def geohash_covering(boxes: List[BoundingBox], max_cells: int = MAX_COVERING_CELLS) -> Optional[List[str]]:
+    """
+    Returns the geohash prefixes of the cells covering 'boxes', using the finest precision that
+    needs at most 'max_cells' cells. None is returned when not even single character cells are
+    coarse enough, which means the boxes cover too much of the globe to be worth restricting
+    """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = geohash_cell_size(precision)
+        lat_count = round((MAX_LAT - MIN_LAT) / height)
+        lon_count = round((MAX_LON - MIN_LON) / width)
+
+        ranges = [
+            (
+                _cell_range(min_lat, max_lat, MIN_LAT, height, lat_count),
+                _cell_range(min_lon, max_lon, MIN_LON, width, lon_count),
+            )
+            for min_lat, max_lat, min_lon, max_lon in boxes
+        ]
+
+        if sum(len(lat_cells) * len(lon_cells) for lat_cells, lon_cells in ranges) <= max_cells:
+            return sorted(
+                {
+                    encode_geohash(
+                        MIN_LAT + (lat_cell + 0.5) * height,
+                        MIN_LON + (lon_cell + 0.5) * width,
+                        precision,
+                    )
+                    for lat_cells, lon_cells in ranges
+                    for lat_cell in lat_cells
+                    for lon_cell in lon_cells
+                }
+            )
+
+    return None
+
+
+# Distance formulas. All of them take two points in radians, the first one being the point searched
+# around, and return meters. The errors are relative to the WGS84 ellipsoid:
+#   equirectangular: flat projection around the searched latitude, no transcendental function per
+#     point. Within 0.6% up to a few tens of kilometers away from the poles, unreliable beyond
+#   cosines: spherical law of cosines, within 0.6% but losing precision below a few meters
+#   haversine: great-circle distance, within 0.6% at any distance
+#   vincenty: Vincenty's inverse formula on the WGS84 ellipsoid, within a millimeter. Nearly
+#     antipodal points where it does not converge fall back to haversine
+
+WGS84_A = 6_378_137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+VINCENTY_MAX_ITERATIONS = 200
+
+# Relative difference between the spherical and the ellipsoidal distances. Candidate searches done on
+# the sphere are widened by it so no point is missed
+FORMULA_MARGIN = 0.01
+# Greatest equirectangular distance, half a turn both in longitude and in latitude
+EQUIRECTANGULAR_MAX_DISTANCE = math.sqrt(2) * MAX_DISTANCE
+
+DEFAULT_FORMULA = "cosines"
+
+
+def wrap_longitude_difference(difference: float) -> float:
+    if difference > math.pi:
+        return difference - 2 * math.pi
+    if difference < -math.pi:
+        return difference + 2 * math.pi
+    return difference
+
+
+def equirectangular(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    x = wrap_longitude_difference(lon2 - lon1) * math.cos(lat1)
+    y = lat2 - lat1
+    return EARTH_RADIUS * math.sqrt(x * x + y * y)
+
+
+def spherical_law_of_cosines(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    cos_angle = math.sin(lat1) * math.sin(lat2) + math.cos(lat1) * math.cos(lat2) * math.cos(lon2 - lon1)
+    return EARTH_RADIUS * math.acos(max(min(cos_angle, 1.0), -1.0))
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(math.sqrt(a), 1.0))
+
+
+def vincenty(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    u1 = math.atan((1 - WGS84_F) * math.tan(lat1))
+    u2 = math.atan((1 - WGS84_F) * math.tan(lat2))
+    sin_u1, cos_u1 = math.sin(u1), math.cos(u1)
+    sin_u2, cos_u2 = math.sin(u2), math.cos(u2)
+
+    longitude_difference = wrap_longitude_difference(lon2 - lon1)
+    lambda_ = longitude_difference
+    for _ in range(VINCENTY_MAX_ITERATIONS):
+        sin_lambda, cos_lambda = math.sin(lambda_), math.cos(lambda_)
+        sin_sigma = math.hypot(cos_u2 * sin_lambda, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lambda)
+        if sin_sigma == 0:
+            return 0.0
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lambda
+        sigma = math.atan2(sin_sigma, cos_sigma)
+        sin_alpha = cos_u1 * cos_u2 * sin_lambda / sin_sigma
+        cos_squared_alpha = 1 - sin_alpha ** 2
+        cos_2sigma_m = cos_sigma - 2 * sin_u1 * sin_u2 / cos_squared_alpha if cos_squared_alpha else 0.0
+        c = WGS84_F / 16 * cos_squared_alpha * (4 + WGS84_F * (4 - 3 * cos_squared_alpha))
+        previous_lambda = lambda_
+        lambda_ = longitude_difference + (1 - c) * WGS84_F * sin_alpha * (
+            sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2))
+        )
+        if abs(lambda_ - previous_lambda) < 1e-12:
+            break
+    else:
+        return haversine(lat1, lon1, lat2, lon2)
+
+    u_squared = cos_squared_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    a = 1 + u_squared / 16384 * (4096 + u_squared * (-768 + u_squared * (320 - 175 * u_squared)))
+    b = u_squared / 1024 * (256 + u_squared * (-128 + u_squared * (74 - 47 * u_squared)))
+    delta_sigma = b * sin_sigma * (
+        cos_2sigma_m
+        + b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+        )
+    )
+    return WGS84_B * a * (sigma - delta_sigma)
+
+
+def initial_bearing(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Initial bearing in degrees clockwise from north, between 0 and 360, to go from the first point
+    to the second one along a great circle. The points are in radians
+    """
+    y = math.sin(lon2 - lon1) * math.cos(lat2)
+    x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(lon2 - lon1)
+    return math.degrees(math.atan2(y, x)) % 360
+
+
+DISTANCE_FORMULAS = {
+    "equirectangular": equirectangular,
+    "cosines": spherical_law_of_cosines,
+    "haversine": haversine,
+    "vincenty": vincenty,
+}
+
+# Formulas computing the great-circle distance, the others need widened spherical searches
+SPHERICAL_FORMULAS = ("cosines", "haversine")
+
+
+def max_distance(formula: str) -> float:
+    """
+    Greatest distance 'formula' returns between two points
+    """
+    return EQUIRECTANGULAR_MAX_DISTANCE if formula == "equirectangular" else MAX_DISTANCE
+
+
+def search_distance(distance: float, formula: str, lat: float = 0.0) -> float:
+    """
+    Distance to search on the sphere so every point within 'distance' meters by 'formula' of a point
+    at latitude 'lat', in degrees, is found. The equirectangular formula scales the longitudes by the
+    cosine of 'lat', while the points it finds can be up to 'distance' closer to the equator where
+    that cosine is larger. The great-circle distance being at most the length of the straight line of
+    the projection, it exceeds the formula by at most the ratio of the two cosines
+    """
+    if formula in SPHERICAL_FORMULAS:
+        return distance
+    if formula != "equirectangular":
+        return distance * (1 + FORMULA_MARGIN)
+
+    lat = abs(math.radians(lat))
+    ratio = math.cos(max(lat - distance / EARTH_RADIUS, 0.0)) / math.cos(lat)
+    return min(distance * max(ratio, 1.0), MAX_DISTANCE)
+
+
+def unit_vector(lat: float, lon: float) -> Tuple[float, float, float]:
+    """
+    Cartesian coordinates on the unit sphere of a point given in radians
+    """
+    cos_lat = math.cos(lat)
+    return cos_lat * math.cos(lon), cos_lat * math.sin(lon), math.sin(lat)
+
+
+def chord_length(distance: float) -> float:
+    """
+    Straight line distance on the unit sphere between two points 'distance' meters apart
+    """
+    return 2 * math.sin(min(distance / EARTH_RADIUS, math.pi) / 2)
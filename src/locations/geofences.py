@@ -0,0 +1,145 @@
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.db import transaction
+
+from .colocation import great_circle_distance
+from .geo import BoundingBox, bounding_boxes, unit_vector
+
+CIRCLE = "circle"
+POLYGON = "polygon"
+MAX_POLYGON_VERTICES = 1000
+# Cell sizes in degrees of the levels of the GeofenceIndex, from the finest to a handful of cells for the whole globe
+FENCE_INDEX_LEVELS = (0.01, 0.1, 1.0, 10.0, 180.0)
+# A fence is indexed at the finest level where its bounding boxes overlap at most this many cells
+MAX_FENCE_CELLS = 4
+
+# (id, kind, shape) of a fence, the shape being the (unit vector of the center, radius in meters) of
+# a circle or the [lat, lon] vertices of a polygon
+Fence = Tuple[int, str, object]
+
+
+def fence_boxes(
+    kind: str, lat: Optional[float], lon: Optional[float], radius: Optional[float], polygon
+) -> List[BoundingBox]:
+    """
+    The (south, north, west, east) boxes enclosing a fence. Circles are split across the
+    antimeridian, polygons are expected not to cross it
+    """
+    if kind == CIRCLE:
+        return bounding_boxes(lat, lon, radius)
+    lats = [vertex[0] for vertex in polygon]
+    lons = [vertex[1] for vertex in polygon]
+    return [(min(lats), max(lats), min(lons), max(lons))]
+
+
+def point_in_polygon(lat: float, lon: float, polygon: Sequence[Sequence[float]]) -> bool:
+    """
+    Whether the point is inside the polygon of [lat, lon] vertices, counting the crossings of its
+    edges by a ray going east from the point
+    """
+    inside = False
+    previous_lat, previous_lon = polygon[-1]
+    for vertex_lat, vertex_lon in polygon:
+        if (vertex_lat > lat) != (previous_lat > lat):
+            crossing = vertex_lon + (lat - vertex_lat) * (previous_lon - vertex_lon) / (previous_lat - vertex_lat)
+            if lon < crossing:
+                inside = not inside
+        previous_lat, previous_lon = vertex_lat, vertex_lon
+    return inside
+
+
+def fence_contains(fence: Fence, lat: float, lon: float) -> bool:
+    _, kind, shape = fence
+    if kind == CIRCLE:
+        center, radius = shape
+        return great_circle_distance(center, unit_vector(math.radians(lat), math.radians(lon))) <= radius
+    return point_in_polygon(lat, lon, shape)
+
+
+class GeofenceIndex:
+    """
+    In-process spatial index of the geofences. Every level is a grid whose cells hold the fences
+    overlapping them, and each fence is only put at the finest level where it overlaps at most
+    MAX_FENCE_CELLS cells, so finding the fences containing a point costs a lookup per level and
+    an exact test of the few fences found, however many fences there are. It is built on first use
+    and dropped when the fences written by this process are committed, or after
+    LOCATIONS_GEOFENCE_INDEX_MAX_AGE seconds to pick up the writes of other processes
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fences: Optional[Dict[int, Fence]] = None
+        self._levels: Dict[float, Dict[Tuple[int, int], List[Fence]]] = {}
+        self._loaded_at = 0.0
+
+    def clear(self):
+        with self._lock:
+            self._fences = None
+            self._levels = {}
+
+    def clear_on_commit(self, using: Optional[str] = None):
+        transaction.on_commit(self.clear, using=using)
+
+    def _ensure_loaded(self):
+        max_age = getattr(settings, "LOCATIONS_GEOFENCE_INDEX_MAX_AGE", 60)
+        if self._fences is None or time.monotonic() - self._loaded_at > max_age:
+            self._load()
+
+    def _load(self):
+        from .models import Geofence
+
+        self._fences = {}
+        self._levels = {}
+        rows = Geofence.objects.values_list("id", "kind", "lat", "lon", "radius", "polygon")
+        for fence_id, kind, lat, lon, radius, polygon in rows.iterator():
+            lat, lon = (float(lat), float(lon)) if kind == CIRCLE else (None, None)
+            shape = (unit_vector(math.radians(lat), math.radians(lon)), radius) if kind == CIRCLE else polygon
+            self._insert((fence_id, kind, shape), fence_boxes(kind, lat, lon, radius, polygon))
+        self._loaded_at = time.monotonic()
+
+    @staticmethod
+    def _ranges(boxes: List[BoundingBox], size: float) -> List[Tuple[range, range]]:
+        return [
+            (
+                range(math.floor(south / size), math.floor(north / size) + 1),
+                range(math.floor(west / size), math.floor(east / size) + 1),
+            )
+            for south, north, west, east in boxes
+        ]
+
+    def _insert(self, fence: Fence, boxes: List[BoundingBox]):
+        self._fences[fence[0]] = fence
+        for size in FENCE_INDEX_LEVELS:
+            ranges = self._ranges(boxes, size)
+            cells = sum(len(rows) * len(columns) for rows, columns in ranges)
+            if cells <= MAX_FENCE_CELLS or size == FENCE_INDEX_LEVELS[-1]:
+                level = self._levels.setdefault(size, {})
+                for rows, columns in ranges:
+                    for cell in ((row, column) for row in rows for column in columns):
+                        level.setdefault(cell, []).append(fence)
+                return
+
+    def fence_ids(self) -> set:
+        with self._lock:
+            self._ensure_loaded()
+            return set(self._fences)
+
+    def containing(self, lat: float, lon: float) -> List[int]:
+        """
+        The ids of the fences containing the point, in order
+        """
+        found = set()
+        with self._lock:
+            self._ensure_loaded()
+            for size, level in self._levels.items():
+                for fence in level.get((math.floor(lat / size), math.floor(lon / size)), ()):
+                    if fence[0] not in found and fence_contains(fence, lat, lon):
+                        found.add(fence[0])
+        return sorted(found)
+
+
+geofence_index = GeofenceIndex()
@@ -0,0 +1,67 @@
+from collections import Counter
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from typing import Iterable, List, Tuple, Union
+
+from django.db.models import F, FloatField, IntegerField
+from django.db.models.functions import Cast, Floor, Round
+from django.utils import timezone
+
+# Grid cells are sized in millionths of a degree, the precision of the stored coordinates, so
+# every coordinate falls in a cell with exact integer arithmetic
+MICRODEGREES = 1_000_000
+
+# Cell sizes the density rollups are maintained at: 0.01, 0.1 and 1 degree
+ROLLUP_STEPS = (10_000, 100_000, 1_000_000)
+
+# (step, hour, lat_index, lon_index) of a rollup cell
+RollupKey = Tuple[int, datetime, int, int]
+
+
+def to_microdegrees(value: Union[Decimal, float, str]) -> int:
+    return int((Decimal(str(value)) * MICRODEGREES).to_integral_value())
+
+
+def cell_index(value: Union[Decimal, float, str], step: int) -> int:
+    return to_microdegrees(value) // step
+
+
+def cell_index_expression(field: str, step: int):
+    """
+    Database side 'cell_index' of a coordinate field. The product is rounded back to the integer it
+    is meant to be before the division, so both sides agree on every stored coordinate
+    """
+    microdegrees = Round(Cast(F(field), FloatField()) * MICRODEGREES)
+    return Floor(microdegrees / step, output_field=IntegerField())
+
+
+def hour_of(timestamp: datetime) -> datetime:
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    return timestamp.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def month_of(timestamp: datetime) -> datetime:
+    return hour_of(timestamp).replace(day=1, hour=0)
+
+
+def next_month(month: datetime) -> datetime:
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+def rollup_keys(lat, lon, timestamp: datetime) -> List[RollupKey]:
+    hour = hour_of(timestamp)
+    return [(step, hour, cell_index(lat, step), cell_index(lon, step)) for step in ROLLUP_STEPS]
+
+
+def rollup_deltas(added: Iterable[Tuple] = (), removed: Iterable[Tuple] = ()) -> Counter:
+    """
+    Changes of the rollup counts when the (lat, lon, timestamp) rows 'removed' are replaced by the
+    rows 'added'. Unlike a sum of Counters, it keeps the negative changes
+    """
+    deltas = Counter()
+    for rows, sign in ((added, 1), (removed, -1)):
+        for lat, lon, timestamp in rows:
+            for key in rollup_keys(lat, lon, timestamp):
+                deltas[key] += sign
+    return deltas
@@ -0,0 +1,170 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import List, NamedTuple, Optional, Tuple
+
+from django.db.models import Count, F, FloatField, IntegerField, Q, Sum
+from django.db.models.functions import Cast, Floor
+
+from .engines import filter_by_spatial_index
+from .geo import BoundingBox
+from .grid import MICRODEGREES, ROLLUP_STEPS, cell_index_expression, hour_of, to_microdegrees
+from .models import DensityRollup
+
+MAX_HEATMAP_CELLS = 100_000
+
+# Index ranges, bounds included
+IndexRange = Tuple[int, int]
+
+
+def index_range(low: int, high: int, step: int, limit: int) -> IndexRange:
+    """
+    Indexes of the cells of 'step' microdegrees overlapping [low, high], the cell starting at
+    'high' only when it is the 'limit' of the coordinate, the pole or the antimeridian
+    """
+    first = low // step
+    last = high // step if high == limit or high % step else high // step - 1
+    return first, max(first, last)
+
+
+class Grid(NamedTuple):
+    """
+    Cells of 'step' microdegrees overlapping a bounding box, as a range of rows and one or two
+    ranges of columns across the antimeridian. They are always counted whole
+    """
+
+    step: int
+    rows: IndexRange
+    columns: List[IndexRange]
+
+    @classmethod
+    def over(cls, south: float, west: float, north: float, east: float, step: int) -> "Grid":
+        south, west, north, east = (to_microdegrees(value) for value in (south, west, north, east))
+        lat_limit, lon_limit = 90 * MICRODEGREES, 180 * MICRODEGREES
+        rows = index_range(south, north, step, lat_limit)
+        if west <= east:
+            columns = [index_range(west, east, step, lon_limit)]
+        else:
+            columns = [index_range(west, lon_limit, step, lon_limit), index_range(-lon_limit, east, step, lon_limit)]
+        return cls(step, rows, columns)
+
+    def cells(self) -> int:
+        return (self.rows[1] - self.rows[0] + 1) * sum(last - first + 1 for first, last in self.columns)
+
+    def boxes(self) -> List[BoundingBox]:
+        """
+        The bounding boxes covering the cells, in degrees
+        """
+
+        def degrees(index: int, limit: int) -> float:
+            return max(-limit, min(limit, index * self.step / MICRODEGREES))
+
+        south, north = degrees(self.rows[0], 90), degrees(self.rows[1] + 1, 90)
+        return [(south, north, degrees(first, 180), degrees(last + 1, 180)) for first, last in self.columns]
+
+    def filter(self, row: str, column: str, scale: int = 1) -> Q:
+        """
+        Restricts the 'row' and 'column' indexes of cells 'scale' times smaller to the grid
+        """
+        columns = Q()
+        for first, last in self.columns:
+            columns |= Q(**{f"{column}__range": (first * scale, (last + 1) * scale - 1)})
+        return Q(**{f"{row}__range": (self.rows[0] * scale, (self.rows[1] + 1) * scale - 1)}) & columns
+
+
+def cell_step(cell: float) -> Optional[int]:
+    """
+    The 'cell' size in microdegrees, None when it is not a whole number of them
+    """
+    microdegrees = Decimal(str(cell)) * MICRODEGREES
+    return int(microdegrees) if microdegrees > 0 and microdegrees == microdegrees.to_integral_value() else None
+
+
+def rollup_step(step: int) -> Optional[int]:
+    """
+    The coarsest rollup whose cells tile the cells of 'step' microdegrees exactly
+    """
+    return max((rollup for rollup in ROLLUP_STEPS if step % rollup == 0), default=None)
+
+
+def grid_counts(queryset, grid: Grid, per_character: bool = False) -> Counter:
+    """
+    Counts the locations of the queryset in each cell of the grid, grouped in the database on
+    the integer quantized coordinates, per character when 'per_character' is set
+    """
+    groups = ["row", "column", "character"] if per_character else ["row", "column"]
+    rows = (
+        filter_by_spatial_index(queryset, grid.boxes())
+        .annotate(row=cell_index_expression("lat", grid.step), column=cell_index_expression("lon", grid.step))
+        .filter(grid.filter("row", "column"))
+        .values(*groups)
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    return Counter({tuple(row[group] for group in groups): row["count"] for row in rows})
+
+
+def rollup_counts(grid: Grid, step: int, start: Optional[datetime] = None, end: Optional[datetime] = None) -> Counter:
+    """
+    Counts the locations in each cell of the grid from the rollups of 'step' microdegrees, over
+    the whole hours from 'start' included to 'end' excluded
+    """
+    scale = grid.step // step
+    rollups = DensityRollup.objects.filter(grid.filter("lat_index", "lon_index", scale), step=step)
+    if start is not None:
+        rollups = rollups.filter(hour__gte=start, hour__lt=end)
+    if scale > 1:
+        rollups = rollups.annotate(
+            row=Floor(Cast(F("lat_index"), FloatField()) / scale, output_field=IntegerField()),
+            column=Floor(Cast(F("lon_index"), FloatField()) / scale, output_field=IntegerField()),
+        )
+    else:
+        rollups = rollups.annotate(row=F("lat_index"), column=F("lon_index"))
+    cells = rollups.values("row", "column").annotate(total=Sum("count")).order_by()
+    return Counter({(cell["row"], cell["column"]): cell["total"] for cell in cells})
+
+
+def density_counts(queryset, grid: Grid, date_range: Optional[Tuple[datetime, datetime]] = None) -> Counter:
+    """
+    Counts the locations of the queryset in each cell of the grid, reading the whole hours of the
+    'date_range' from the rollups when a rollup tiles the cells, and only the locations of the
+    partial hours at its ends
+    """
+    step = rollup_step(grid.step)
+    if step is None:
+        if date_range is not None:
+            queryset = queryset.filter(timestamp__range=date_range)
+        return grid_counts(queryset, grid)
+    if date_range is None:
+        return rollup_counts(grid, step)
+
+    start, end = date_range
+    first_hour, last_hour = hour_of(start), hour_of(end)
+    if first_hour < start:
+        first_hour += timedelta(hours=1)
+    if first_hour >= last_hour:
+        queryset = queryset.filter(timestamp__range=date_range)
+        return grid_counts(queryset, grid)
+
+    counts = rollup_counts(grid, step, first_hour, last_hour)
+    if start < first_hour:
+        head = queryset.filter(timestamp__gte=start, timestamp__lt=first_hour)
+        counts.update(grid_counts(head, grid))
+    tail = queryset.filter(timestamp__gte=last_hour, timestamp__lte=end)
+    counts.update(grid_counts(tail, grid))
+    return counts
+
+
+def cells_of(counts: Counter, step: int, per_character: bool = False) -> List[dict]:
+    """
+    The non empty cells identified by their south west corner, in order
+    """
+    cells = []
+    for key, count in sorted(counts.items()):
+        if count <= 0:
+            continue
+        cell = {"lat": round(key[0] * step / MICRODEGREES, 6), "lon": round(key[1] * step / MICRODEGREES, 6), "count": count}
+        if per_character:
+            cell["character"] = key[2]
+        cells.append(cell)
+    return cells
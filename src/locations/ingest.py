@@ -0,0 +1,73 @@
+from typing import Any, Dict, List, Sequence, Tuple
+
+from django.db import transaction
+from rest_framework import serializers
+from rest_framework.fields import empty
+
+from characters.models import Character
+
+from .models import Location
+from .serializers import LocationSerializer
+
+# Rows inserted by each bulk insert, each of them in its own transaction
+INGEST_BATCH_SIZE = 1000
+MAX_INGEST_ROWS = 100_000
+
+RowErrors = Dict[str, Any]
+
+
+def validate_rows(rows: Sequence[Any]) -> Tuple[List[Location], List[RowErrors]]:
+    """
+    Validates the rows of a bulk ingest with the fields of LocationSerializer, without building a
+    serializer per row, and checks every character with a single query. Returns the valid locations
+    and the errors of the invalid rows, with their 'index' in 'rows'
+    """
+    fields = LocationSerializer().fields
+    # The character is checked for all the rows at once instead of with a query per row
+    character_field = serializers.IntegerField()
+    value_fields = [name for name in LocationSerializer.Meta.fields if not fields[name].read_only and name != "character"]
+
+    validated, errors = [], []
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            errors.append({"index": index, "errors": {"non_field_errors": ["Expected an object"]}})
+            continue
+
+        values, row_errors = {}, {}
+        for name, field in [("character", character_field), *((name, fields[name]) for name in value_fields)]:
+            try:
+                values[name] = field.run_validation(row.get(name, empty))
+            except serializers.ValidationError as e:
+                row_errors[name] = e.detail
+        if row_errors:
+            errors.append({"index": index, "errors": row_errors})
+        else:
+            validated.append((index, values))
+
+    existing = set(
+        Character.objects.filter(id__in={values["character"] for _, values in validated}).values_list("id", flat=True)
+    )
+    locations = []
+    for index, values in validated:
+        if values["character"] not in existing:
+            errors.append(
+                {"index": index, "errors": {"character": [f'Invalid pk "{values["character"]}" - object does not exist.']}}
+            )
+            continue
+        values["character_id"] = values.pop("character")
+        locations.append(Location(**values))
+
+    errors.sort(key=lambda error: error["index"])
+    return locations, errors
+
+
+def ingest(locations: Sequence[Location], batch_size: int = INGEST_BATCH_SIZE) -> List[Location]:
+    """
+    Inserts the 'locations' with one bulk insert and one transaction per 'batch_size' rows, so a
+    large ingest never holds the write lock for long
+    """
+    created = []
+    for start in range(0, len(locations), batch_size):
+        with transaction.atomic():
+            created += Location.objects.bulk_create(locations[start:start + batch_size])
+    return created
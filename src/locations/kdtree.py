@@ -0,0 +1,155 @@
+import math
+from array import array
+from bisect import bisect_left
+from typing import List, Tuple
+
+from .geo import DEFAULT_FORMULA, DISTANCE_FORMULAS, chord_length, search_distance, unit_vector
+
+# Ranges of points up to this size are arranged together, a tree level at a time
+LEAF_SIZE = 32
+
+
+class KDTree:
+    """
+    Static KD-tree over points on the unit sphere, stored as flat arrays in implicit tree order:
+    the root of every [lo, hi) range is at its middle, the left subtree before it and the right
+    subtree after it. Searching in 3D Cartesian space makes radius queries immune to the
+    antimeridian and the poles. Points can be removed, which only marks them as dead
+    """
+
+    def __init__(self, ids, lats, lons):
+        """
+        'ids', 'lats' and 'lons' are sequences or NumPy arrays, the coordinates in radians. The
+        tree is arranged on NumPy arrays and copied to flat arrays for the searches
+        """
+        import numpy
+
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        cos_lats = numpy.cos(lats)
+        vectors = numpy.stack((cos_lats * numpy.cos(lons), cos_lats * numpy.sin(lons), numpy.sin(lats)))
+        order = self._arrange(numpy, vectors)
+        size = len(order)
+
+        self.ids = array("q", ids[order].tobytes())
+        self.lats = array("d", lats[order].tobytes())
+        self.lons = array("d", lons[order].tobytes())
+        self.axes = tuple(array("d", vectors[axis, order].tobytes()) for axis in range(3))
+        self.alive = bytearray(b"\x01") * size
+        self.dead = 0
+
+        # Sorted copy of the ids with their position in the tree, to find points to remove
+        by_id = numpy.argsort(ids[order], kind="stable")
+        self._sorted_ids = array("q", ids[order][by_id].tobytes())
+        self._sorted_positions = array("q", by_id.astype(numpy.int64).tobytes())
+
+    @staticmethod
+    def _arrange(numpy, vectors):
+        """
+        The order of the points in the tree. Ranges larger than LEAF_SIZE are split around their
+        median with numpy.argpartition, a linear pass each, the smaller ones are then arranged a
+        level at a time for all of them at once, sorting every range on its axis with a single
+        numpy.lexsort
+        """
+        order = numpy.arange(vectors.shape[1])
+        stack = [(0, len(order), 0)]
+        small = []
+        while stack:
+            lo, hi, axis = stack.pop()
+            if hi - lo <= LEAF_SIZE:
+                if hi - lo > 1:
+                    small.append((lo, hi, axis))
+                continue
+            mid = (lo + hi) // 2
+            segment = order[lo:hi]
+            order[lo:hi] = segment[numpy.argpartition(vectors[axis, segment], mid - lo)]
+            next_axis = (axis + 1) % 3
+            stack.append((lo, mid, next_axis))
+            stack.append((mid + 1, hi, next_axis))
+
+        ranges = numpy.array(small, dtype=numpy.int64).reshape(-1, 3)
+        los, his, axes = ranges[:, 0], ranges[:, 1], ranges[:, 2]
+        while len(los):
+            lengths = his - los
+            labels = numpy.repeat(numpy.arange(len(los)), lengths)
+            positions = numpy.arange(lengths.sum()) + numpy.repeat(los - (numpy.cumsum(lengths) - lengths), lengths)
+            segment = order[positions]
+            order[positions] = segment[numpy.lexsort((vectors[numpy.repeat(axes, lengths), segment], labels))]
+            mids = (los + his) // 2
+            los, his = numpy.concatenate((los, mids + 1)), numpy.concatenate((mids, his))
+            axes = (numpy.concatenate((axes, axes)) + 1) % 3
+            split = his - los > 1
+            los, his, axes = los[split], his[split], axes[split]
+        return order
+
+    def __len__(self) -> int:
+        return len(self.ids) - self.dead
+
+    def remove(self, location_id: int) -> bool:
+        index = bisect_left(self._sorted_ids, location_id)
+        if index == len(self._sorted_ids) or self._sorted_ids[index] != location_id:
+            return False
+
+        position = self._sorted_positions[index]
+        if not self.alive[position]:
+            return False
+        self.alive[position] = 0
+        self.dead += 1
+        return True
+
+    def points(self) -> tuple:
+        """
+        Copies of the (ids, lats, lons) NumPy arrays of the points that were not removed
+        """
+        import numpy
+
+        alive = numpy.frombuffer(self.alive, dtype=numpy.bool_)
+        return (
+            numpy.frombuffer(self.ids, dtype=numpy.int64)[alive],
+            numpy.frombuffer(self.lats, dtype=numpy.float64)[alive],
+            numpy.frombuffer(self.lons, dtype=numpy.float64)[alive],
+        )
+
+    def radius(
+        self, lat: float, lon: float, distance: float, formula: str = DEFAULT_FORMULA
+    ) -> List[Tuple[int, float]]:
+        """
+        Returns the (id, distance) of every point within 'distance' meters of ('lat', 'lon'),
+        given in radians, as computed by 'formula'
+        """
+        query = unit_vector(lat, lon)
+        distance_function = DISTANCE_FORMULAS[formula]
+        # Widening the chord slightly so floating point error never drops a point on the border
+        max_chord = chord_length(search_distance(distance, formula, math.degrees(lat))) * (1 + 1e-9) + 1e-12
+        max_chord_squared = max_chord * max_chord
+        ids, lats, lons, axes, alive = self.ids, self.lats, self.lons, self.axes, self.alive
+
+        found = []
+        stack = [(0, len(ids), 0)]
+        while stack:
+            lo, hi, axis = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+
+            if alive[mid]:
+                squared = (
+                    (axes[0][mid] - query[0]) ** 2
+                    + (axes[1][mid] - query[1]) ** 2
+                    + (axes[2][mid] - query[2]) ** 2
+                )
+                if squared <= max_chord_squared:
+                    point_distance = distance_function(lat, lon, lats[mid], lons[mid])
+                    if point_distance <= distance:
+                        found.append((ids[mid], point_distance))
+
+            difference = query[axis] - axes[axis][mid]
+            next_axis = (axis + 1) % 3
+            near, far = ((lo, mid), (mid + 1, hi)) if difference < 0 else ((mid + 1, hi), (lo, mid))
+            if difference * difference <= max_chord_squared:
+                stack.append((far[0], far[1], next_axis))
+            stack.append((near[0], near[1], next_axis))
+
+        return found
+
@@ -0,0 +1,77 @@
+import random
+import time
+from statistics import median
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+from rest_framework.request import Request
+
+from characters.models import Character
+from locations.models import Location
+from locations.rtree import rtree_available
+from locations.views import LocationViewSet
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the near query with each distance engine, with and without the SQLite R*Tree index, "
+        "on a synthetic table. "
+        "Everything is written inside a transaction that is rolled back at the end"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=2_000_000)
+        parser.add_argument("--queries", type=int, default=50)
+        parser.add_argument("--distance", type=float, default=5_000)
+        parser.add_argument("--batch-size", type=int, default=10_000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--engines", default="sql,numpy", help="Comma separated distance engines")
+
+    def handle(self, *args, **options):
+        if not rtree_available():
+            self.stderr.write("The R*Tree index is not available, only the ORM path can be measured")
+
+        rng = random.Random(options["seed"])
+        with transaction.atomic():
+            self.populate(rng, options["rows"], options["batch_size"])
+
+            points = [
+                f"{rng.uniform(-80, 80):.6f},{rng.uniform(-180, 180):.6f}" for _ in range(options["queries"])
+            ]
+            for engine in options["engines"].split(","):
+                for use_rtree in (True, False):
+                    with override_settings(LOCATIONS_DISTANCE_ENGINE=engine, LOCATIONS_RTREE_INDEX=use_rtree):
+                        timings = self.measure(points, options["distance"])
+                    self.stdout.write(
+                        f"{engine} / {'R*Tree' if use_rtree and rtree_available() else 'ORM'}: "
+                        f"median {median(timings) * 1000:.2f} ms, max {max(timings) * 1000:.2f} ms"
+                    )
+
+            transaction.set_rollback(True)
+
+    def populate(self, rng, rows, batch_size):
+        character = Character.objects.create(
+            name="Benchmark", date_of_birth="1970-01-01", occupation="Benchmark"
+        )
+        for start in range(0, rows, batch_size):
+            Location.objects.bulk_create(
+                Location(
+                    character=character,
+                    timestamp="2020-01-01T00:00:00Z",
+                    lat=f"{rng.uniform(-90, 90):.6f}",
+                    lon=f"{rng.uniform(-180, 180):.6f}",
+                )
+                for _ in range(min(batch_size, rows - start))
+            )
+        self.stdout.write(f"Inserted {rows} synthetic locations")
+
+    @staticmethod
+    def measure(points, distance):
+        view = LocationViewSet(request=Request(RequestFactory().get("/locations/near/")))
+        timings = []
+        for coordinates in points:
+            start = time.perf_counter()
+            list(view.filter_by_distance(Location.objects.all(), coordinates, distance))
+            timings.append(time.perf_counter() - start)
+        return timings
@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework import serializers
+
+from locations.colocation import find_colocations, points_of
+from locations.models import Location
+from locations.serializers import parse_date_range
+
+
+class Command(BaseCommand):
+    help = (
+        "Lists the pairs of characters that were within --distance meters of each other within "
+        "--time-window minutes, in a single sweep over the locations ordered by timestamp"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--distance", type=float, required=True, help="Meters")
+        parser.add_argument("--time-window", type=int, required=True, help="Minutes")
+        parser.add_argument("--character", type=int, help="Only the pairs of this character id")
+        parser.add_argument("--date-range", help="start,end datetimes of the locations to search")
+
+    def handle(self, *args, **options):
+        locations = Location.objects.all()
+        if options["date_range"]:
+            try:
+                start, end = parse_date_range(options["date_range"])
+            except serializers.ValidationError as e:
+                raise CommandError(f"Invalid --date-range: {e.detail[0]}")
+            locations = locations.filter(timestamp__range=[start, end])
+
+        pairs = find_colocations(
+            points_of(locations), options["distance"], timedelta(minutes=options["time_window"]), options["character"]
+        )
+        for pair in pairs:
+            self.stdout.write(
+                f"{pair['character_a']} and {pair['character_b']}: {pair['meetings']} meetings from "
+                f"{pair['first_seen'].isoformat()} to {pair['last_seen'].isoformat()}, "
+                f"{pair['closest']:.1f} meters apart at the closest"
+            )
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from locations.models import Contact
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the contacts between characters from the locations. They are recorded as locations "
+        "are created, this accounts for the locations moved or deleted since, or written before"
+    )
+
+    def handle(self, *args, **options):
+        pairs = Contact.objects.rebuild()
+        self.stdout.write(f"Rebuilt the contacts: {pairs} pairs of characters")
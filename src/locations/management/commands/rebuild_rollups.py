@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from locations.models import DensityRollup
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the density rollups from the locations. They are kept up to date as locations are "
+        "written, this repairs them after writes that bypass the ORM"
+    )
+
+    def handle(self, *args, **options):
+        cells = DensityRollup.objects.rebuild()
+        self.stdout.write(f"Rebuilt the density rollups: {cells} cells")
@@ -0,0 +1,193 @@
+import math
+import threading
+import time
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .geo import DEFAULT_FORMULA, DISTANCE_FORMULAS
+from .kdtree import KDTree
+
+# Pending points are merged into a rebuilt tree once they exceed this share of the tree size
+REBUILD_RATIO = 0.05
+MIN_REBUILD_SIZE = 1024
+
+
+class LocationIndex:
+    """
+    In-process spatial index over every Location, answering radius queries with ids and distances.
+    It is loaded from the database on first use and reloaded after LOCATIONS_MEMORY_INDEX_MAX_AGE
+    seconds, so writes made by other processes show up after at most that long. Writes made by this
+    process are applied incrementally: moved or deleted points are removed from the KD-tree and new
+    positions wait in a small pending buffer until the tree is rebuilt. Reloads and rebuilds run in
+    a background thread while the current tree keeps answering, the writes made in the meantime are
+    replayed on the new tree when it is swapped in
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._tree: Optional[KDTree] = None
+        self._pending: Dict[int, Tuple[float, float]] = {}
+        self._loaded_at = 0.0
+        # Writes made since the tree being built was read, None when no tree is being built
+        self._changes: Optional[Dict[int, Optional[Tuple[float, float]]]] = None
+        self._builder: Optional[threading.Thread] = None
+        # Bumped by clear, so a tree built before it is dropped
+        self._generation = 0
+
+    @staticmethod
+    def enabled() -> bool:
+        return getattr(settings, "LOCATIONS_DISTANCE_ENGINE", "sql") == "kdtree"
+
+    def clear(self):
+        with self._lock:
+            self._tree = None
+            self._pending = {}
+            self._changes = None
+            self._generation += 1
+
+    def wait(self, timeout: Optional[float] = None):
+        """
+        Waits for the tree being built in the background, if any
+        """
+        builder = self._builder
+        if builder is not None:
+            builder.join(timeout)
+
+    def _ensure_loaded(self):
+        max_age = getattr(settings, "LOCATIONS_MEMORY_INDEX_MAX_AGE", 300)
+        if self._tree is None:
+            # Nothing to answer with yet
+            self._swap(KDTree(*self._read()))
+        elif time.monotonic() - self._loaded_at > max_age and self._builder is None:
+            self._build(self._read)
+
+    def _read(self) -> tuple:
+        """
+        The (ids, lats, lons) of every location in the database, the coordinates in radians
+        """
+        from .models import Location
+
+        self._loaded_at = time.monotonic()
+        ids, lats, lons = array("q"), array("d"), array("d")
+        for location_id, lat, lon in Location.objects.values_list("id", "lat", "lon").iterator():
+            ids.append(location_id)
+            lats.append(math.radians(lat))
+            lons.append(math.radians(lon))
+        return ids, lats, lons
+
+    def _snapshot(self) -> tuple:
+        """
+        Copies of the (ids, lats, lons) of the points of the tree and of the pending ones
+        """
+        import numpy
+
+        ids, lats, lons = self._tree.points()
+        pending_ids = numpy.fromiter(self._pending, dtype=numpy.int64, count=len(self._pending))
+        pending_points = numpy.array(list(self._pending.values()), dtype=numpy.float64).reshape(-1, 2)
+        return (
+            numpy.concatenate((ids, pending_ids)),
+            numpy.concatenate((lats, pending_points[:, 0])),
+            numpy.concatenate((lons, pending_points[:, 1])),
+        )
+
+    def _build(self, points: Callable[[], tuple]):
+        """
+        Builds a tree of the (ids, lats, lons) returned by 'points' in a background thread, and
+        swaps it in under the lock
+        """
+        self._changes = {}
+        generation = self._generation
+
+        def build():
+            try:
+                tree = KDTree(*points())
+                with self._lock:
+                    if generation == self._generation:
+                        self._swap(tree)
+            finally:
+                with self._lock:
+                    if self._builder is threading.current_thread():
+                        self._builder = None
+                    if generation == self._generation:
+                        self._changes = None
+                connections.close_all()
+
+        self._builder = threading.Thread(target=build, name="location-index-build", daemon=True)
+        self._builder.start()
+
+    def _swap(self, tree: KDTree):
+        """
+        Replaces the tree with 'tree', replaying the writes made since it was read
+        """
+        pending = {}
+        for location_id, point in (self._changes or {}).items():
+            tree.remove(location_id)
+            if point is not None:
+                pending[location_id] = point
+        self._tree, self._pending, self._changes = tree, pending, None
+
+    def upsert(self, location_id: int, lat: float, lon: float):
+        with self._lock:
+            if self._tree is None:
+                # Not loaded yet, the point is read from the database on first use
+                return
+
+            point = (math.radians(lat), math.radians(lon))
+            self._tree.remove(location_id)
+            self._pending[location_id] = point
+            if self._changes is not None:
+                self._changes[location_id] = point
+            elif len(self._pending) > max(MIN_REBUILD_SIZE, len(self._tree) * REBUILD_RATIO):
+                # The snapshot is taken now, the tree is built from it in the background
+                snapshot = self._snapshot()
+                self._build(lambda: snapshot)
+
+    def remove(self, location_id: int):
+        with self._lock:
+            if self._tree is None:
+                return
+
+            self._tree.remove(location_id)
+            self._pending.pop(location_id, None)
+            if self._changes is not None:
+                self._changes[location_id] = None
+
+    def upsert_on_commit(self, locations, using: Optional[str] = None):
+        """
+        Indexes the new coordinates of 'locations' once the current transaction commits
+        """
+        if not self.enabled():
+            return
+
+        points = [(location.id, float(location.lat), float(location.lon)) for location in locations]
+        transaction.on_commit(lambda: [self.upsert(*point) for point in points], using=using)
+
+    def remove_on_commit(self, location_id: int, using: Optional[str] = None):
+        if not self.enabled():
+            return
+
+        transaction.on_commit(lambda: self.remove(location_id), using=using)
+
+    def radius(
+        self, lat: float, lon: float, distance: float, formula: str = DEFAULT_FORMULA
+    ) -> List[Tuple[int, float]]:
+        """
+        Returns the (id, distance) of every location within 'distance' meters of ('lat', 'lon'),
+        given in degrees, as computed by 'formula'
+        """
+        lat, lon = math.radians(lat), math.radians(lon)
+        distance_function = DISTANCE_FORMULAS[formula]
+        with self._lock:
+            self._ensure_loaded()
+            found = self._tree.radius(lat, lon, distance, formula)
+            for location_id, (point_lat, point_lon) in self._pending.items():
+                point_distance = distance_function(lat, lon, point_lat, point_lon)
+                if point_distance <= distance:
+                    found.append((location_id, point_distance))
+        return found
+
+
+location_index = LocationIndex()
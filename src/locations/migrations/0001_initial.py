@@ -0,0 +1,26 @@
+# Generated by Django 4.2.1 on 2026-10-15 14:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('characters', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Location',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField()),
+                ('lat', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('lon', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('character', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='locations', to='characters.character')),
+            ],
+        ),
+    ]
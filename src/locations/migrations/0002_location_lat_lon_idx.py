@@ -0,0 +1,17 @@
+# Generated by Django 4.2.1 on 2026-10-15 14:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['lat', 'lon'], name='location_lat_lon_idx'),
+        ),
+    ]
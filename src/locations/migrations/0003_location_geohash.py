@@ -0,0 +1,42 @@
+from django.db import migrations, models
+
+from locations.geo import encode_geohash
+
+BATCH_SIZE = 2000
+
+
+def backfill_geohash(apps, schema_editor):
+    Location = apps.get_model("locations", "Location")
+    last_id = 0
+    while True:
+        locations = list(
+            Location.objects.filter(id__gt=last_id).only("id", "lat", "lon").order_by("id")[:BATCH_SIZE]
+        )
+        if not locations:
+            break
+        for location in locations:
+            location.geohash = encode_geohash(float(location.lat), float(location.lon))
+        Location.objects.bulk_update(locations, ["geohash"])
+        last_id = locations[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0002_location_lat_lon_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='geohash',
+            field=models.CharField(default='', editable=False, max_length=9),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_geohash, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='location',
+            name='geohash',
+            field=models.CharField(db_index=True, editable=False, max_length=9),
+        ),
+    ]
@@ -0,0 +1,79 @@
+from django.db import migrations, transaction
+from django.db.utils import OperationalError
+
+CREATE_RTREE = """
+    CREATE VIRTUAL TABLE locations_location_rtree USING rtree(
+        id, min_lat, max_lat, min_lon, max_lon
+    )
+"""
+
+BACKFILL_RTREE = """
+    INSERT INTO locations_location_rtree (id, min_lat, max_lat, min_lon, max_lon)
+    SELECT id, lat, lat, lon, lon FROM locations_location
+"""
+
+CREATE_TRIGGERS = [
+    """
+    CREATE TRIGGER locations_location_rtree_insert AFTER INSERT ON locations_location
+    BEGIN
+        INSERT INTO locations_location_rtree (id, min_lat, max_lat, min_lon, max_lon)
+        VALUES (NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon);
+    END
+    """,
+    """
+    CREATE TRIGGER locations_location_rtree_update AFTER UPDATE OF id, lat, lon ON locations_location
+    BEGIN
+        DELETE FROM locations_location_rtree WHERE id = OLD.id;
+        INSERT INTO locations_location_rtree (id, min_lat, max_lat, min_lon, max_lon)
+        VALUES (NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon);
+    END
+    """,
+    """
+    CREATE TRIGGER locations_location_rtree_delete AFTER DELETE ON locations_location
+    BEGIN
+        DELETE FROM locations_location_rtree WHERE id = OLD.id;
+    END
+    """,
+]
+
+DROP_RTREE = [
+    "DROP TRIGGER IF EXISTS locations_location_rtree_insert",
+    "DROP TRIGGER IF EXISTS locations_location_rtree_update",
+    "DROP TRIGGER IF EXISTS locations_location_rtree_delete",
+    "DROP TABLE IF EXISTS locations_location_rtree",
+]
+
+
+def create_rtree(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute(CREATE_RTREE)
+    except OperationalError:
+        # SQLite was built without the R*Tree module, the near endpoint falls back to the ORM path
+        return
+
+    schema_editor.execute(BACKFILL_RTREE)
+    for sql in CREATE_TRIGGERS:
+        schema_editor.execute(sql)
+
+
+def drop_rtree(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+
+    for sql in DROP_RTREE:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0003_location_geohash'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_rtree, drop_rtree),
+    ]
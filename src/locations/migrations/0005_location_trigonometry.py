@@ -0,0 +1,60 @@
+import math
+
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+TRIGONOMETRY_FIELDS = ["sin_lat", "cos_lat", "sin_lon", "cos_lon"]
+
+
+def backfill_trigonometry(apps, schema_editor):
+    Location = apps.get_model("locations", "Location")
+    last_id = 0
+    while True:
+        locations = list(
+            Location.objects.filter(id__gt=last_id).only("id", "lat", "lon").order_by("id")[:BATCH_SIZE]
+        )
+        if not locations:
+            break
+        for location in locations:
+            lat, lon = math.radians(location.lat), math.radians(location.lon)
+            location.sin_lat = math.sin(lat)
+            location.cos_lat = math.cos(lat)
+            location.sin_lon = math.sin(lon)
+            location.cos_lon = math.cos(lon)
+        Location.objects.bulk_update(locations, TRIGONOMETRY_FIELDS)
+        last_id = locations[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0004_location_rtree'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='sin_lat',
+            field=models.FloatField(default=0.0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='cos_lat',
+            field=models.FloatField(default=0.0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='sin_lon',
+            field=models.FloatField(default=0.0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='cos_lon',
+            field=models.FloatField(default=0.0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_trigonometry, migrations.RunPython.noop),
+    ]
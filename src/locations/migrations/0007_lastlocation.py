@@ -0,0 +1,37 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_last_locations(apps, schema_editor):
+    Character = apps.get_model("characters", "Character")
+    Location = apps.get_model("locations", "Location")
+    LastLocation = apps.get_model("locations", "LastLocation")
+    for character_id in Character.objects.values_list("id", flat=True).iterator():
+        latest = (
+            Location.objects.filter(character_id=character_id)
+            .order_by("-timestamp", "-id")
+            .values_list("id", "timestamp")
+            .first()
+        )
+        if latest is not None:
+            LastLocation.objects.create(character_id=character_id, location_id=latest[0], timestamp=latest[1])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('characters', '0001_initial'),
+        ('locations', '0006_location_character_timestamp_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LastLocation',
+            fields=[
+                ('character', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='last_location', serialize=False, to='characters.character')),
+                ('timestamp', models.DateTimeField()),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='locations.location')),
+            ],
+        ),
+        migrations.RunPython(backfill_last_locations, migrations.RunPython.noop),
+    ]
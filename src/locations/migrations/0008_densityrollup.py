@@ -0,0 +1,75 @@
+from collections import Counter
+from datetime import timezone as dt_timezone
+
+from django.db import migrations, models
+from django.db.models import Count, F, FloatField, IntegerField, Max, Min
+from django.db.models.functions import Cast, Floor, Round, TruncHour
+
+# Frozen copy of locations.grid.ROLLUP_STEPS
+ROLLUP_STEPS = (10_000, 100_000, 1_000_000)
+
+
+def cell_index(field, step):
+    return Floor(Round(Cast(F(field), FloatField()) * 1_000_000) / step, output_field=IntegerField())
+
+
+def backfill_density_rollups(apps, schema_editor):
+    Location = apps.get_model("locations", "Location")
+    DensityRollup = apps.get_model("locations", "DensityRollup")
+    bounds = Location.objects.aggregate(first=Min("timestamp"), last=Max("timestamp"))
+    if bounds["first"] is None:
+        return
+
+    # A month of locations at a time
+    month = bounds["first"].astimezone(dt_timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while month <= bounds["last"]:
+        following = month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+        counts = Counter()
+        for step in ROLLUP_STEPS:
+            cells = (
+                Location.objects.filter(timestamp__gte=month, timestamp__lt=following)
+                .order_by()
+                .annotate(
+                    hour=TruncHour("timestamp", tzinfo=dt_timezone.utc),
+                    lat_index=cell_index("lat", step),
+                    lon_index=cell_index("lon", step),
+                )
+                .values("hour", "lat_index", "lon_index")
+                .annotate(locations=Count("id"))
+            )
+            for cell in cells:
+                counts[(step, cell["hour"], cell["lat_index"], cell["lon_index"])] += cell["locations"]
+        DensityRollup.objects.bulk_create(
+            [
+                DensityRollup(step=step, hour=hour, lat_index=lat_index, lon_index=lon_index, count=count)
+                for (step, hour, lat_index, lon_index), count in counts.items()
+            ],
+            batch_size=2000,
+        )
+        month = following
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0007_lastlocation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DensityRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('step', models.PositiveIntegerField()),
+                ('hour', models.DateTimeField()),
+                ('lat_index', models.IntegerField()),
+                ('lon_index', models.IntegerField()),
+                ('count', models.IntegerField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='densityrollup',
+            constraint=models.UniqueConstraint(fields=('step', 'hour', 'lat_index', 'lon_index'), name='densityrollup_cell_unique'),
+        ),
+        migrations.RunPython(backfill_density_rollups, migrations.RunPython.noop),
+    ]
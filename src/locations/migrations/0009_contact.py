@@ -0,0 +1,30 @@
+# Generated by Django 4.2.1 on 2026-10-15 14:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('characters', '0001_initial'),
+        ('locations', '0008_densityrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Contact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_seen', models.DateTimeField()),
+                ('last_seen', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('character', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contacts', to='characters.character')),
+                ('contact', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='characters.character')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='contact',
+            constraint=models.UniqueConstraint(fields=('character', 'contact'), name='contact_pair_unique'),
+        ),
+    ]
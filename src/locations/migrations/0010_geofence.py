@@ -0,0 +1,50 @@
+# Generated by Django 4.2.1 on 2026-10-15 14:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('characters', '0001_initial'),
+        ('locations', '0009_contact'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Geofence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('kind', models.CharField(choices=[('circle', 'Circle'), ('polygon', 'Polygon')], max_length=7)),
+                ('lat', models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True)),
+                ('lon', models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True)),
+                ('radius', models.FloatField(blank=True, null=True)),
+                ('polygon', models.JSONField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GeofenceState',
+            fields=[
+                ('character', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='characters.character')),
+                ('timestamp', models.DateTimeField()),
+                ('location_id', models.BigIntegerField()),
+                ('fences', models.JSONField(default=list)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GeofenceEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('enter', 'Enter'), ('exit', 'Exit')], max_length=5)),
+                ('timestamp', models.DateTimeField()),
+                ('character', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='geofence_events', to='characters.character')),
+                ('fence', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='locations.geofence')),
+                ('location', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='locations.location')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['fence', 'timestamp'], name='geofenceevent_fence_ts_idx'), models.Index(fields=['character', 'timestamp'], name='geofenceevent_character_ts_idx'), models.Index(fields=['timestamp'], name='geofenceevent_timestamp_idx')],
+            },
+        ),
+    ]
@@ -1,9 +1,133 @@
-from django.db import models
+import math
+from collections import Counter
+from datetime import timedelta, timezone as dt_timezone
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.db.models import Count, Max, Min, Q
+from django.db.models.functions import TruncHour
 
 from characters.models import Character
 
+from .geo import EARTH_RADIUS, GEOHASH_PRECISION, bounding_boxes, encode_geohash, haversine
+from .grid import ROLLUP_STEPS, cell_index_expression, month_of, next_month, rollup_deltas
+from .clusters import cluster_index
+from .colocation import SpatialHash, find_colocations, points_of
+from .geofences import CIRCLE, POLYGON, geofence_index
+from .memory_index import location_index
+from .tiles import tile_cache
+
+
+def locations_moved(using: str, added: Iterable[tuple] = (), removed: Iterable[tuple] = ()):
+    """
+    Updates the aggregates of the locations after the (lat, lon, timestamp) rows 'removed' were
+    replaced by the rows 'added'
+    """
+    added, removed = list(added), list(removed)
+    DensityRollup.objects.db_manager(using).apply(rollup_deltas(added=added, removed=removed))
+    tile_cache.invalidate_on_commit(added + removed, using=using)
+
+
+class LocationQuerySet(models.QuerySet):
+    """
+    QuerySet that keeps the derived columns in sync on the bulk write paths, which skip
+    Location.save
+    """
+
+    def _plain(self) -> models.QuerySet:
+        # Writing through a plain QuerySet so the derived fields are not recomputed twice
+        return models.QuerySet(self.model, using=self.db)
+
+    def _characters(self, pks) -> set:
+        return set(self._plain().filter(pk__in=pks).values_list("character_id", flat=True))
+
+    def _rollup_sources(self, pks) -> list:
+        return list(self._plain().filter(pk__in=pks).values_list(*self.model.SOURCE_FIELDS))
+
+    def _contacts(self) -> "ContactManager":
+        return Contact.objects.db_manager(self.db)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.set_derived_fields()
+        with transaction.atomic(using=self.db):
+            created = super().bulk_create(objs, *args, **kwargs)
+            locations_moved(self.db, added=[obj.rollup_source() for obj in created])
+            self._contacts().record(created)
+            GeofenceEvent.objects.db_manager(self.db).record(created)
+            LastLocation.objects.db_manager(self.db).advance(created)
+        location_index.upsert_on_commit([obj for obj in created if obj.id is not None], using=self.db)
+        cluster_index.upsert_on_commit([obj for obj in created if obj.id is not None], using=self.db)
+        return created
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        fields = list(fields)
+        derived = set(self.model.SOURCE_FIELDS) & set(fields)
+        reordered = set(self.model.HISTORY_FIELDS) & set(fields)
+        if derived:
+            for obj in objs:
+                obj.set_derived_fields()
+            fields += [field for field in self.model.DERIVED_FIELDS if field not in fields]
+            location_index.upsert_on_commit(objs, using=self.db)
+            cluster_index.upsert_on_commit(objs, using=self.db)
+        if not (derived or reordered):
+            return self._plain().bulk_update(objs, fields, *args, **kwargs)
+
+        with transaction.atomic(using=self.db):
+            pks = [obj.pk for obj in objs]
+            characters = self._characters(pks) if reordered else set()
+            previous = self._rollup_sources(pks) if derived else []
+            self._contacts().remove(self._plain().filter(pk__in=pks))
+            rows = self._plain().bulk_update(objs, fields, *args, **kwargs)
+            self._contacts().record(self._plain().filter(pk__in=pks))
+            if derived:
+                locations_moved(self.db, added=self._rollup_sources(pks), removed=previous)
+            if reordered:
+                LastLocation.objects.db_manager(self.db).refresh(characters | {obj.character_id for obj in objs})
+        return rows
+
+    def update(self, **kwargs):
+        derived = set(self.model.SOURCE_FIELDS) & set(kwargs)
+        reordered = set(self.model.HISTORY_FIELDS) & set(kwargs)
+        if not (derived or reordered):
+            return super().update(**kwargs)
+
+        with transaction.atomic(using=self.db):
+            pks = list(self.values_list("pk", flat=True))
+            characters = self._characters(pks) if reordered else set()
+            previous = self._rollup_sources(pks) if derived else []
+            self._contacts().remove(self._plain().filter(pk__in=pks))
+            rows = super().update(**kwargs)
+            if derived:
+                locations = list(self._plain().filter(pk__in=pks))
+                for location in locations:
+                    location.set_derived_fields()
+                self._plain().bulk_update(locations, self.model.DERIVED_FIELDS)
+                location_index.upsert_on_commit(locations, using=self.db)
+                cluster_index.upsert_on_commit(locations, using=self.db)
+                locations_moved(self.db, added=[location.rollup_source() for location in locations], removed=previous)
+            self._contacts().record(self._plain().filter(pk__in=pks))
+            if reordered:
+                LastLocation.objects.db_manager(self.db).refresh(characters | self._characters(pks))
+        return rows
+
+    def delete(self):
+        with transaction.atomic(using=self.db):
+            # Taken back while the rows, and the meetings between them, are still there
+            self._contacts().remove(self._plain().filter(pk__in=self.values("pk")))
+            return super().delete()
+
 
 class Location(models.Model):
+    DERIVED_FIELDS = ("geohash", "sin_lat", "cos_lat", "sin_lon", "cos_lon")
+    # Fields the derived fields are computed from
+    SOURCE_FIELDS = ("lat", "lon", "timestamp")
+    # Fields deciding which location of a character is the latest one
+    HISTORY_FIELDS = ("character", "character_id", "timestamp")
+
     id = models.BigAutoField(primary_key=True)
     character = models.ForeignKey(
         Character, on_delete=models.CASCADE, related_name="locations"
@@ -11,3 +135,545 @@ class Location(models.Model):
     timestamp = models.DateTimeField()
     lat = models.DecimalField(max_digits=9, decimal_places=6)
     lon = models.DecimalField(max_digits=9, decimal_places=6)
+    geohash = models.CharField(max_length=GEOHASH_PRECISION, db_index=True, editable=False)
+    # Trigonometric values of the coordinates in radians, so distance queries are plain multiply-adds
+    sin_lat = models.FloatField(editable=False)
+    cos_lat = models.FloatField(editable=False)
+    sin_lon = models.FloatField(editable=False)
+    cos_lon = models.FloatField(editable=False)
+
+    objects = LocationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["lat", "lon"], name="location_lat_lon_idx"),
+            # Range scans over the history of a character, and over every character
+            models.Index(fields=["character", "timestamp"], name="location_character_ts_idx"),
+            models.Index(fields=["timestamp"], name="location_timestamp_idx"),
+        ]
+
+    def set_derived_fields(self):
+        """
+        Recomputes the columns that only depend on the coordinates and the timestamp
+        """
+        lat, lon = float(self.lat), float(self.lon)
+        self.geohash = encode_geohash(lat, lon)
+        self.sin_lat = math.sin(math.radians(lat))
+        self.cos_lat = math.cos(math.radians(lat))
+        self.sin_lon = math.sin(math.radians(lon))
+        self.cos_lon = math.cos(math.radians(lon))
+
+    def rollup_source(self) -> tuple:
+        """
+        The (lat, lon, timestamp) the density rollups count the location with
+        """
+        return self.lat, self.lon, self._meta.get_field("timestamp").to_python(self.timestamp)
+
+    def save(self, *args, **kwargs):
+        self.set_derived_fields()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and set(self.SOURCE_FIELDS) & set(update_fields):
+            kwargs["update_fields"] = set(update_fields) | set(self.DERIVED_FIELDS)
+        if update_fields is not None and not set(self.SOURCE_FIELDS + self.HISTORY_FIELDS) & set(update_fields):
+            return super().save(*args, **kwargs)
+
+        using = kwargs.get("using") or router.db_for_write(type(self), instance=self)
+        contacts = Contact.objects.db_manager(using)
+        with transaction.atomic(using=using):
+            adding = self._state.adding
+            if not adding:
+                contacts.remove(Location.objects.using(using)._plain().filter(pk=self.pk))
+            if update_fields is None or set(self.SOURCE_FIELDS) & set(update_fields):
+                previous = [] if adding else Location.objects.using(using)._rollup_sources([self.pk])
+                super().save(*args, **kwargs)
+                locations_moved(using, added=[self.rollup_source()], removed=previous)
+            else:
+                super().save(*args, **kwargs)
+            contacts.record([self])
+            if adding:
+                GeofenceEvent.objects.db_manager(using).record([self])
+
+    def delete(self, *args, **kwargs):
+        using = kwargs.get("using") or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            Contact.objects.db_manager(using).remove(Location.objects.using(using)._plain().filter(pk=self.pk))
+            return super().delete(*args, **kwargs)
+
+
+class LastLocationManager(models.Manager):
+    """
+    Keeps the latest location of every character, the one with the greatest (timestamp, id)
+    """
+
+    def advance(self, locations: Iterable[Location]):
+        """
+        Makes the new 'locations' the latest ones of their characters when they are newer. Each
+        character is moved forward with a single conditional update, so concurrent writers can
+        never move it back
+        """
+        timestamp_field = Location._meta.get_field("timestamp")
+        latest = {}
+        for location in locations:
+            if location.id is None:
+                # Inserted without getting its id back, the character is looked up again
+                latest[location.character_id] = None
+                continue
+            key = (timestamp_field.to_python(location.timestamp), location.id)
+            if location.character_id not in latest or (
+                latest[location.character_id] is not None and key > latest[location.character_id]
+            ):
+                latest[location.character_id] = key
+
+        self.refresh(character_id for character_id, key in latest.items() if key is None)
+        for character_id, key in latest.items():
+            if key is not None:
+                self.advance_to(character_id, *key)
+
+    def advance_to(self, character_id: int, timestamp, location_id: int):
+        newer = Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, location_id__lt=location_id)
+        values = {"location_id": location_id, "timestamp": timestamp}
+        if self.filter(newer, character_id=character_id).update(**values):
+            return
+        _, created = self.get_or_create(character_id=character_id, defaults=values)
+        if not created:
+            # Another writer created the record first, it is only replaced if older
+            self.filter(newer, character_id=character_id).update(**values)
+
+    def refresh(self, character_ids: Iterable[int]):
+        """
+        Looks the latest location of the characters up again, after locations were deleted, moved
+        to other characters or back in time
+        """
+        locations = Location.objects.db_manager(self.db)
+        for character_id in set(character_ids):
+            with transaction.atomic(using=self.db):
+                latest: Optional[tuple] = (
+                    locations.filter(character_id=character_id)
+                    .order_by("-timestamp", "-id")
+                    .values_list("id", "timestamp")
+                    .first()
+                )
+                if latest is None:
+                    self.filter(character_id=character_id).delete()
+                else:
+                    self.update_or_create(
+                        character_id=character_id, defaults={"location_id": latest[0], "timestamp": latest[1]}
+                    )
+
+
+class LastLocation(models.Model):
+    """
+    Latest known location of a character, so where every character is now is a primary key lookup
+    """
+
+    character = models.OneToOneField(
+        Character, on_delete=models.CASCADE, primary_key=True, related_name="last_location"
+    )
+    location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name="+")
+    timestamp = models.DateTimeField()
+
+    objects = LastLocationManager()
+
+
+class DensityRollupManager(models.Manager):
+    """
+    Keeps the number of locations of every hour in the cells of grids of ROLLUP_STEPS microdegrees,
+    so the density of an area is read from a number of rows independent of the number of locations
+    """
+
+    def apply(self, deltas: Counter):
+        """
+        Adds the (step, hour, lat_index, lon_index) keyed 'deltas' to the counts with a single upsert
+        per cell, the cells no location is left in are deleted
+        """
+        deltas = {key: delta for key, delta in deltas.items() if delta}
+        if not deltas:
+            return
+
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with transaction.atomic(using=self.db), connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {table} (step, hour, lat_index, lon_index, count) VALUES (%s, %s, %s, %s, %s) "
+                "ON CONFLICT (step, hour, lat_index, lon_index) DO UPDATE SET count = count + excluded.count",
+                [
+                    (step, connection.ops.adapt_datetimefield_value(hour), lat_index, lon_index, delta)
+                    for (step, hour, lat_index, lon_index), delta in deltas.items()
+                ],
+            )
+            if any(delta < 0 for delta in deltas.values()):
+                self.filter(
+                    step__in={key[0] for key in deltas}, hour__in={key[1] for key in deltas}, count__lte=0
+                ).delete()
+
+    def counts(self, locations: models.QuerySet, sign: int = 1) -> Counter:
+        """
+        Counts the 'locations' in every rollup cell, grouping in the database
+        """
+        counts = Counter()
+        for step in ROLLUP_STEPS:
+            cells = (
+                locations.order_by()
+                .annotate(
+                    hour=TruncHour("timestamp", tzinfo=dt_timezone.utc),
+                    lat_index=cell_index_expression("lat", step),
+                    lon_index=cell_index_expression("lon", step),
+                )
+                .values("hour", "lat_index", "lon_index")
+                .annotate(locations=Count("id"))
+            )
+            for cell in cells:
+                counts[(step, cell["hour"], cell["lat_index"], cell["lon_index"])] += sign * cell["locations"]
+        return counts
+
+    def rebuild(self) -> int:
+        """
+        Recomputes every count from the locations, a month at a time. Returns the number of cells
+        """
+        locations = Location.objects.db_manager(self.db)
+        cells = 0
+        with transaction.atomic(using=self.db):
+            self.all().delete()
+            bounds = locations.aggregate(first=Min("timestamp"), last=Max("timestamp"))
+            month = month_of(bounds["first"]) if bounds["first"] is not None else None
+            while month is not None and month <= bounds["last"]:
+                following = next_month(month)
+                counts = self.counts(locations.filter(timestamp__gte=month, timestamp__lt=following))
+                self.bulk_create(
+                    [
+                        DensityRollup(step=step, hour=hour, lat_index=lat_index, lon_index=lon_index, count=count)
+                        for (step, hour, lat_index, lon_index), count in counts.items()
+                    ],
+                    batch_size=2000,
+                )
+                cells += len(counts)
+                month = following
+        return cells
+
+
+class DensityRollup(models.Model):
+    """
+    Number of locations of an hour in a cell of a grid of 'step' microdegrees, the cell of a
+    location being at (floor(lat / step), floor(lon / step)) with the coordinates in microdegrees
+    """
+
+    step = models.PositiveIntegerField()
+    hour = models.DateTimeField()
+    lat_index = models.IntegerField()
+    lon_index = models.IntegerField()
+    count = models.IntegerField()
+
+    objects = DensityRollupManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["step", "hour", "lat_index", "lon_index"], name="densityrollup_cell_unique"
+            ),
+        ]
+
+
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+class ContactManager(models.Manager):
+    """
+    Records the contacts of the characters as locations are written, when LOCATIONS_CONTACTS is
+    set: two characters are in contact when they have locations within LOCATIONS_CONTACT_DISTANCE
+    meters and LOCATIONS_CONTACT_TIME_WINDOW seconds of each other. Every pair of such locations
+    counts once, and is taken back when one of them is moved or deleted. The first and last seen
+    times are not narrowed then, they stay bounds of the meetings counted until rebuild
+    """
+
+    @staticmethod
+    def enabled() -> bool:
+        return getattr(settings, "LOCATIONS_CONTACTS", False)
+
+    @staticmethod
+    def distance() -> float:
+        return getattr(settings, "LOCATIONS_CONTACT_DISTANCE", 50)
+
+    @staticmethod
+    def window() -> timedelta:
+        return timedelta(seconds=getattr(settings, "LOCATIONS_CONTACT_TIME_WINDOW", 300))
+
+    def record(self, locations: Iterable[Location]):
+        """
+        Adds the contacts of the new 'locations'
+        """
+        if self.enabled():
+            self.add(self.meetings(locations))
+
+    def remove(self, locations: Iterable[Location]):
+        """
+        Takes back the contacts of the 'locations' before they are moved or deleted, the pairs of
+        characters left without any are deleted
+        """
+        if self.enabled():
+            self.subtract(self.meetings(locations))
+
+    def meetings(self, locations: Iterable[Location]) -> Dict[Tuple[int, int], list]:
+        """
+        The (character, contact) keyed [first seen, last seen, count] meetings of the 'locations'
+        with the stored ones, themselves included. The locations near them in space and time are
+        probed with a single query for every group of them spanning less than the time window
+        """
+        timestamp_field = Location._meta.get_field("timestamp")
+        new = sorted(
+            (
+                (location.id, location.character_id, timestamp_field.to_python(location.timestamp), location)
+                for location in locations
+                if location.id is not None
+            ),
+            key=lambda point: point[2],
+        )
+        new_ids = {point[0] for point in new}
+        distance, window = self.distance(), self.window()
+        meetings: Dict[Tuple[int, int], list] = {}
+
+        groups = []
+        for point in new:
+            if not groups or point[2] - groups[-1][0][2] > window:
+                groups.append([])
+            groups[-1].append(point)
+        for group in groups:
+            spatial_hash = SpatialHash(distance)
+            for candidate in self._candidates(group, distance, window):
+                spatial_hash.add(candidate)
+            for location_id, character_id, timestamp, location in group:
+                vector = (location.cos_lat * location.cos_lon, location.cos_lat * location.sin_lon, location.sin_lat)
+                for other, _ in spatial_hash.near(vector):
+                    other_id, other_character, other_timestamp, _ = other
+                    if other_character == character_id or abs(other_timestamp - timestamp) > window:
+                        continue
+                    if other_id in new_ids and other_id >= location_id:
+                        # Both are new, the pair is counted from the newest one
+                        continue
+                    first, last = sorted((timestamp, other_timestamp))
+                    for key in ((character_id, other_character), (other_character, character_id)):
+                        meeting = meetings.setdefault(key, [first, last, 0])
+                        meeting[0], meeting[1] = min(meeting[0], first), max(meeting[1], last)
+                        meeting[2] += 1
+        return meetings
+
+    def _candidates(self, group: list, distance: float, window: timedelta):
+        """
+        The locations within 'window' of the group and 'distance' meters of its points. The points
+        are gathered in cells about 'distance' meters wide, and the spatial index is probed with the
+        boxes of a circle around every cell holding some, so the probe stays local however spread
+        the points are
+        """
+        from .engines import filter_by_box_chunks
+
+        size = max(distance, 1.0) / METERS_PER_DEGREE
+        cells: Dict[Tuple[int, int], list] = {}
+        for point in group:
+            lat, lon = float(point[3].lat), float(point[3].lon)
+            cells.setdefault((math.floor(lat / size), math.floor(lon / size)), []).append((lat, lon))
+        boxes = []
+        for (row, column), coordinates in cells.items():
+            center = (min((row + 0.5) * size, 90.0), min((column + 0.5) * size, 180.0))
+            reach = max(haversine(*map(math.radians, center + coordinate)) for coordinate in coordinates)
+            boxes += bounding_boxes(*center, distance + reach)
+
+        start, end = group[0][2] - window, group[-1][2] + window
+        locations = Location.objects.db_manager(self.db).filter(timestamp__range=(start, end))
+        for chunk in filter_by_box_chunks(locations, boxes):
+            yield from points_of(chunk)
+
+    def add(self, meetings: Dict[Tuple[int, int], list]):
+        """
+        Adds the (character, contact) keyed [first seen, last seen, count] 'meetings' with a single
+        upsert per pair
+        """
+        if not meetings:
+            return
+
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {table} (character_id, contact_id, first_seen, last_seen, count) "
+                "VALUES (%s, %s, %s, %s, %s) ON CONFLICT (character_id, contact_id) DO UPDATE SET "
+                "first_seen = CASE WHEN excluded.first_seen < first_seen THEN excluded.first_seen ELSE first_seen END, "
+                "last_seen = CASE WHEN excluded.last_seen > last_seen THEN excluded.last_seen ELSE last_seen END, "
+                "count = count + excluded.count",
+                [
+                    (
+                        character_id,
+                        contact_id,
+                        connection.ops.adapt_datetimefield_value(first),
+                        connection.ops.adapt_datetimefield_value(last),
+                        count,
+                    )
+                    for (character_id, contact_id), (first, last, count) in meetings.items()
+                ],
+            )
+
+    def subtract(self, meetings: Dict[Tuple[int, int], list]):
+        """
+        Subtracts the counts of the (character, contact) keyed 'meetings' with a single update per
+        pair
+        """
+        if not meetings:
+            return
+
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with transaction.atomic(using=self.db), connection.cursor() as cursor:
+            cursor.executemany(
+                f"UPDATE {table} SET count = CASE WHEN count > %s THEN count - %s ELSE 0 END "
+                "WHERE character_id = %s AND contact_id = %s",
+                [
+                    (count, count, character_id, contact_id)
+                    for (character_id, contact_id), (_, _, count) in meetings.items()
+                ],
+            )
+            self.filter(character_id__in={character_id for character_id, _ in meetings}, count=0).delete()
+
+    def rebuild(self) -> int:
+        """
+        Recomputes every contact from the locations, in a single sweep over them. Returns the number
+        of pairs of characters in contact
+        """
+        with transaction.atomic(using=self.db):
+            self.all().delete()
+            pairs = find_colocations(
+                points_of(Location.objects.db_manager(self.db).all()), self.distance(), self.window()
+            )
+            meetings = {}
+            for pair in pairs:
+                for key in ((pair["character_a"], pair["character_b"]), (pair["character_b"], pair["character_a"])):
+                    meetings[key] = [pair["first_seen"], pair["last_seen"], pair["meetings"]]
+            self.add(meetings)
+        return len(pairs)
+
+
+class Contact(models.Model):
+    """
+    Contacts of a character with another one, stored for both of them so the contacts of a
+    character are read from a single index range
+    """
+
+    character = models.ForeignKey(Character, on_delete=models.CASCADE, related_name="contacts")
+    contact = models.ForeignKey(Character, on_delete=models.CASCADE, related_name="+")
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField()
+    count = models.PositiveIntegerField()
+
+    objects = ContactManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["character", "contact"], name="contact_pair_unique"),
+        ]
+
+
+class Geofence(models.Model):
+    """
+    Area whose entries and exits are recorded for every character: a circle of 'radius' meters
+    around ('lat', 'lon') or a polygon of [lat, lon] vertices
+    """
+
+    KINDS = ((CIRCLE, "Circle"), (POLYGON, "Polygon"))
+
+    name = models.CharField(max_length=100)
+    kind = models.CharField(max_length=7, choices=KINDS)
+    lat = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    lon = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    radius = models.FloatField(null=True, blank=True)
+    polygon = models.JSONField(null=True, blank=True)
+
+
+class GeofenceEventManager(models.Manager):
+    """
+    Records the geofences the characters enter and leave as their locations are created. A new
+    location is compared with the fences its character was in at its previous location, looked up
+    in the GeofenceIndex. Locations older than the last one evaluated for their character are not,
+    they would rewrite a past the events already describe
+    """
+
+    def record(self, locations: Iterable[Location]):
+        timestamp_field = Location._meta.get_field("timestamp")
+        new: Dict[int, list] = {}
+        for location in locations:
+            if location.id is not None:
+                key = (timestamp_field.to_python(location.timestamp), location.id)
+                new.setdefault(location.character_id, []).append((key, float(location.lat), float(location.lon)))
+        fences = geofence_index.fence_ids()
+        if not (new and fences):
+            return
+
+        states = GeofenceState.objects.db_manager(self.db).in_bulk(list(new))
+        events, changed = [], []
+        for character_id, points in new.items():
+            state = states.get(character_id)
+            if state is None:
+                state = GeofenceState(character_id=character_id, fences=[])
+            position = (state.timestamp, state.location_id) if state.timestamp is not None else None
+            inside = set(state.fences) & fences
+            for (timestamp, location_id), lat, lon in sorted(points, key=lambda point: point[0]):
+                if position is not None and (timestamp, location_id) <= position:
+                    continue
+                now = set(geofence_index.containing(lat, lon)) & fences
+                # The fences left come first when a character moves from one fence to another
+                for kind, fence_ids in ((GeofenceEvent.EXIT, inside - now), (GeofenceEvent.ENTER, now - inside)):
+                    events += [
+                        GeofenceEvent(
+                            fence_id=fence_id,
+                            character_id=character_id,
+                            location_id=location_id,
+                            kind=kind,
+                            timestamp=timestamp,
+                        )
+                        for fence_id in sorted(fence_ids)
+                    ]
+                inside, position = now, (timestamp, location_id)
+            if position is not None and (state.timestamp, state.location_id) != position:
+                state.timestamp, state.location_id, state.fences = position[0], position[1], sorted(inside)
+                changed.append(state)
+
+        self.bulk_create(events)
+        GeofenceState.objects.db_manager(self.db).bulk_create(
+            changed,
+            update_conflicts=True,
+            unique_fields=["character"],
+            update_fields=["timestamp", "location_id", "fences"],
+        )
+
+
+class GeofenceEvent(models.Model):
+    """
+    A character entering or leaving a geofence, at the timestamp of the location it was seen at
+    """
+
+    ENTER = "enter"
+    EXIT = "exit"
+    KINDS = ((ENTER, "Enter"), (EXIT, "Exit"))
+
+    fence = models.ForeignKey(Geofence, on_delete=models.CASCADE, related_name="events")
+    character = models.ForeignKey(Character, on_delete=models.CASCADE, related_name="geofence_events")
+    location = models.ForeignKey(Location, on_delete=models.SET_NULL, null=True, related_name="+")
+    kind = models.CharField(max_length=5, choices=KINDS)
+    timestamp = models.DateTimeField()
+
+    objects = GeofenceEventManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["fence", "timestamp"], name="geofenceevent_fence_ts_idx"),
+            models.Index(fields=["character", "timestamp"], name="geofenceevent_character_ts_idx"),
+            models.Index(fields=["timestamp"], name="geofenceevent_timestamp_idx"),
+        ]
+
+
+class GeofenceState(models.Model):
+    """
+    The geofences a character is in as of the last of its locations evaluated, identified by its
+    (timestamp, id). The location is not a foreign key, the state outlives it
+    """
+
+    character = models.OneToOneField(Character, on_delete=models.CASCADE, primary_key=True, related_name="+")
+    timestamp = models.DateTimeField()
+    location_id = models.BigIntegerField()
+    fences = models.JSONField(default=list)
@@ -0,0 +1,118 @@
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Tuple
+
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+from rest_framework.utils.urls import replace_query_param
+
+from .engines import Position
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Trajectories are streamed, so their pages can be much larger, or the whole history
+MAX_TRAJECTORY_PAGE_SIZE = 100_000
+
+
+def encode_cursor(position) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """
+    Decodes a cursor, raising a ValidationError when it was not made by 'encode_cursor'
+    """
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise serializers.ValidationError("The query parameter `cursor` is invalid")
+
+
+class DistanceCursorPagination:
+    """
+    Keyset pagination for results ordered by distance. The opaque 'cursor' holds the
+    (distance_key, id) of the last location of the previous page, so every page is a query for the
+    next 'page_size' locations after it, however deep the page
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+
+    def __init__(self, request):
+        self.request = request
+
+    def get_page_size(self) -> int:
+        page_size = self.request.query_params.get(self.page_size_query_param, str(DEFAULT_PAGE_SIZE))
+        if not (page_size.isdigit() and 0 < int(page_size) <= MAX_PAGE_SIZE):
+            raise serializers.ValidationError(
+                f"The query parameter `page_size` accepts any value between 1 and {MAX_PAGE_SIZE}"
+            )
+        return int(page_size)
+
+    def get_position(self) -> Optional[Position]:
+        cursor = self.request.query_params.get(self.cursor_query_param)
+        if cursor is None:
+            return None
+
+        try:
+            distance_key, location_id = decode_cursor(cursor)
+            return float(distance_key), int(location_id)
+        except (ValueError, TypeError):
+            raise serializers.ValidationError("The query parameter `cursor` is invalid")
+
+    def get_next_link(self, last_location) -> str:
+        cursor = encode_cursor([last_location.distance_key, last_location.id])
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def paginate(self, locations, page_size: int):
+        """
+        Splits the 'page_size' + 1 locations fetched into the page and the link to the next one
+        """
+        locations = list(locations)
+        page = locations[:page_size]
+        next_link = self.get_next_link(page[-1]) if len(locations) > page_size else None
+        return page, next_link
+
+
+class TimestampCursorPagination:
+    """
+    Keyset pagination for locations ordered by (timestamp, id). The opaque 'cursor' holds the
+    position of the last location of the previous page. Without a 'page_size' every location after
+    the cursor is in the page
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+
+    def __init__(self, request):
+        self.request = request
+
+    def get_page_size(self) -> Optional[int]:
+        page_size = self.request.query_params.get(self.page_size_query_param)
+        if page_size is None:
+            return None
+        if not (page_size.isdigit() and 0 < int(page_size) <= MAX_TRAJECTORY_PAGE_SIZE):
+            raise serializers.ValidationError(
+                f"The query parameter `page_size` accepts any value between 1 and {MAX_TRAJECTORY_PAGE_SIZE}"
+            )
+        return int(page_size)
+
+    def get_position(self) -> Optional[Tuple[datetime, int]]:
+        cursor = self.request.query_params.get(self.cursor_query_param)
+        if cursor is None:
+            return None
+
+        try:
+            timestamp, location_id = decode_cursor(cursor)
+            timestamp = parse_datetime(timestamp)
+            if timestamp is None:
+                raise ValueError
+            return timestamp, int(location_id)
+        except (ValueError, TypeError):
+            raise serializers.ValidationError("The query parameter `cursor` is invalid")
+
+    def get_next_link(self, position: Tuple[datetime, int]) -> str:
+        timestamp, location_id = position
+        cursor = encode_cursor([timestamp.isoformat(), location_id])
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
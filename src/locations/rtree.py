@@ -0,0 +1,102 @@
+from typing import List
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.signals import connection_created
+from django.db.models.expressions import RawSQL
+from django.dispatch import receiver
+
+from .geo import BoundingBox
+
+RTREE_TABLE = "locations_location_rtree"
+
+RTREE_TRIGGERS = {
+    "locations_location_rtree_insert": f"""
+        CREATE TRIGGER locations_location_rtree_insert AFTER INSERT ON locations_location
+        BEGIN
+            INSERT INTO {RTREE_TABLE} (id, min_lat, max_lat, min_lon, max_lon)
+            VALUES (NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon);
+        END
+    """,
+    "locations_location_rtree_update": f"""
+        CREATE TRIGGER locations_location_rtree_update AFTER UPDATE OF id, lat, lon ON locations_location
+        BEGIN
+            DELETE FROM {RTREE_TABLE} WHERE id = OLD.id;
+            INSERT INTO {RTREE_TABLE} (id, min_lat, max_lat, min_lon, max_lon)
+            VALUES (NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon);
+        END
+    """,
+    "locations_location_rtree_delete": f"""
+        CREATE TRIGGER locations_location_rtree_delete AFTER DELETE ON locations_location
+        BEGIN
+            DELETE FROM {RTREE_TABLE} WHERE id = OLD.id;
+        END
+    """,
+}
+
+_availability = {}
+
+
+@receiver(connection_created)
+def reset_availability(sender, connection, **kwargs):
+    _availability.pop(connection.alias, None)
+
+
+def repair_rtree(using: str = DEFAULT_DB_ALIAS):
+    """
+    Recreates the triggers maintaining the R*Tree index and refills it when any of them is missing.
+    SQLite drops the triggers of a table whenever a migration rebuilds it, so this runs after every
+    migrate
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite" or RTREE_TABLE not in connection.introspection.table_names():
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'locations_location'")
+        existing = {name for name, in cursor.fetchall()}
+        missing = [name for name in RTREE_TRIGGERS if name not in existing]
+        if not missing:
+            return
+
+        cursor.execute(f"DELETE FROM {RTREE_TABLE}")
+        cursor.execute(
+            f"INSERT INTO {RTREE_TABLE} (id, min_lat, max_lat, min_lon, max_lon) "
+            "SELECT id, lat, lat, lon, lon FROM locations_location"
+        )
+        for name in missing:
+            cursor.execute(RTREE_TRIGGERS[name])
+
+
+def rtree_available(using: str = DEFAULT_DB_ALIAS) -> bool:
+    """
+    Whether the R*Tree index over the locations exists on the 'using' database. It is only
+    created by the migrations on SQLite builds with the R*Tree module compiled in
+    """
+    if not getattr(settings, "LOCATIONS_RTREE_INDEX", True):
+        return False
+
+    if using not in _availability:
+        connection = connections[using]
+        _availability[using] = (
+            connection.vendor == "sqlite" and RTREE_TABLE in connection.introspection.table_names()
+        )
+    return _availability[using]
+
+
+def rtree_candidates(boxes: List[BoundingBox]) -> RawSQL:
+    """
+    Subquery returning the ids of the locations inside any of the 'boxes'. Every box is a SELECT
+    of its own joined by UNION ALL, SQLite stops searching the index with an OR of many boxes and
+    scans it instead
+    """
+    condition = "min_lat <= %s AND max_lat >= %s AND min_lon <= %s AND max_lon >= %s"
+    selects, params = [], []
+    for min_lat, max_lat, min_lon, max_lon in boxes:
+        selects.append(f"SELECT id FROM {RTREE_TABLE} WHERE {condition}")
+        params += [max_lat, min_lat, max_lon, min_lon]
+    return RawSQL(" UNION ALL ".join(selects), params)
+
+
+def repair_rtree_after_migrate(sender, using, **kwargs):
+    repair_rtree(using)
@@ -1,9 +1,141 @@
+from datetime import datetime
+from typing import Tuple
+
 from rest_framework import serializers
 
-from locations.models import Location
+from locations.geo import DEFAULT_FORMULA, DISTANCE_FORMULAS, MAX_DISTANCE
+from locations.geofences import CIRCLE, MAX_POLYGON_VERTICES, POLYGON
+from locations.models import Contact, Geofence, GeofenceEvent, Location
+
+
+def parse_date_range(value: str) -> Tuple[datetime, datetime]:
+    field = serializers.DateTimeField()
+    try:
+        start_datetime, end_datetime = value.split(",")
+    except ValueError:
+        raise serializers.ValidationError("`date_range` accepts a `start,end` pair of datetimes")
+    return field.to_internal_value(start_datetime), field.to_internal_value(end_datetime)
 
 
 class LocationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Location
         fields = ("id", "character", "timestamp", "lat", "lon")
+
+
+class NearLocationSerializer(LocationSerializer):
+    """
+    Location found around a point, with the distance in meters and the initial bearing in degrees
+    from that point unless the 'with_distance' and 'with_bearing' context flags are off
+    """
+
+    distance = serializers.FloatField(read_only=True)
+    bearing = serializers.FloatField(read_only=True)
+
+    class Meta(LocationSerializer.Meta):
+        fields = LocationSerializer.Meta.fields + ("distance", "bearing")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field in ("distance", "bearing"):
+            if not self.context.get(f"with_{field}", True):
+                self.fields.pop(field)
+
+
+class LocationPageSerializer(serializers.Serializer):
+    """
+    A page of locations and the link to the next one, null on the last page
+    """
+
+    next = serializers.URLField(allow_null=True)
+    results = NearLocationSerializer(many=True)
+
+
+class NearQuerySerializer(serializers.Serializer):
+    """
+    One query of a batch near request, with the same parameters as the near endpoint
+    """
+
+    coordinates = serializers.CharField()
+    distance = serializers.FloatField(min_value=0)
+    character = serializers.IntegerField(required=False)
+    date_range = serializers.CharField(required=False)
+    ascending = serializers.BooleanField(default=True)
+    formula = serializers.ChoiceField(choices=list(DISTANCE_FORMULAS), default=DEFAULT_FORMULA)
+
+    def validate_coordinates(self, value):
+        try:
+            lat, lon = (float(coordinate) for coordinate in value.split(","))
+        except ValueError:
+            raise serializers.ValidationError("`coordinates` accepts a `latitude,longitude` pair")
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise serializers.ValidationError("`coordinates` must be a valid latitude and longitude")
+        return lat, lon
+
+    def validate_date_range(self, value):
+        return parse_date_range(value)
+
+
+class ContactSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Contact
+        fields = ("contact", "first_seen", "last_seen", "count")
+
+
+class GeofenceSerializer(serializers.ModelSerializer):
+    """
+    A circle needs its center 'lat', 'lon' and its 'radius' in meters, a polygon its [lat, lon]
+    vertices, which must not cross the antimeridian
+    """
+
+    class Meta:
+        model = Geofence
+        fields = ("id", "name", "kind", "lat", "lon", "radius", "polygon")
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        shape = {field: attrs.get(field, getattr(self.instance, field, None)) for field in self.Meta.fields[2:]}
+        if shape["kind"] == CIRCLE:
+            if None in (shape["lat"], shape["lon"], shape["radius"]):
+                raise serializers.ValidationError("A circle needs its `lat`, `lon` and `radius`")
+            if not (-90 <= shape["lat"] <= 90 and -180 <= shape["lon"] <= 180):
+                raise serializers.ValidationError("`lat` and `lon` must be a valid latitude and longitude")
+            if not 0 < shape["radius"] <= MAX_DISTANCE:
+                raise serializers.ValidationError(f"`radius` accepts meters above 0 and up to {MAX_DISTANCE:.0f}")
+            attrs.update(polygon=None)
+        elif shape["kind"] == POLYGON:
+            attrs.update(polygon=self.validate_vertices(shape["polygon"]), lat=None, lon=None, radius=None)
+        return attrs
+
+    @staticmethod
+    def validate_vertices(polygon):
+        error = serializers.ValidationError(
+            f"A polygon needs `polygon`, a list of 3 to {MAX_POLYGON_VERTICES} `[latitude, longitude]` vertices"
+        )
+        if not isinstance(polygon, list) or not 3 <= len(polygon) <= MAX_POLYGON_VERTICES:
+            raise error
+        vertices = []
+        for vertex in polygon:
+            try:
+                lat, lon = (float(coordinate) for coordinate in vertex)
+            except (TypeError, ValueError):
+                raise error
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                raise serializers.ValidationError("The vertices of `polygon` must be valid latitudes and longitudes")
+            vertices.append([lat, lon])
+        return vertices
+
+
+class GeofenceEventSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = GeofenceEvent
+        fields = ("id", "fence", "character", "location", "kind", "timestamp")
+
+
+class GeofenceEventPageSerializer(serializers.Serializer):
+    """
+    A page of geofence events and the link to the next one, null on the last page
+    """
+
+    next = serializers.URLField(allow_null=True)
+    results = GeofenceEventSerializer(many=True)
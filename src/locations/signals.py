@@ -0,0 +1,61 @@
+from django.core.signals import request_started
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .clusters import cluster_index
+from .geofences import geofence_index
+from .memory_index import location_index
+from .models import Geofence, LastLocation, Location, locations_moved
+from .write_behind import write_behind_buffer
+
+
+@receiver(post_save, sender=Location)
+def index_saved_location(sender, instance, using, **kwargs):
+    location_index.upsert_on_commit([instance], using=using)
+    cluster_index.upsert_on_commit([instance], using=using)
+
+
+@receiver(post_delete, sender=Location)
+def unindex_deleted_location(sender, instance, using, **kwargs):
+    location_index.remove_on_commit(instance.id, using=using)
+    cluster_index.remove_on_commit(instance.id, using=using)
+
+
+@receiver(post_save, sender=Location)
+def update_last_location(sender, instance, created, using, **kwargs):
+    last_locations = LastLocation.objects.db_manager(using)
+    if not created:
+        # The location may have been the latest one of a character it no longer belongs to, or
+        # moved back in time
+        stale = (
+            last_locations.filter(location_id=instance.id)
+            .exclude(character_id=instance.character_id, timestamp=instance.timestamp)
+            .values_list("character_id", flat=True)
+        )
+        last_locations.refresh(stale)
+    last_locations.advance([instance])
+
+
+@receiver(post_delete, sender=Location)
+def repair_last_location(sender, instance, using, **kwargs):
+    # Deleting the latest location of a character cascades to its record, which is looked up again
+    if not LastLocation.objects.using(using).filter(character_id=instance.character_id).exists():
+        LastLocation.objects.db_manager(using).refresh([instance.character_id])
+
+
+@receiver(post_delete, sender=Location)
+def uncount_deleted_location(sender, instance, using, **kwargs):
+    locations_moved(using, removed=[instance.rollup_source()])
+
+
+@receiver(request_started)
+def start_write_behind_buffer(**kwargs):
+    # Started with the first request, so the locations a crash left in its log are written early
+    if write_behind_buffer.enabled():
+        write_behind_buffer.start()
+
+
+@receiver(post_save, sender=Geofence)
+@receiver(post_delete, sender=Geofence)
+def reindex_geofences(sender, using, **kwargs):
+    geofence_index.clear_on_commit(using=using)
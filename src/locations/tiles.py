@@ -0,0 +1,208 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Min, Value
+from django.db.models.functions import Floor, Ln
+
+from .clusters import inverse_mercator, mercator
+
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+MAX_TILE_ZOOM = 22
+# Resolution of the tile, locations falling in the same of its pixels are merged in one feature
+TILE_EXTENT = 4096
+LAYER_NAME = "locations"
+
+# (z, x, y) of a web mercator tile
+Tile = Tuple[int, int, int]
+# (x, y, number of locations, id of the location when there is a single one) of a tile feature
+Feature = Tuple[int, int, int, Optional[int]]
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """
+    The (south, west, north, east) bounds of a tile in degrees
+    """
+    tiles = 2 ** z
+    north, west = inverse_mercator(x / tiles, y / tiles)
+    south, east = inverse_mercator((x + 1) / tiles, (y + 1) / tiles)
+    return south, west, north, east
+
+
+def tile_of(lat: float, lon: float, z: int) -> Tile:
+    x, y = mercator(lat, lon)
+    tiles = 2 ** z
+    return z, min(math.floor(x * tiles), tiles - 1), min(math.floor(y * tiles), tiles - 1)
+
+
+def tile_features(queryset, z: int, x: int, y: int) -> List[Feature]:
+    """
+    The locations of the queryset within a tile, merged per pixel of the tile in the database. The
+    web mercator y is computed from the stored sine of the latitude
+    """
+    from .engines import as_float, filter_by_spatial_index
+
+    south, west, north, east = tile_bounds(z, x, y)
+    scale = 2 ** z * TILE_EXTENT
+    pixels = (
+        filter_by_spatial_index(queryset, [(south, north, west, east)])
+        .annotate(
+            px=Floor((as_float("lon") + 180) / 360 * scale) - x * TILE_EXTENT,
+            py=Floor(
+                (Value(0.5) - Ln((Value(1.0) + F("sin_lat")) / (Value(1.0) - F("sin_lat"))) / (4 * math.pi)) * scale
+            )
+            - y * TILE_EXTENT,
+        )
+        .values("px", "py")
+        .annotate(count=Count("id"), first=Min("id"))
+        .order_by("py", "px")
+    )
+    return [
+        (int(pixel["px"]), int(pixel["py"]), pixel["count"], pixel["first"] if pixel["count"] == 1 else None)
+        for pixel in pixels
+        # The bounds are inclusive, the east and south edges belong to the next tiles
+        if 0 <= pixel["px"] < TILE_EXTENT and 0 <= pixel["py"] < TILE_EXTENT
+    ]
+
+
+def _varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _zigzag(value: int) -> int:
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def _key(number: int, wire_type: int) -> bytes:
+    return _varint(number << 3 | wire_type)
+
+
+def _integer(number: int, value: int) -> bytes:
+    return _key(number, 0) + _varint(value)
+
+
+def _message(number: int, payload: bytes) -> bytes:
+    return _key(number, 2) + _varint(len(payload)) + payload
+
+
+def _packed(number: int, values: Iterable[int]) -> bytes:
+    return _message(number, b"".join(_varint(value) for value in values))
+
+
+def encode_tile(features: List[Feature]) -> bytes:
+    """
+    Encodes the features as a Mapbox Vector Tile of a single layer of points, each with its
+    number of locations as 'count' property and the id of its location as feature id when single
+    """
+    values: Dict[int, int] = {}
+    encoded = []
+    for x, y, count, location_id in features:
+        feature = _integer(1, location_id) if location_id is not None else b""
+        feature += _packed(2, (0, values.setdefault(count, len(values))))
+        # A POINT, drawn with a single MoveTo command relative to the tile origin
+        feature += _integer(3, 1) + _packed(4, (1 | 1 << 3, _zigzag(x), _zigzag(y)))
+        encoded.append(_message(2, feature))
+
+    layer = _integer(15, 2) + _message(1, LAYER_NAME.encode())
+    layer += b"".join(encoded)
+    layer += _message(3, b"count")
+    layer += b"".join(_message(4, _integer(5, count)) for count in values)
+    layer += _integer(5, TILE_EXTENT)
+    return _message(3, layer)
+
+
+class TileCache:
+    """
+    In-process LRU cache of LOCATIONS_TILE_CACHE_SIZE encoded tiles. The writes of this process
+    evict the tiles containing the old and new coordinates of the locations once committed, at every
+    zoom. A tile is only cached if none of its evictions happened while it was read, which the
+    generation it was read at tells. Tiles are also dropped after LOCATIONS_TILE_CACHE_MAX_AGE seconds to pick up the writes
+    of other processes
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[Tile, Hashable], Tuple[bytes, float]]" = OrderedDict()
+        self._filters: Dict[Tile, Set[Hashable]] = {}
+        self._versions: Dict[Tile, int] = {}
+        self._generation = 0
+
+    @staticmethod
+    def size() -> int:
+        return getattr(settings, "LOCATIONS_TILE_CACHE_SIZE", 1000)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._filters.clear()
+            self._versions.clear()
+            self._generation += 1
+
+    def get(self, tile: Tile, filters: Hashable) -> Tuple[Optional[bytes], Optional[int]]:
+        """
+        The cached tile, or None and the version to 'put' the tile with once encoded
+        """
+        max_age = getattr(settings, "LOCATIONS_TILE_CACHE_MAX_AGE", 300)
+        with self._lock:
+            entry = self._entries.get((tile, filters))
+            if entry is not None and time.monotonic() - entry[1] <= max_age:
+                self._entries.move_to_end((tile, filters))
+                return entry[0], None
+            return None, self._versions.setdefault(tile, self._generation)
+
+    def put(self, tile: Tile, filters: Hashable, version: int, content: bytes):
+        with self._lock:
+            if self._versions.get(tile) != version:
+                # Evicted since it was read
+                return
+            self._entries[(tile, filters)] = (content, time.monotonic())
+            self._entries.move_to_end((tile, filters))
+            self._filters.setdefault(tile, set()).add(filters)
+            while len(self._entries) > self.size():
+                (evicted, evicted_filters), _ = self._entries.popitem(last=False)
+                self._forget(evicted, evicted_filters)
+
+    def _forget(self, tile: Tile, filters: Hashable):
+        cached = self._filters.get(tile)
+        if cached is not None:
+            cached.discard(filters)
+            if not cached:
+                del self._filters[tile]
+                self._versions.pop(tile, None)
+
+    def invalidate(self, points: Iterable[Tuple]):
+        """
+        Evicts the tiles of every zoom containing the (lat, lon, ...) 'points'
+        """
+        with self._lock:
+            if not self._versions:
+                return
+            for point in points:
+                lat, lon = float(point[0]), float(point[1])
+                for z in range(MAX_TILE_ZOOM + 1):
+                    tile = tile_of(lat, lon, z)
+                    if self._versions.pop(tile, None) is None:
+                        continue
+                    for filters in self._filters.pop(tile, ()):
+                        self._entries.pop((tile, filters), None)
+            # Tiles read from now on get a newer version than the ones being read
+            self._generation += 1
+
+    def invalidate_on_commit(self, points: Iterable[Tuple], using: Optional[str] = None):
+        if self.size() <= 0:
+            return
+
+        points = list(points)
+        transaction.on_commit(lambda: self.invalidate(points), using=using)
+
+
+tile_cache = TileCache()
@@ -1,8 +1,16 @@
+from django.urls import re_path
 from rest_framework import routers
 
-from .views import LocationViewSet
+from .views import GeofenceViewSet, LocationViewSet
 
 router = routers.SimpleRouter()
 router.register(r"locations", LocationViewSet, basename='location')
+router.register(r"geofences", GeofenceViewSet, basename='geofence')
 
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    re_path(
+        r"^locations/tiles/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)\.mvt$",
+        LocationViewSet.as_view({"get": "tile"}),
+        name="location-tile",
+    ),
+]
@@ -1,22 +1,97 @@
-from decimal import Decimal
+import math
+from array import array
+from datetime import timedelta
+from operator import itemgetter
 
 from django.core.exceptions import ValidationError
-from django.db.models import F, FloatField
-from django.db.models.functions import ACos, Cos, Least, Radians, Round, Sin
+from django.db.models import Q
+from django.http import HttpResponse
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import serializers, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
 
-from .models import Location
-from .serializers import LocationSerializer
+from .clusters import MAX_ZOOM, cluster_index
+from .colocation import MAX_COLOCATION_DISTANCE, MAX_COLOCATION_WINDOW, find_colocations, points_of
+from .engines import Position, filter_by_box_chunks, filter_by_bounding_box, get_distance_engine
+from .geo import DEFAULT_FORMULA, DISTANCE_FORMULAS, bbox_boxes, bounding_boxes, max_distance, search_distance
+from .heatmap import MAX_HEATMAP_CELLS, Grid, cell_step, cells_of, density_counts, grid_counts
+from .ingest import MAX_INGEST_ROWS, ingest, validate_rows
+from .kdtree import KDTree
+from .models import Geofence, GeofenceEvent, Location
+from .pagination import DistanceCursorPagination, TimestampCursorPagination
+from .parsers import CSVParser, NDJSONParser
+from .serializers import (
+    GeofenceEventPageSerializer,
+    GeofenceEventSerializer,
+    GeofenceSerializer,
+    LocationPageSerializer,
+    LocationSerializer,
+    NearLocationSerializer,
+    NearQuerySerializer,
+    parse_date_range,
+)
+from .tiles import MAX_TILE_ZOOM, MVT_MEDIA_TYPE, encode_tile, tile_cache, tile_features
+from .write_behind import write_behind_buffer
+
+MAX_NEAREST = 1000
+# The nearest search starts with this radius in meters and grows it until k locations are found
+NEAREST_INITIAL_RADIUS = 1_000
+NEAREST_RADIUS_GROWTH = 4
+
+MAX_BATCH_QUERIES = 1000
+
+FORMULA_PARAMETER = openapi.Parameter(
+    "formula",
+    openapi.IN_QUERY,
+    type=openapi.TYPE_STRING,
+    enum=list(DISTANCE_FORMULAS),
+    default=DEFAULT_FORMULA,
+    description=(
+        "How distances are computed, errors are relative to the WGS84 ellipsoid. `equirectangular`: "
+        "cheapest, within 0.6% up to a few tens of kilometers away from the poles. `cosines`: within 0.6% "
+        "but imprecise below a few meters. `haversine`: within 0.6% at any distance. `vincenty`: within a "
+        "millimeter, the most expensive"
+    ),
+)
+WITH_DISTANCE_PARAMETER = openapi.Parameter(
+    "with_distance",
+    openapi.IN_QUERY,
+    type=openapi.TYPE_INTEGER,
+    description="`1` to return the distance in meters of every location",
+)
+WITH_BEARING_PARAMETER = openapi.Parameter(
+    "with_bearing",
+    openapi.IN_QUERY,
+    type=openapi.TYPE_INTEGER,
+    description="`1` to return the initial bearing in degrees clockwise from north to every location",
+)
 
 
 class LocationViewSet(viewsets.ModelViewSet):
     queryset = Location.objects.all()
     serializer_class = LocationSerializer
 
+    def create(self, request, *args, **kwargs):
+        """
+        Creates a location. With LOCATIONS_WRITE_BEHIND it is queued and written shortly after, the
+        response is then 202, or 429 when too many locations are waiting to be written
+        """
+        if not write_behind_buffer.enabled():
+            return super().create(request, *args, **kwargs)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if not write_behind_buffer.put(Location(**serializer.validated_data)):
+            return Response(
+                {"detail": "Too many locations are waiting to be written, retry later"},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={"Retry-After": "1"},
+            )
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
     @staticmethod
     def validate_distance_params(coordinates: str, distance: str):
         if not (coordinates and "," in coordinates and distance.isdigit() and float(distance) >= 0):
@@ -25,6 +100,78 @@ class LocationViewSet(viewsets.ModelViewSet):
                 "a `latitude,longitude` pair. `distance` accepts any value >= 0"
             )
 
+    @staticmethod
+    def validate_nearest_params(coordinates: str, k: str):
+        if not (coordinates and "," in coordinates and k.isdigit() and 0 < int(k) <= MAX_NEAREST):
+            raise serializers.ValidationError(
+                "The query parameters `coordinates` and `k` are obligatory. `coordinates` accepts "
+                f"a `latitude,longitude` pair. `k` accepts any value between 1 and {MAX_NEAREST}"
+            )
+
+    @staticmethod
+    def validate_bbox(bbox: str):
+        """
+        Parses the (south, west, north, east) 'bbox', the whole world when missing
+        """
+        error = serializers.ValidationError(
+            "The query parameter `bbox` accepts `south,west,north,east` latitudes and longitudes, with "
+            "west > east across the antimeridian"
+        )
+        try:
+            south, west, north, east = (float(value) for value in (bbox or "-90,-180,90,180").split(","))
+        except ValueError:
+            raise error
+        if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+            raise error
+        return south, west, north, east
+
+    @classmethod
+    def validate_heatmap_params(cls, bbox: str, cell: str) -> Grid:
+        """
+        Parses the 'bbox' and the 'cell' size into the grid of cells overlapping the bbox
+        """
+        bbox = cls.validate_bbox(bbox)
+        error = serializers.ValidationError(
+            "The query parameter `cell` is obligatory and accepts any size in degrees > 0, to 6 decimal places"
+        )
+        try:
+            step = cell_step(float(cell))
+        except (TypeError, ValueError, ArithmeticError):
+            raise error
+        if step is None or step > 360_000_000:
+            raise error
+        grid = Grid.over(*bbox, step)
+        if grid.cells() > MAX_HEATMAP_CELLS:
+            raise serializers.ValidationError(
+                f"The query parameter `cell` is too small for the `bbox`, at most {MAX_HEATMAP_CELLS} cells are returned"
+            )
+        return grid
+
+    @staticmethod
+    def validate_colocation_params(distance: str, time_window: str):
+        """
+        Parses the 'distance' in meters and the 'time_window' in minutes
+        """
+        max_minutes = int(MAX_COLOCATION_WINDOW.total_seconds() // 60)
+        error = serializers.ValidationError(
+            f"The query parameters `distance` and `time_window` are obligatory. `distance` accepts meters from 0 "
+            f"to {MAX_COLOCATION_DISTANCE}, `time_window` accepts minutes from 0 to {max_minutes}"
+        )
+        try:
+            distance, time_window = float(distance), int(time_window)
+        except (TypeError, ValueError):
+            raise error
+        if not (0 <= distance <= MAX_COLOCATION_DISTANCE and 0 <= time_window <= max_minutes):
+            raise error
+        return distance, timedelta(minutes=time_window)
+
+    @staticmethod
+    def validate_formula(formula: str):
+        if formula not in DISTANCE_FORMULAS:
+            raise serializers.ValidationError(
+                f"The query parameter `formula` only accepts {', '.join(f'`{name}`' for name in DISTANCE_FORMULAS)}"
+            )
+
     def filter_by_character(self, queryset):
         """
         Filter by character assigned to specific location entry
@@ -40,56 +187,123 @@ class LocationViewSet(viewsets.ModelViewSet):
         """
         date_range = self.request.query_params.get("date_range")
         if date_range is not None:
-            start_datetime, end_datetime = date_range.split(",")
+            start_datetime, end_datetime = parse_date_range(date_range)
             queryset = queryset.filter(timestamp__range=[start_datetime, end_datetime])
         return queryset
 
-    def filter_by_distance(self, queryset, coordinates, distance):
+    def filter_by_distance(
+        self, queryset, coordinates, distance, ascending: bool = True, limit: int = None, after: Position = None
+    ):
         """
-        Filtering by locations that are within the distance specified and ordering asc or desc
+        Filtering by locations that are within the distance specified and ordering asc or desc, with
+        the distance engine selected in the settings and the distance 'formula' requested
         """
         lat, lon = coordinates.split(",")
-        lat = Decimal(lat)
-        lon = Decimal(lon)
-        ascending = self.request.query_params.get("ascending", "1")
-
-        order_by = "distance" if ascending == "1" else f"-distance"
-
-        # Calculating distance using the spherical law of cosines
-        queryset = (
-            queryset.annotate(
-                distance=Round(
-                    ACos(
-                        Least(
-                            Cos(Radians(lat))
-                            * Cos(Radians(F("lat")))
-                            * Cos(Radians(F("lon")) - Radians(lon))
-                            + Sin(Radians(lat)) * Sin(Radians(F("lat"))),
-                            1.0,
-                        )
-                    )
-                    * 6_371_000,
-                    precision=6,
-                    output_field=FloatField(),
-                )
-            )
-            .filter(distance__lte=distance)
-            .order_by(order_by)
+        formula = self.request.query_params.get("formula", DEFAULT_FORMULA)
+        bearing = self.get_near_serializer_context()["with_bearing"]
+        return get_distance_engine().near(
+            queryset, float(lat), float(lon), float(distance), ascending, limit, formula, after, bearing
         )
 
-        return queryset
+    def get_near_serializer_context(self):
+        """
+        Whether the distance and the bearing, already computed by the distance engine, are returned
+        """
+        return {
+            "with_distance": self.request.query_params.get("with_distance", "0") == "1",
+            "with_bearing": self.request.query_params.get("with_bearing", "0") == "1",
+        }
 
-    def get_filtered_queryset(self, coordinates: str, distance: float):
+    def get_filtered_queryset(
+        self, coordinates: str, distance: float, ascending: bool = True, limit: int = None, after: Position = None
+    ):
         queryset = self.queryset.all()
 
         queryset = self.filter_by_character(queryset)
         queryset = self.filter_by_date_range(queryset)
-        queryset = self.filter_by_distance(queryset, coordinates, distance)
+        queryset = self.filter_by_distance(queryset, coordinates, distance, ascending, limit, after)
 
         return queryset
 
+    def get_nearest_locations(self, coordinates: str, k: int):
+        """
+        Gets the 'k' closest locations by searching growing radii around the 'coordinates', so the
+        cost depends on how far the k-th location is and not on the size of the table
+        """
+        # Equirectangular distances go beyond half the circumference
+        farthest = max_distance(self.request.query_params.get("formula", DEFAULT_FORMULA))
+        radius = NEAREST_INITIAL_RADIUS
+        while True:
+            locations = list(self.get_filtered_queryset(coordinates, radius, limit=k))
+
+            if len(locations) == k or radius >= farthest:
+                return locations
+            radius = min(radius * NEAREST_RADIUS_GROWTH, farthest)
+
+    def get_batch_candidates(self, queries):
+        """
+        Fetches in one pass the candidates of every query of a batch: the rows inside the union of
+        their bounding boxes, narrowed by the characters and dates all of them are restricted to
+        """
+        queryset = self.queryset.all()
+        if all("character" in query for query in queries):
+            queryset = queryset.filter(character__in={query["character"] for query in queries})
+        if all("date_range" in query for query in queries):
+            date_range = (
+                min(query["date_range"][0] for query in queries),
+                max(query["date_range"][1] for query in queries),
+            )
+            queryset = queryset.filter(timestamp__range=date_range)
+
+        boxes = [
+            box
+            for query in queries
+            for box in bounding_boxes(
+                *query["coordinates"], search_distance(query["distance"], query["formula"], query["coordinates"][0])
+            )
+        ]
+        candidates = {}
+        for chunk in filter_by_box_chunks(queryset, boxes, filter_by_bounding_box):
+            for row in chunk.values_list("id", "character_id", "timestamp", "lat", "lon"):
+                candidates[row[0]] = row
+        return candidates
+
+    def get_batch_near_locations(self, queries):
+        """
+        Answers every query of a batch from a single candidate pass: the candidates are indexed in a
+        KD-tree that each query searches, then the results of all queries are hydrated together
+        """
+        candidates = self.get_batch_candidates(queries)
+        rows = list(candidates.values())
+        tree = KDTree(
+            array("q", (row[0] for row in rows)),
+            array("d", (math.radians(row[3]) for row in rows)),
+            array("d", (math.radians(row[4]) for row in rows)),
+        )
+
+        results = []
+        for query in queries:
+            lat, lon = query["coordinates"]
+            found = []
+            within = tree.radius(math.radians(lat), math.radians(lon), query["distance"], query["formula"])
+            for location_id, location_distance in within:
+                _, character_id, timestamp, _, _ = candidates[location_id]
+                if "character" in query and character_id != query["character"]:
+                    continue
+                if "date_range" in query and not query["date_range"][0] <= timestamp <= query["date_range"][1]:
+                    continue
+                found.append((location_id, location_distance))
+            found.sort(key=itemgetter(1), reverse=not query["ascending"])
+            results.append([location_id for location_id, _ in found])
+
+        locations = self.queryset.in_bulk({location_id for ids in results for location_id in ids})
+        serialized = {
+            location_id: self.serializer_class(location).data for location_id, location in locations.items()
+        }
+        return [[serialized[location_id] for location_id in ids] for ids in results]
+
     @swagger_auto_schema(
-        responses={200: LocationSerializer(many=True)},
+        responses={200: LocationPageSerializer},
         manual_parameters=[
             openapi.Parameter(
                 "coordinates", openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True
@@ -100,6 +314,11 @@ class LocationViewSet(viewsets.ModelViewSet):
             openapi.Parameter("ascending", openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
             openapi.Parameter("character", openapi.IN_QUERY, type=openapi.TYPE_STRING),
             openapi.Parameter("date_range", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            FORMULA_PARAMETER,
+            WITH_DISTANCE_PARAMETER,
+            WITH_BEARING_PARAMETER,
+            openapi.Parameter("page_size", openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+            openapi.Parameter("cursor", openapi.IN_QUERY, type=openapi.TYPE_STRING),
         ],
     )
     @action(detail=False, methods=["get"])
@@ -108,15 +327,300 @@ class LocationViewSet(viewsets.ModelViewSet):
         Gets all locations that are at a radius of 'distance' meters from the 'coordinates' specified,
         filters optionally by 'character' id, 'dater_ange' of timestamps and orders 'ascending' or descending based on
         the distance from the 'coordinates' specified and the coordinates in the database
-        Distances are calculates using the spherical law of cosines
+        Distances are calculated with the spherical law of cosines unless another 'formula' is requested
+        Results are paginated by 'page_size', the 'next' link of each page holds the cursor of the next one
+        The distance and the bearing from the 'coordinates' are returned 'with_distance' and 'with_bearing'
         """
         coordinates = request.query_params.get("coordinates")
         distance = request.query_params.get("distance", "")
+        ascending = request.query_params.get("ascending", "1") == "1"
+        paginator = DistanceCursorPagination(request)
 
         try:
             self.validate_distance_params(coordinates, distance)
-            locations = self.get_filtered_queryset(coordinates, distance)
-            serializer = self.serializer_class(locations, many=True)
+            self.validate_formula(request.query_params.get("formula", DEFAULT_FORMULA))
+            page_size = paginator.get_page_size()
+            locations = self.get_filtered_queryset(
+                coordinates, distance, ascending, limit=page_size + 1, after=paginator.get_position()
+            )
+            page, next_link = paginator.paginate(locations, page_size)
+            serializer = NearLocationSerializer(page, many=True, context=self.get_near_serializer_context())
+            return Response({"next": next_link, "results": serializer.data})
+        except serializers.ValidationError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    @swagger_auto_schema(
+        responses={200: NearLocationSerializer(many=True)},
+        manual_parameters=[
+            openapi.Parameter(
+                "coordinates", openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True
+            ),
+            openapi.Parameter("k", openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=True),
+            openapi.Parameter("character", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter("date_range", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            FORMULA_PARAMETER,
+            WITH_DISTANCE_PARAMETER,
+            WITH_BEARING_PARAMETER,
+        ],
+    )
+    @action(detail=False, methods=["get"])
+    def nearest(self, request):
+        """
+        Gets the 'k' locations closest to the 'coordinates' specified, ordered by distance,
+        filters optionally by 'character' id and 'date_range' of timestamps, returns optionally the
+        distance and the bearing from the 'coordinates' 'with_distance' and 'with_bearing'
+        """
+        coordinates = request.query_params.get("coordinates")
+        k = request.query_params.get("k", "")
+
+        try:
+            self.validate_nearest_params(coordinates, k)
+            self.validate_formula(request.query_params.get("formula", DEFAULT_FORMULA))
+            locations = self.get_nearest_locations(coordinates, int(k))
+            serializer = NearLocationSerializer(locations, many=True, context=self.get_near_serializer_context())
             return Response(serializer.data)
         except serializers.ValidationError as e:
             return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    @swagger_auto_schema(
+        request_body=NearQuerySerializer(many=True),
+        responses={200: "A list with the locations found for each query, in the order of the queries"},
+    )
+    @action(detail=False, methods=["post"], url_path="near/batch")
+    def near_batch(self, request):
+        """
+        Runs many near queries at once. The body is a list of queries with the parameters of the near
+        endpoint: 'coordinates', 'distance' and optionally 'character', 'date_range' and 'ascending'.
+        All of them are answered from a single pass over the candidate locations
+        """
+        serializer = NearQuerySerializer(data=request.data, many=True, max_length=MAX_BATCH_QUERIES)
+        if not serializer.is_valid():
+            return Response({"detail": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        queries = serializer.validated_data
+        results = self.get_batch_near_locations(queries) if queries else []
+        return Response(
+            [
+                {"coordinates": ",".join(map(str, query["coordinates"])), "locations": locations}
+                for query, locations in zip(queries, results)
+            ]
+        )
+
+    @swagger_auto_schema(
+        request_body=LocationSerializer(many=True),
+        responses={
+            201: "The number of locations `created` and the `errors` of the rows rejected, with their `index`",
+            400: "Error: Bad Request",
+        },
+    )
+    @action(detail=False, methods=["post"], parser_classes=[JSONParser, NDJSONParser, CSVParser])
+    def bulk(self, request):
+        """
+        Creates many locations at once from a JSON array, NDJSON or CSV with a header row, each row
+        with the fields of a location. Invalid rows are reported without rejecting the valid ones
+        """
+        rows = request.data
+        if not isinstance(rows, list):
+            return Response({"detail": "Expected a list of locations"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > MAX_INGEST_ROWS:
+            return Response(
+                {"detail": f"At most {MAX_INGEST_ROWS} locations can be created at once"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        locations, errors = validate_rows(rows)
+        created = ingest(locations)
+        return Response(
+            {"created": len(created), "errors": errors},
+            status=status.HTTP_201_CREATED if created or not errors else status.HTTP_400_BAD_REQUEST,
+        )
+
+    @swagger_auto_schema(
+        responses={200: "The `cell` size and the `cells` with their south west corner `lat` and `lon` and `count`"},
+        manual_parameters=[
+            openapi.Parameter("cell", openapi.IN_QUERY, type=openapi.TYPE_NUMBER, required=True),
+            openapi.Parameter("bbox", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter("character", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter("date_range", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter("per_character", openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+        ],
+    )
+    @action(detail=False, methods=["get"])
+    def heatmap(self, request):
+        """
+        Counts the locations in each cell of a grid of 'cell' degrees overlapping the 'bbox', given as
+        `south,west,north,east`, filters optionally by 'character' id and 'date_range' of timestamps
+        and counts 'per_character'. Only the cells with locations are returned. Without a character,
+        the whole hours of the range are read from the density rollups
+        """
+        try:
+            grid = self.validate_heatmap_params(request.query_params.get("bbox"), request.query_params.get("cell"))
+            date_range = request.query_params.get("date_range")
+            date_range = parse_date_range(date_range) if date_range is not None else None
+        except serializers.ValidationError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        per_character = request.query_params.get("per_character", "0") == "1"
+        if per_character or "character" in request.query_params:
+            counts = grid_counts(self.filter_by_date_range(self.filter_by_character(self.queryset.all())), grid, per_character)
+        else:
+            counts = density_counts(self.queryset.all(), grid, date_range)
+        return Response({"cell": float(request.query_params["cell"]), "cells": cells_of(counts, grid.step, per_character)})
+
+    @swagger_auto_schema(
+        responses={200: "The `zoom` and the `clusters` with their centroid `lat` and `lon`, `count` and `id` when single"},
+        manual_parameters=[
+            openapi.Parameter("zoom", openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=True),
+            openapi.Parameter("bbox", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+        ],
+    )
+    @action(detail=False, methods=["get"])
+    def clusters(self, request):
+        """
+        Clusters the locations around the 'bbox', given as `south,west,north,east`, as a map shows
+        them at the web map 'zoom' level, so the number of clusters is bounded by the size of the
+        screen and not by the number of locations. The clusters of a single location carry its id
+        """
+        try:
+            bbox = self.validate_bbox(request.query_params.get("bbox"))
+            zoom = request.query_params.get("zoom", "")
+            if not (zoom.isdigit() and int(zoom) <= MAX_ZOOM):
+                raise serializers.ValidationError(f"The query parameter `zoom` is obligatory and accepts 0 to {MAX_ZOOM}")
+        except serializers.ValidationError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"zoom": int(zoom), "clusters": cluster_index.clusters(bbox_boxes(*bbox), int(zoom))})
+
+    @swagger_auto_schema(
+        responses={
+            200: "The pairs of characters that met, with the `first_seen` and `last_seen` times they met, their "
+            "number of `meetings` and the `closest` distance in meters between them"
+        },
+        manual_parameters=[
+            openapi.Parameter("distance", openapi.IN_QUERY, type=openapi.TYPE_NUMBER, required=True),
+            openapi.Parameter("time_window", openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=True),
+            openapi.Parameter("character", openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+            openapi.Parameter("date_range", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+        ],
+    )
+    @action(detail=False, methods=["get"])
+    def colocations(self, request):
+        """
+        Finds the characters that were within 'distance' meters of each other within 'time_window'
+        minutes, only those who met the 'character' when given, over the locations of the
+        'date_range' of timestamps
+        """
+        try:
+            distance, window = self.validate_colocation_params(
+                request.query_params.get("distance"), request.query_params.get("time_window")
+            )
+            character = request.query_params.get("character")
+            if character is not None and not character.isdigit():
+                raise serializers.ValidationError("The query parameter `character` accepts a character id")
+            queryset = self.filter_by_date_range(self.queryset.all())
+        except serializers.ValidationError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        pairs = find_colocations(
+            points_of(queryset), distance, window, int(character) if character is not None else None
+        )
+        return Response({"distance": distance, "time_window": window.total_seconds() / 60, "pairs": pairs})
+
+    @swagger_auto_schema(
+        responses={200: "The tile, in the Mapbox Vector Tile format"},
+        manual_parameters=[
+            openapi.Parameter("character", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter("date_range", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+        ],
+    )
+    def tile(self, request, z: str, x: str, y: str):
+        """
+        Encodes the locations within the web mercator tile 'z'/'x'/'y' as a Mapbox Vector Tile of a
+        `locations` layer of points, filtered optionally by 'character' id and 'date_range' of
+        timestamps. Locations within the same pixel of the tile are merged in a point with their
+        `count`, a single location gives its id to its point
+        """
+        z, x, y = int(z), int(x), int(y)
+        if z > MAX_TILE_ZOOM or x >= 2 ** z or y >= 2 ** z:
+            return Response(
+                {"detail": f"Tiles exist from zoom 0 to {MAX_TILE_ZOOM}, with x and y below 2^zoom"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            queryset = self.filter_by_date_range(self.filter_by_character(self.queryset.all()))
+        except serializers.ValidationError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        filters = (request.query_params.get("character"), request.query_params.get("date_range"))
+        content, version = tile_cache.get((z, x, y), filters)
+        if content is None:
+            content = encode_tile(tile_features(queryset, z, x, y))
+            tile_cache.put((z, x, y), filters, version, content)
+        return HttpResponse(content, content_type=MVT_MEDIA_TYPE)
+
+    @swagger_auto_schema(
+        responses={200: "The depth of the write-behind buffer, its counters and its flush latencies in seconds"}
+    )
+    @action(detail=False, methods=["get"], url_path="buffer/metrics")
+    def buffer_metrics(self, request):
+        """
+        Gets the metrics of the write-behind buffer the created locations go through when enabled
+        """
+        return Response(write_behind_buffer.metrics())
+
+
+class GeofenceViewSet(viewsets.ModelViewSet):
+    """
+    CRUD of the geofences. Every location created is checked against them, and the entries and
+    exits of the characters are recorded as events
+    """
+
+    queryset = Geofence.objects.all()
+    serializer_class = GeofenceSerializer
+
+    @swagger_auto_schema(
+        responses={200: GeofenceEventPageSerializer},
+        manual_parameters=[
+            openapi.Parameter("fence", openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+            openapi.Parameter("character", openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+            openapi.Parameter("date_range", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter("page_size", openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+            openapi.Parameter("cursor", openapi.IN_QUERY, type=openapi.TYPE_STRING),
+        ],
+    )
+    @action(detail=False, methods=["get"])
+    def events(self, request):
+        """
+        Lists the entries and exits of the geofences in timestamp order, filtered optionally by
+        'fence' id, 'character' id and 'date_range' of timestamps. Everything is returned unless a
+        'page_size' is given, then the 'next' link holds the cursor of the next page
+        """
+        paginator = TimestampCursorPagination(request)
+        queryset = GeofenceEvent.objects.all()
+        try:
+            for parameter in ("fence", "character"):
+                value = request.query_params.get(parameter)
+                if value is not None:
+                    if not value.isdigit():
+                        raise serializers.ValidationError(f"The query parameter `{parameter}` accepts an id")
+                    queryset = queryset.filter(**{parameter: int(value)})
+            date_range = request.query_params.get("date_range")
+            if date_range is not None:
+                queryset = queryset.filter(timestamp__range=parse_date_range(date_range))
+            page_size = paginator.get_page_size()
+            position = paginator.get_position()
+        except serializers.ValidationError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if position is not None:
+            timestamp, event_id = position
+            queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=event_id))
+        queryset = queryset.order_by("timestamp", "id")
+        if page_size is not None:
+            queryset = queryset[:page_size + 1]
+        events = list(queryset)
+        next_link = None
+        if page_size is not None and len(events) > page_size:
+            events = events[:page_size]
+            next_link = paginator.get_next_link((events[-1].timestamp, events[-1].id))
+        return Response({"next": next_link, "results": GeofenceEventSerializer(events, many=True).data})
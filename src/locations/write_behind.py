@@ -0,0 +1,439 @@
+import fcntl
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection
+
+from .ingest import ingest, validate_rows
+from .models import Location
+
+logger = logging.getLogger(__name__)
+
+# Entries written to a segment of the append log before the next one is started
+LOG_SEGMENT_SIZE = 10_000
+# Locked in the append log directory of a process for as long as it runs
+LOCK_FILE = "lock"
+# Attempts at writing a batch before it is written row by row, dropping the rows that fail
+FLUSH_ATTEMPTS = 3
+FLUSH_RETRY_DELAY = 0.1
+# Attempts at writing the rows of the append log on start, they are left in it for the next start
+# when they all fail
+REPLAY_ATTEMPTS = 5
+
+
+def lock_file(path: Path):
+    """
+    The file at 'path', created if needed, opened and exclusively locked until it is closed. None
+    when another process holds the lock
+    """
+    file = path.open("a")
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        file.close()
+        return None
+    return file
+
+
+class AppendLog:
+    """
+    Log of the rows accepted but not yet committed, so they survive a crash. Every process appends
+    to its own subdirectory of 'directory', locked for as long as the log is open, and replays the
+    subdirectories whose lock no process holds. The log is split in numbered segments, each of them
+    deleted once all its rows are committed. With 'fsync' every row is on disk before it is
+    acknowledged, the rows appended while an fsync runs share the next one
+    """
+
+    def __init__(self, directory: str, fsync: bool = True):
+        self.root = Path(directory)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        # Held by the writer running an fsync, the writers waiting for it find their rows on disk
+        self._sync_lock = threading.Lock()
+        self._written = self._synced = 0
+        self._pending: Counter = Counter()
+        self._file = None
+        self._entries = 0
+        self._segment = 0
+        # Claimed before creating the directory of this process, so only stopped processes are replayed
+        self._claimed = self._claim()
+        self._previous = [path for directory in self._claimed for path in self.segments(directory)]
+        self.directory, self._lock_file = self._create()
+
+    @staticmethod
+    def segments(directory: Path) -> List[Path]:
+        return sorted(directory.glob("*.ndjson"), key=lambda path: int(path.stem))
+
+    def _claim(self) -> Dict[Path, Any]:
+        """
+        Locks the subdirectories left by stopped processes
+        """
+        claimed = {}
+        for directory in sorted(self.root.iterdir()):
+            # Dot prefixed directories are being created
+            if not directory.is_dir() or directory.name.startswith("."):
+                continue
+            try:
+                file = lock_file(directory / LOCK_FILE)
+            except FileNotFoundError:
+                # Removed by another process once replayed
+                continue
+            if file is not None:
+                claimed[directory] = file
+        return claimed
+
+    def _create(self) -> Tuple[Path, Any]:
+        """
+        Creates and locks the subdirectory of this process, locked before it is visible to others
+        """
+        staging = Path(tempfile.mkdtemp(prefix=f".{os.getpid()}-", dir=self.root))
+        file = lock_file(staging / LOCK_FILE)
+        directory = staging.with_name(staging.name[1:])
+        staging.rename(directory)
+        return directory, file
+
+    @staticmethod
+    def _release(directory: Path, file):
+        """
+        Unlocks 'directory', which is deleted when no segment is left in it
+        """
+        if not any(directory.glob("*.ndjson")):
+            (directory / LOCK_FILE).unlink(missing_ok=True)
+            try:
+                directory.rmdir()
+            except OSError:
+                logger.warning("Could not delete the append log directory %s", directory)
+        file.close()
+
+    def replay(self) -> Tuple[List[Path], List[Dict[str, Any]]]:
+        """
+        Reads the rows of the segments left by stopped processes, a partly written last line is
+        dropped since it was never acknowledged
+        """
+        paths, rows = self._previous, []
+        for path in paths:
+            with path.open() as segment:
+                for line in segment:
+                    try:
+                        rows.append(json.loads(line))
+                    except ValueError:
+                        logger.warning("Skipping a truncated entry of %s", path)
+        return paths, rows
+
+    def replayed(self, paths: List[Path]):
+        for path in paths:
+            path.unlink(missing_ok=True)
+        self._previous = [path for path in self._previous if path not in paths]
+        left = {path.parent for path in self._previous}
+        for directory in [directory for directory in self._claimed if directory not in left]:
+            self._release(directory, self._claimed.pop(directory))
+
+    def append(self, row: Dict[str, Any]) -> int:
+        line = json.dumps(row) + "\n"
+        with self._lock:
+            if self._file is None or self._entries >= LOG_SEGMENT_SIZE:
+                self._rotate()
+            self._file.write(line)
+            self._entries += 1
+            self._pending[self._segment] += 1
+            self._written += 1
+            position, segment = self._written, self._segment
+            if not self.fsync:
+                self._file.flush()
+        if self.fsync:
+            self._sync(position)
+        return segment
+
+    def _sync(self, position: int):
+        """
+        Returns once the row at 'position' is on disk. A single writer runs an fsync at a time, for
+        every row written until it started
+        """
+        with self._sync_lock:
+            if self._synced >= position:
+                return
+            with self._lock:
+                if self._file is None:
+                    # Closed, which flushed it
+                    return
+                self._file.flush()
+                written = self._written
+                # Duplicated so the fsync is not run on a descriptor closed by a rotation meanwhile
+                descriptor = os.dup(self._file.fileno())
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+            self._synced = written
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._delete_committed()
+        self._segment += 1
+        self._entries = 0
+        self._file = (self.directory / f"{self._segment:012d}.ndjson").open("a")
+
+    def _delete_committed(self):
+        for segment in [segment for segment, count in self._pending.items() if count <= 0]:
+            if segment != self._segment or self._file is None:
+                (self.directory / f"{segment:012d}.ndjson").unlink(missing_ok=True)
+                del self._pending[segment]
+
+    def committed(self, segments: Counter):
+        with self._lock:
+            self._pending.subtract(segments)
+            self._delete_committed()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._delete_committed()
+            # The segments not replayed are left to the next start
+            for directory, file in self._claimed.items():
+                file.close()
+            self._claimed = {}
+            self._release(self.directory, self._lock_file)
+
+
+class WriteBehindBuffer:
+    """
+    Bounded in-process queue of the locations created through the API, written by a background
+    thread in batches of LOCATIONS_WRITE_BEHIND_BATCH_SIZE rows, or of whatever arrived within
+    LOCATIONS_WRITE_BEHIND_FLUSH_INTERVAL seconds. A single writer committing groups of rows avoids
+    the lock contention of concurrent SQLite writers. When LOCATIONS_WRITE_BEHIND_LOG_DIR is set
+    the rows are appended to a log first and the rows a crash left in it are written on start, so
+    each row is written at least once. A flusher stopped by an unexpected error is restarted by the
+    next location queued, with the rows left in the queue
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._log: Optional[AppendLog] = None
+        # Slots of the queue taken by the rows being appended to the log
+        self._reserved = 0
+        self._stopping = threading.Event()
+        self._metrics: Counter = Counter()
+        self._last_flush_latency = 0.0
+        self._max_flush_latency = 0.0
+
+    @staticmethod
+    def enabled() -> bool:
+        return getattr(settings, "LOCATIONS_WRITE_BEHIND", False)
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            if self._queue is None:
+                self._queue = queue.Queue(maxsize=getattr(settings, "LOCATIONS_WRITE_BEHIND_MAX_SIZE", 10_000))
+                log_directory = getattr(settings, "LOCATIONS_WRITE_BEHIND_LOG_DIR", None)
+                if log_directory:
+                    self._log = AppendLog(log_directory, getattr(settings, "LOCATIONS_WRITE_BEHIND_FSYNC", True))
+                self._metrics = Counter()
+                self._last_flush_latency = self._max_flush_latency = 0.0
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="locations-write-behind", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Writes what is queued and stops the flusher. The queue and the log are only dropped once
+        the flusher exited, a flusher still writing after 'timeout' keeps them
+        """
+        with self._lock:
+            thread = self._thread
+            self._stopping.set()
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.warning("The write-behind flusher is still writing after %s seconds", timeout)
+                return
+
+        with self._lock:
+            # Unless a location queued meanwhile restarted it
+            if self._thread is not None or self._reserved:
+                return
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            self._queue = None
+
+    def put(self, location: Location) -> bool:
+        """
+        Queues a validated location, returns False without queueing it when the buffer is full
+        """
+        self.start()
+        row = {
+            "character": location.character_id,
+            "timestamp": location.timestamp.isoformat(),
+            "lat": str(location.lat),
+            "lon": str(location.lon),
+        }
+        with self._lock:
+            # Checked under the lock, only the flusher takes rows out meanwhile
+            if self._queue.qsize() + self._reserved >= self._queue.maxsize:
+                self._metrics["rejected"] += 1
+                return False
+            self._reserved += 1
+            rows, log = self._queue, self._log
+        try:
+            # Appended outside the lock, so the rows appended together share an fsync
+            segment = log.append(row) if log is not None else None
+            rows.put_nowait((segment, location))
+        except BaseException:
+            with self._lock:
+                self._reserved -= 1
+            raise
+        with self._lock:
+            self._reserved -= 1
+            self._metrics["queued"] += 1
+        return True
+
+    def join(self):
+        """
+        Waits until every queued location is written
+        """
+        if self._queue is not None:
+            self._queue.join()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled(),
+            "running": self._thread is not None and self._thread.is_alive(),
+            "depth": self._queue.qsize() if self._queue is not None else 0,
+            "capacity": self._queue.maxsize if self._queue is not None else 0,
+            "queued": self._metrics["queued"],
+            "rejected": self._metrics["rejected"],
+            "written": self._metrics["written"],
+            "failed": self._metrics["failed"],
+            "replayed": self._metrics["replayed"],
+            "flushes": self._metrics["flushes"],
+            "last_flush_latency": self._last_flush_latency,
+            "max_flush_latency": self._max_flush_latency,
+        }
+
+    def _run(self):
+        try:
+            self._replay()
+            batch_size = getattr(settings, "LOCATIONS_WRITE_BEHIND_BATCH_SIZE", 500)
+            interval = getattr(settings, "LOCATIONS_WRITE_BEHIND_FLUSH_INTERVAL", 0.05)
+            while not (self._stopping.is_set() and self._queue.empty()):
+                batch = self._take(batch_size, interval)
+                if batch:
+                    try:
+                        self._flush(batch)
+                    except Exception:
+                        logger.exception("Flushing %d buffered locations failed", len(batch))
+        except Exception:
+            logger.exception("The write-behind flusher stopped")
+        finally:
+            connection.close()
+            with self._lock:
+                # Restarted by the next 'put' if it stopped on an error
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+    def _replay(self):
+        if self._log is None:
+            return
+        for attempt in range(REPLAY_ATTEMPTS):
+            try:
+                close_old_connections()
+                self._replay_log()
+                return
+            except Exception:
+                logger.warning("Writing the locations of the append log failed", exc_info=True)
+                if self._stopping.wait(FLUSH_RETRY_DELAY * 2 ** attempt):
+                    break
+        logger.error("The locations of the append log are left in it for the next start")
+
+    def _replay_log(self):
+        paths, rows = self._log.replay()
+        if not rows:
+            return
+        locations, errors = validate_rows(rows)
+        for error in errors:
+            logger.warning("Dropping the logged location %s: %s", rows[error["index"]], error["errors"])
+        ingest(locations)
+        self._log.replayed(paths)
+        self._metrics["replayed"] += len(locations)
+
+    def _take(self, batch_size: int, interval: float) -> List[Tuple[Optional[int], Location]]:
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + interval
+        while len(batch) < batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch: List[Tuple[Optional[int], Location]]):
+        started = time.monotonic()
+        close_old_connections()
+        locations = [location for _, location in batch]
+        try:
+            written = self._write(locations)
+
+            latency = time.monotonic() - started
+            self._last_flush_latency = latency
+            self._max_flush_latency = max(self._max_flush_latency, latency)
+            self._metrics["flushes"] += 1
+            self._metrics["written"] += written
+            self._metrics["failed"] += len(locations) - written
+            if self._log is not None:
+                self._log.committed(Counter(segment for segment, _ in batch))
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    @staticmethod
+    def _write(locations: List[Location]) -> int:
+        for attempt in range(FLUSH_ATTEMPTS):
+            try:
+                return len(ingest(locations, batch_size=len(locations)))
+            except DatabaseError:
+                logger.warning("Writing %d buffered locations failed", len(locations), exc_info=True)
+                time.sleep(FLUSH_RETRY_DELAY * 2 ** attempt)
+            except Exception:
+                # Not transient, retrying the whole batch would fail the same way
+                logger.warning("Writing %d buffered locations failed", len(locations), exc_info=True)
+                break
+
+        # A row keeps failing, like one whose character was deleted since, the others are kept
+        written = 0
+        for location in locations:
+            try:
+                ingest([location])
+                written += 1
+            except Exception:
+                logger.exception("Dropping the buffered location %s", location.__dict__)
+        return written
+
+
+write_behind_buffer = WriteBehindBuffer()
@@ -1,7 +1,11 @@
+import json
+
+from django.test import override_settings
 from rest_framework.test import APITestCase
 from rest_framework import status
 
 from characters.models import Character
+from locations.models import Location
 
 
 class TestCharacterViewSet(APITestCase):
@@ -219,3 +223,225 @@ class TestCharacterViewSet(APITestCase):
         # Then
         assert response.status_code == status.HTTP_404_NOT_FOUND
         assert "Not found." in response.data["detail"]
+
+    # Tests that the latest known location of a character can be retrieved.
+    def test_retrieve_last_location_successfully(self):
+        """
+        Given a character with locations and a character without any exist in the database
+        When GET requests are made to their last_location
+        Then the response should contain the most recent location, or have a status code of 404
+        """
+        # Given
+        character = Character.objects.create(name="John Doe", date_of_birth="1990-01-01", occupation="Teacher")
+        lost = Character.objects.create(name="Jane Smith", date_of_birth="1995-05-05", occupation="Doctor")
+        Location.objects.create(character=character, timestamp="2020-01-02T00:00:00Z", lat="10", lon="10")
+        Location.objects.create(character=character, timestamp="2020-01-01T00:00:00Z", lat="20", lon="20")
+
+        # When
+        response = self.client.get(f"/characters/{character.id}/last_location/")
+        missing = self.client.get(f"/characters/{lost.id}/last_location/")
+
+        # Then
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data["timestamp"] == "2020-01-02T00:00:00Z"
+        assert response.data["lat"] == "10.000000"
+        assert missing.status_code == status.HTTP_404_NOT_FOUND
+
+    # Tests that the latest known locations can be embedded in the list of characters.
+    def test_list_characters_with_last_location(self):
+        """
+        Given characters with and without locations exist in the database
+        When GET requests are made to list characters with and without with_last_location
+        Then the latest known locations should only be embedded when requested
+        """
+        # Given
+        character = Character.objects.create(name="John Doe", date_of_birth="1990-01-01", occupation="Teacher")
+        Character.objects.create(name="Jane Smith", date_of_birth="1995-05-05", occupation="Doctor")
+        Location.objects.create(character=character, timestamp="2020-01-02T00:00:00Z", lat="10", lon="10")
+        url = "/characters/?orderBy=name&ascending=0"
+
+        # When
+        plain = self.client.get(url)
+        with self.assertNumQueries(1):
+            embedded = self.client.get(f"{url}&with_last_location=1")
+
+        # Then
+        assert "last_location" not in plain.data[0]
+        assert embedded.status_code == status.HTTP_200_OK
+        assert embedded.data[0]["last_location"]["lat"] == "10.000000"
+        assert embedded.data[1]["last_location"] is None
+
+    # Tests that the trajectory of a character is streamed in timestamp order, page by page.
+    def test_trajectory_successfully(self):
+        """
+        Given a character with locations written out of order, two of them at the same time
+        When its trajectory is requested whole, within a date range and page by page as JSON and NDJSON
+        Then the locations should be returned once each, ordered by timestamp and id
+        """
+        # Given
+        character = Character.objects.create(name="John Doe", date_of_birth="1990-01-01", occupation="Teacher")
+        other = Character.objects.create(name="Jane Smith", date_of_birth="1995-05-05", occupation="Doctor")
+        for timestamp, lat in [
+            ("2020-01-03T00:00:00Z", "3"),
+            ("2020-01-01T00:00:00Z", "1"),
+            ("2020-01-02T00:00:00Z", "2"),
+            ("2020-01-02T00:00:00Z", "2.5"),
+        ]:
+            Location.objects.create(character=character, timestamp=timestamp, lat=lat, lon="0")
+        Location.objects.create(character=other, timestamp="2020-01-01T12:00:00Z", lat="9", lon="0")
+        url = f"/characters/{character.id}/trajectory/"
+
+        # When
+        whole = self.client.get(url)
+        ranged = self.client.get(f"{url}?date_range=2020-01-02T00:00:00Z,2020-01-02T12:00:00Z")
+        pages, ndjson_pages, next_link, ndjson_link = [], [], f"{url}?page_size=3", f"{url}?page_size=3&format=ndjson"
+        while next_link:
+            response = json.loads(b"".join(self.client.get(next_link).streaming_content))
+            pages.append([location["lat"] for location in response["results"]])
+            next_link = response["next"]
+        while ndjson_link:
+            response = self.client.get(ndjson_link)
+            lines = b"".join(response.streaming_content).decode().splitlines()
+            ndjson_pages.append([json.loads(line)["lat"] for line in lines])
+            ndjson_link = response.get("Link", "<>").split(">")[0][1:]
+
+        # Then
+        assert whole.status_code == status.HTTP_200_OK
+        assert whole["Content-Type"] == "application/json"
+        results = json.loads(b"".join(whole.streaming_content))["results"]
+        assert [location["lat"] for location in results] == ["1.000000", "2.000000", "2.500000", "3.000000"]
+        assert results[0]["timestamp"] == "2020-01-01T00:00:00Z"
+        ranged_results = json.loads(b"".join(ranged.streaming_content))["results"]
+        assert [location["lat"] for location in ranged_results] == ["2.000000", "2.500000"]
+        assert pages == ndjson_pages == [["1.000000", "2.000000", "2.500000"], ["3.000000"]]
+
+    # Tests that an error is returned when invalid query parameters are used to get a trajectory.
+    def test_trajectory_with_invalid_query_params(self):
+        """
+        Given a character exists in the database
+        When its trajectory is requested with an invalid cursor, page size or date range, or for a missing character
+        Then the responses should have a status code of 400, or 404 for the missing character
+        """
+        # Given
+        character = Character.objects.create(name="John Doe", date_of_birth="1990-01-01", occupation="Teacher")
+        url = f"/characters/{character.id}/trajectory/"
+
+        # When
+        responses = [
+            self.client.get(f"{url}?cursor=invalid"),
+            self.client.get(f"{url}?page_size=0"),
+            self.client.get(f"{url}?date_range=2020-01-01"),
+        ]
+        missing = self.client.get(f"/characters/{character.id + 1}/trajectory/")
+
+        # Then
+        assert [response.status_code for response in responses] == [status.HTTP_400_BAD_REQUEST] * 3
+        assert missing.status_code == status.HTTP_404_NOT_FOUND
+
+    # Tests that the contacts of a character are recorded as locations are created.
+    @override_settings(LOCATIONS_CONTACTS=True)
+    def test_contacts_successfully(self):
+        """
+        Given characters whose locations are created close in space and time, one by one and in bulk
+        When GET requests are made to their contacts
+        Then the characters they met should be returned, most recent first, or a status code of 404 for a missing character
+        """
+        # Given
+        walter, jesse, saul = [
+            Character.objects.create(name=name, date_of_birth="1990-01-01", occupation="Cook")
+            for name in ["Walter White", "Jesse Pinkman", "Saul Goodman"]
+        ]
+        Location.objects.create(character=walter, timestamp="2020-01-01T10:00:00Z", lat="10", lon="10")
+        Location.objects.create(character=jesse, timestamp="2020-01-01T10:03:00Z", lat="10.0002", lon="10")
+        Location.objects.bulk_create(
+            [
+                Location(character=saul, timestamp="2020-01-01T12:00:00Z", lat="10", lon="10"),
+                Location(character=walter, timestamp="2020-01-01T12:01:00Z", lat="10", lon="10.0001"),
+                Location(character=jesse, timestamp="2020-01-01T12:30:00Z", lat="10", lon="10"),
+                Location(character=jesse, timestamp="2020-01-01T09:58:00Z", lat="10", lon="10"),
+            ]
+        )
+
+        # When
+        response = self.client.get(f"/characters/{walter.id}/contacts/")
+        missing = self.client.get(f"/characters/{saul.id + 1}/contacts/")
+
+        # Then
+        assert response.status_code == status.HTTP_200_OK
+        assert [dict(contact) for contact in response.data] == [
+            {"contact": saul.id, "first_seen": "2020-01-01T12:00:00Z", "last_seen": "2020-01-01T12:01:00Z", "count": 1},
+            {"contact": jesse.id, "first_seen": "2020-01-01T09:58:00Z", "last_seen": "2020-01-01T10:03:00Z", "count": 2},
+        ]
+        assert [contact["contact"] for contact in self.client.get(f"/characters/{saul.id}/contacts/").data] == [walter.id]
+        assert missing.status_code == status.HTTP_404_NOT_FOUND
+
+    # Tests that the suspicion is propagated to the characters who met the suspects.
+    @override_settings(LOCATIONS_CONTACTS=True)
+    def test_propagate_suspects_successfully(self):
+        """
+        Given a chain of characters who met one after the other, and one who met nobody
+        When the suspicion is propagated from the first one, as a dry run, over the locations, and for real
+        Then the characters within the depth should be reported with their hops, and only then marked as suspects
+        """
+        # Given
+        walter, jesse, saul, mike, skyler = [
+            Character.objects.create(name=name, date_of_birth="1990-01-01", occupation="Cook")
+            for name in ["Walter White", "Jesse Pinkman", "Saul Goodman", "Mike Ehrmantraut", "Skyler White"]
+        ]
+        for character, timestamp, lat in [
+            (walter, "2020-01-01T10:00:00Z", "10"),
+            (jesse, "2020-01-01T10:01:00Z", "10"),
+            (jesse, "2020-01-02T10:00:00Z", "20"),
+            (saul, "2020-01-02T10:20:00Z", "20"),
+            (saul, "2020-01-03T10:00:00Z", "30"),
+            (mike, "2020-01-03T10:02:00Z", "30"),
+            (skyler, "2020-01-03T10:02:00Z", "40"),
+        ]:
+            Location.objects.create(character=character, timestamp=timestamp, lat=lat, lon="10")
+
+        # When
+        dry_run = self.client.post(
+            "/characters/propagate_suspects/", data={"seeds": [walter.id], "depth": 2}, format="json"
+        )
+        wider = self.client.post(
+            "/characters/propagate_suspects/",
+            data={"seeds": [walter.id], "depth": 3, "time_window": 30, "distance": 10},
+            format="json",
+        )
+        marked_before = list(Character.objects.filter(is_suspect=True))
+        response = self.client.post(
+            "/characters/propagate_suspects/",
+            data={"seeds": [walter.id], "depth": 3, "dry_run": False},
+            format="json",
+        )
+
+        # Then
+        assert dry_run.status_code == status.HTTP_200_OK
+        assert dry_run.data["characters"] == [{"id": walter.id, "hops": 0}, {"id": jesse.id, "hops": 1}]
+        assert dry_run.data["updated"] == 0
+        assert [character["id"] for character in wider.data["characters"]] == [walter.id, jesse.id, saul.id, mike.id]
+        assert marked_before == []
+        assert response.data["updated"] == 2
+        assert set(Character.objects.filter(is_suspect=True).values_list("id", flat=True)) == {walter.id, jesse.id}
+
+    # Tests that an error is returned when the suspicion is propagated with invalid parameters.
+    def test_propagate_suspects_with_invalid_data(self):
+        """
+        Given a character exists in the database
+        When the suspicion is propagated without seeds, from a missing character or too deep
+        Then the responses should have a status code of 400
+        """
+        # Given
+        character = Character.objects.create(name="John Doe", date_of_birth="1990-01-01", occupation="Teacher")
+
+        # When
+        responses = [
+            self.client.post("/characters/propagate_suspects/", data={"seeds": []}, format="json"),
+            self.client.post("/characters/propagate_suspects/", data={"seeds": [character.id + 1]}, format="json"),
+            self.client.post(
+                "/characters/propagate_suspects/", data={"seeds": [character.id], "depth": 11}, format="json"
+            ),
+        ]
+
+        # Then
+        assert [response.status_code for response in responses] == [status.HTTP_400_BAD_REQUEST] * 3
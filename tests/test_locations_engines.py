@@ -0,0 +1,232 @@
+from unittest import mock
+
+from django.test import override_settings
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from characters.models import Character
+from locations import engines
+from locations.engines import DISTANCE_ENGINES
+from locations.geo import DISTANCE_FORMULAS
+from locations.memory_index import location_index
+from locations.models import Location
+
+
+class TestDistanceEngines(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.main_character = Character.objects.create(
+            name="Walter White", date_of_birth="1970-11-01", occupation="Teacher"
+        )
+        cls.other_character = Character.objects.create(
+            name="Jesse Pinkman", date_of_birth="1984-09-24", occupation="Cook"
+        )
+        for character, lat, lon in [
+            (cls.main_character, "10", "10"),
+            (cls.main_character, "10.01", "10"),
+            (cls.main_character, "10.02", "10.02"),
+            (cls.other_character, "10.005", "10"),
+            (cls.main_character, "11", "10"),
+            (cls.main_character, "0", "179.999"),
+            (cls.main_character, "0", "-179.999"),
+        ]:
+            Location.objects.create(character=character, timestamp="2020-01-01T00:00:00Z", lat=lat, lon=lon)
+
+    def setUp(self):
+        location_index.clear()
+        self.addCleanup(location_index.clear)
+
+    # Tests that every distance engine gives the same near results.
+    def test_near_locations_with_every_engine(self):
+        """
+        Given locations exist in the database
+        When GET requests are made to locations/near and locations/nearest with each distance engine
+        Then every engine should return the same locations in the same order
+        """
+        for engine in DISTANCE_ENGINES:
+            with self.subTest(engine=engine), override_settings(LOCATIONS_DISTANCE_ENGINE=engine):
+                # When
+                near = self.client.get(
+                    f"/locations/near/?coordinates=10,10&distance=5000&character={self.main_character.id}"
+                )
+                descending = self.client.get("/locations/near/?coordinates=0,179.9995&distance=1000&ascending=0")
+                nearest = self.client.get("/locations/nearest/?coordinates=10,10&k=2")
+
+                # Then
+                assert near.status_code == status.HTTP_200_OK
+                assert [(location["lat"], location["lon"]) for location in near.data["results"]] == [
+                    ("10.000000", "10.000000"),
+                    ("10.010000", "10.000000"),
+                    ("10.020000", "10.020000"),
+                ]
+                assert [location["lon"] for location in descending.data["results"]] == ["-179.999000", "179.999000"]
+                assert [location["lat"] for location in nearest.data] == ["10.000000", "10.005000"]
+
+    # Tests that every distance engine supports every distance formula.
+    def test_near_locations_with_every_formula(self):
+        """
+        Given locations exist in the database
+        When GET requests are made to locations/near with each distance engine and formula
+        Then every combination should return the same locations with close distances
+        """
+        for engine in DISTANCE_ENGINES:
+            for formula in DISTANCE_FORMULAS:
+                with self.subTest(engine=engine, formula=formula), override_settings(LOCATIONS_DISTANCE_ENGINE=engine):
+                    # When
+                    response = self.client.get(f"/locations/near/?coordinates=10,10&distance=2000&formula={formula}")
+
+                    # Then
+                    assert response.status_code == status.HTTP_200_OK
+                    assert [location["lat"] for location in response.data["results"]] == ["10.000000", "10.005000", "10.010000"]
+                    distances = self.client.get(
+                        f"/locations/near/?coordinates=10,10.0000001&distance=2000&formula={formula}&with_distance=1"
+                    ).data["results"]
+                    assert [len(str(location["distance"]).split(".")[1]) for location in distances] == [6, 6, 6]
+
+    # Tests that every distance engine returns the distance and the bearing when they are requested.
+    def test_near_locations_with_distance_and_bearing(self):
+        """
+        Given locations exist in the database
+        When GET requests are made to locations/near and locations/nearest with each distance engine and formula,
+        with and without with_distance and with_bearing
+        Then the distance and the bearing from the coordinates should only be returned when requested
+        """
+        for engine in DISTANCE_ENGINES:
+            for formula in DISTANCE_FORMULAS:
+                with self.subTest(engine=engine, formula=formula), override_settings(LOCATIONS_DISTANCE_ENGINE=engine):
+                    # When
+                    plain = self.client.get(f"/locations/near/?coordinates=10,10&distance=2000&formula={formula}")
+                    near = self.client.get(
+                        f"/locations/near/?coordinates=0,179.9995&distance=1000&formula={formula}"
+                        "&with_distance=1&with_bearing=1"
+                    )
+                    nearest = self.client.get(
+                        f"/locations/nearest/?coordinates=10,10&k=3&formula={formula}&with_bearing=1"
+                    )
+
+                    # Then
+                    assert "distance" not in plain.data["results"][0]
+                    assert "bearing" not in plain.data["results"][0]
+                    assert [round(location["bearing"]) for location in near.data["results"]] == [270, 90]
+                    assert [round(location["distance"]) for location in near.data["results"]] == [56, 167]
+                    assert all(
+                        location["distance"] == round(location["distance"], 6) for location in near.data["results"]
+                    )
+                    assert "distance" not in nearest.data[0]
+                    assert [round(location["bearing"]) % 360 for location in nearest.data] == [0, 0, 0]
+
+    # Tests that equirectangular searches find every location in range at high latitudes and past half the circumference.
+    def test_near_locations_equirectangular_range(self):
+        """
+        Given a location 494 km away by the equirectangular formula but 531 km along the great circle, next to a
+        high latitude, and a location farther than half the circumference by that formula
+        When GET requests are made to locations/near and locations/nearest with the equirectangular formula and
+        each distance engine
+        Then both locations should be found
+        """
+        # Given
+        close = Location.objects.create(
+            character=self.other_character, timestamp="2020-01-01T00:00:00Z", lat="77", lon="28.9"
+        )
+        far = Location.objects.create(character=self.other_character, timestamp="2020-01-01T00:00:00Z", lat="-89", lon="179")
+
+        for engine in DISTANCE_ENGINES:
+            with self.subTest(engine=engine), override_settings(LOCATIONS_DISTANCE_ENGINE=engine):
+                # When
+                near = self.client.get("/locations/near/?coordinates=80,10&distance=500000&formula=equirectangular")
+                nearest = self.client.get("/locations/nearest/?coordinates=0,0&k=9&formula=equirectangular")
+
+                # Then
+                assert [location["id"] for location in near.data["results"]] == [close.id]
+                assert len(nearest.data) == 9
+                assert nearest.data[-1]["id"] == far.id
+
+    # Tests that the KD-tree engine only hydrates the closest locations a page needs.
+    def test_near_locations_kdtree_hydrates_page(self):
+        """
+        Given many locations of another character interleaved with those of a character
+        When a page of locations/near filtered by that character is requested with the KD-tree engine
+        Then the page should match the SQL engine while only the closest locations are hydrated
+        """
+        # Given
+        Location.objects.bulk_create(
+            Location(character=character, timestamp="2020-01-01T00:00:00Z", lat=f"{10 + i * 0.00001:.6f}", lon="10")
+            for i in range(1, 500)
+            for character in ([self.main_character] if i % 10 == 0 else [self.other_character])
+        )
+        url = f"/locations/near/?coordinates=10,10&distance=5000&page_size=5&character={self.main_character.id}"
+        with override_settings(LOCATIONS_DISTANCE_ENGINE="sql"):
+            expected = self.client.get(url).data["results"]
+
+        # When
+        with override_settings(LOCATIONS_DISTANCE_ENGINE="kdtree"), mock.patch.object(
+            engines, "hydrate", wraps=engines.hydrate
+        ) as hydrate:
+            response = self.client.get(url)
+
+        # Then
+        assert response.status_code == status.HTTP_200_OK
+        assert [location["id"] for location in response.data["results"]] == [location["id"] for location in expected]
+        hydrated = sum(len(call.args[1]) for call in hydrate.call_args_list)
+        assert 50 <= hydrated < 100
+
+    # Tests that an unknown distance formula is rejected.
+    def test_near_locations_with_invalid_formula(self):
+        """
+        Given the near endpoint
+        When a GET request is made with an unknown formula
+        Then the response should have a status code of 400 and contain an error message
+        """
+        # When
+        response = self.client.get("/locations/near/?coordinates=10,10&distance=2000&formula=manhattan")
+
+        # Then
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "The query parameter `formula` only accepts" in response.data["detail"]
+
+    # Tests that near results can be walked page by page with every distance engine.
+    def test_near_locations_pages_with_every_engine(self):
+        """
+        Given locations exist in the database, two of them at the same coordinates
+        When the pages of locations/near are followed through their `next` link with each distance engine
+        Then every location should be returned once, in distance order, in both directions
+        """
+        # Given
+        Location.objects.create(
+            character=self.other_character, timestamp="2020-01-01T00:00:00Z", lat="10.01", lon="10"
+        )
+        expected = ["10.000000", "10.005000", "10.010000", "10.010000", "10.020000"]
+
+        for engine in DISTANCE_ENGINES:
+            for ascending in ("1", "0"):
+                with self.subTest(engine=engine, ascending=ascending), override_settings(
+                    LOCATIONS_DISTANCE_ENGINE=engine
+                ):
+                    # When
+                    ids, lats = [], []
+                    url = f"/locations/near/?coordinates=10,10&distance=5000&page_size=2&ascending={ascending}"
+                    while url:
+                        response = self.client.get(url)
+                        assert response.status_code == status.HTTP_200_OK
+                        assert len(response.data["results"]) <= 2
+                        ids += [location["id"] for location in response.data["results"]]
+                        lats += [location["lat"] for location in response.data["results"]]
+                        url = response.data["next"]
+
+                    # Then
+                    assert lats == (expected if ascending == "1" else expected[::-1])
+                    assert len(set(ids)) == len(expected)
+
+    # Tests that an invalid cursor is rejected.
+    def test_near_locations_with_invalid_cursor(self):
+        """
+        Given the near endpoint
+        When a GET request is made with a cursor that was not issued by it
+        Then the response should have a status code of 400 and contain an error message
+        """
+        # When
+        response = self.client.get("/locations/near/?coordinates=10,10&distance=2000&cursor=garbage")
+
+        # Then
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "The query parameter `cursor` is invalid" in response.data["detail"]
@@ -0,0 +1,261 @@
+import math
+import random
+import threading
+from array import array
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from rest_framework import status
+
+from characters.models import Character
+from locations.clusters import cluster_index
+from locations.geo import haversine, unit_vector
+from locations.geofences import CIRCLE, POLYGON, fence_contains, geofence_index
+from locations import memory_index
+from locations.kdtree import KDTree
+from locations.memory_index import location_index
+from locations.models import Geofence, Location
+
+
+class TestKDTree(TestCase):
+    # Tests that the KD-tree finds the same points as a brute force scan.
+    def test_radius_matches_brute_force(self):
+        """
+        Given a KD-tree over random points, including some next to the poles and the antimeridian
+        When radius queries are made around random points
+        Then the results should be the same as a linear scan
+        """
+        # Given
+        rng = random.Random(0)
+        points = [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(2000)]
+        points += [(89.9, rng.uniform(-180, 180)) for _ in range(20)]
+        points += [(rng.uniform(-1, 1), rng.choice((-179.99, 179.99))) for _ in range(20)]
+        lats = array("d", (math.radians(lat) for lat, _ in points))
+        lons = array("d", (math.radians(lon) for _, lon in points))
+        tree = KDTree(array("q", range(len(points))), lats, lons)
+        tree.remove(5)
+
+        for lat, lon, distance in [(89.95, 0, 20_000), (0, 180, 50_000), (10, 10, 1_000_000)]:
+            # When
+            found = tree.radius(math.radians(lat), math.radians(lon), distance, "haversine")
+
+            # Then
+            expected = {
+                i
+                for i in range(len(points))
+                if i != 5 and haversine(math.radians(lat), math.radians(lon), lats[i], lons[i]) <= distance
+            }
+            assert {location_id for location_id, _ in found} == expected
+
+
+@override_settings(LOCATIONS_DISTANCE_ENGINE="kdtree")
+class TestLocationIndex(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.main_character = Character.objects.create(
+            name="Walter White", date_of_birth="1970-11-01", occupation="Teacher"
+        )
+
+    def setUp(self):
+        location_index.clear()
+        self.addCleanup(location_index.clear)
+
+    def create_location(self, lat, lon):
+        return Location.objects.create(
+            character=self.main_character, timestamp="2020-01-01T00:00:00Z", lat=lat, lon=lon
+        )
+
+    # Tests that the near endpoint is answered from the in-process index.
+    def test_near_locations_from_index(self):
+        """
+        Given the in-process index is enabled and locations exist in the database
+        When a GET request is made to locations/near
+        Then the response should contain the locations within the distance ordered by distance
+        """
+        # Given
+        self.create_location("10.01", "10")
+        self.create_location("10", "10")
+        self.create_location("11", "10")
+
+        # When
+        response = self.client.get("/locations/near/?coordinates=10,10&distance=5000&ascending=0")
+
+        # Then
+        assert response.status_code == 200
+        assert [location["lat"] for location in response.data["results"]] == ["10.010000", "10.000000"]
+
+    # Tests that writes after the index is loaded are applied incrementally.
+    def test_index_follows_writes(self):
+        """
+        Given the in-process index is loaded
+        When locations are created, moved and deleted
+        Then radius queries should reflect the writes once they are committed
+        """
+        # Given
+        moved = self.create_location("10", "10")
+        deleted = self.create_location("10", "10.01")
+        assert len(location_index.radius(10, 10, 5000)) == 2
+
+        # When
+        with self.captureOnCommitCallbacks(execute=True):
+            created = self.create_location("10.02", "10")
+            moved.lat = "50"
+            moved.save()
+            deleted.delete()
+
+        # Then
+        assert [location_id for location_id, _ in location_index.radius(10, 10, 5000)] == [created.id]
+
+    # Tests that the tree is rebuilt in the background without losing the writes made meanwhile.
+    def test_index_rebuilt_in_background(self):
+        """
+        Given the in-process index is loaded
+        When enough points are written to rebuild the tree, and more writes are made while it is built
+        Then radius queries should be answered during the build, and reflect every write once the new tree is swapped in
+        """
+        # Given
+        moved = self.create_location("10", "10")
+        assert len(location_index.radius(10, 10, 5000)) == 1
+        building, built = threading.Event(), threading.Event()
+
+        def build(*points):
+            building.set()
+            built.wait(5)
+            return KDTree(*points)
+
+        # When
+        with mock.patch.object(memory_index, "MIN_REBUILD_SIZE", 10), mock.patch.object(memory_index, "KDTree", build):
+            for i in range(11):
+                location_index.upsert(1000 + i, 10, 10 + i * 0.001)
+            assert building.wait(5)
+            during = location_index.radius(10, 10, 5000)
+            location_index.upsert(moved.id, 50, 50)
+            location_index.remove(1000)
+            built.set()
+            location_index.wait(5)
+
+        # Then
+        assert len(during) == 12
+        assert sorted(location_id for location_id, _ in location_index.radius(10, 10, 5000)) == list(range(1001, 1011))
+        assert list(location_index._pending) == [moved.id]
+
+
+class TestClusterIndex(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.main_character = Character.objects.create(
+            name="Walter White", date_of_birth="1970-11-01", occupation="Teacher"
+        )
+
+    def setUp(self):
+        cluster_index.clear()
+        self.addCleanup(cluster_index.clear)
+
+    def create_location(self, lat, lon):
+        return Location.objects.create(
+            character=self.main_character, timestamp="2020-01-01T00:00:00Z", lat=lat, lon=lon
+        )
+
+    def counts(self, url):
+        response = self.client.get(url)
+        assert response.status_code == 200
+        return [cluster["count"] for cluster in response.data["clusters"]]
+
+    # Tests that locations are clustered per zoom level and that the clusters follow the writes.
+    def test_clusters_follow_zoom_and_writes(self):
+        """
+        Given locations a few hundred meters apart and one across the antimeridian
+        When GET requests are made to locations/clusters at several zooms, before and after writes
+        Then close locations should be merged at low zooms, split at high zooms, and follow the writes once committed
+        """
+        # Given
+        first = self.create_location("10", "10")
+        self.create_location("10.01", "10.01")
+        self.create_location("10.05", "10.05")
+        self.create_location("0", "179.999")
+
+        # When / Then
+        assert self.counts("/locations/clusters/?zoom=2") == [1, 3]
+        assert self.counts("/locations/clusters/?zoom=2&bbox=-1,179,1,-179") == [1]
+        assert self.counts("/locations/clusters/?zoom=2&bbox=-1,-60,1,-40") == []
+        assert self.counts("/locations/clusters/?zoom=16") == [1, 1, 1, 1]
+        single = self.client.get("/locations/clusters/?zoom=16&bbox=9.9999,9.9999,10.0001,10.0001").data["clusters"]
+        assert single == [{"lat": 10.0, "lon": 10.0, "count": 1, "id": first.id}]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_location("10.02", "10.02")
+            first.lat = "-10"
+            first.save()
+        assert self.counts("/locations/clusters/?zoom=2") == [1, 1, 3]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Location.objects.filter(lat__gt=9).delete()
+        assert self.counts("/locations/clusters/?zoom=2") == [1, 1]
+
+    # Tests that an error is returned when invalid query parameters are used to get clusters.
+    def test_clusters_with_invalid_query_params(self):
+        """
+        Given the clusters endpoint
+        When GET requests are made without a zoom, with a zoom out of range or with an invalid bounding box
+        Then the responses should have a status code of 400
+        """
+        # When
+        responses = [
+            self.client.get("/locations/clusters/"),
+            self.client.get("/locations/clusters/?zoom=25"),
+            self.client.get("/locations/clusters/?zoom=2&bbox=10,10,0,20"),
+        ]
+
+        # Then
+        assert [response.status_code for response in responses] == [status.HTTP_400_BAD_REQUEST] * 3
+
+
+class TestGeofenceIndex(TestCase):
+    def setUp(self):
+        geofence_index.clear()
+        self.addCleanup(geofence_index.clear)
+
+    # Tests that the geofence index finds the same fences as a loop over every fence.
+    def test_containing_matches_brute_force(self):
+        """
+        Given circles and polygons of every size, including circles across the antimeridian and around a pole
+        When the fences containing random points are looked up in the index
+        Then they should be the fences a loop over every fence finds
+        """
+        # Given
+        generator = random.Random(3)
+        fences = [
+            Geofence.objects.create(name="Antimeridian", kind=CIRCLE, lat="0", lon="179.99", radius=5000),
+            Geofence.objects.create(name="North pole", kind=CIRCLE, lat="89.9", lon="0", radius=50_000),
+            Geofence.objects.create(name="Triangle", kind=POLYGON, polygon=[[-10, -10], [-10, 10], [10, 0]]),
+        ]
+        for i in range(200):
+            lat, lon = generator.uniform(-5, 5), generator.uniform(-5, 5)
+            if i % 2:
+                radius = 10 ** generator.uniform(1, 6)
+                fences.append(
+                    Geofence.objects.create(
+                        name=f"Circle {i}", kind=CIRCLE, lat=f"{lat:.6f}", lon=f"{lon:.6f}", radius=radius
+                    )
+                )
+            else:
+                size = 10 ** generator.uniform(-3, 0)
+                polygon = [[lat, lon], [lat + size, lon + size / 2], [lat, lon + size]]
+                fences.append(Geofence.objects.create(name=f"Polygon {i}", kind=POLYGON, polygon=polygon))
+        points = [(generator.uniform(-6, 6), generator.uniform(-6, 6)) for _ in range(500)]
+        points += [(0.0, -179.99), (0.0, 179.999), (89.95, 120.0), (0.0, 0.0)]
+        shapes = [
+            (fence.id, CIRCLE, (unit_vector(math.radians(float(fence.lat)), math.radians(float(fence.lon))), fence.radius))
+            if fence.kind == CIRCLE
+            else (fence.id, POLYGON, fence.polygon)
+            for fence in fences
+        ]
+
+        # When
+        found = [geofence_index.containing(lat, lon) for lat, lon in points]
+
+        # Then
+        expected = [sorted(shape[0] for shape in shapes if fence_contains(shape, lat, lon)) for lat, lon in points]
+        assert found == expected
+        assert sum(map(len, found)) > 100
+        assert found[-4:-1] == [[fences[0].id], [fences[0].id], [fences[1].id]]
@@ -0,0 +1,537 @@
+import math
+import random
+import re
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from characters.models import Character
+from locations.engines import SQLDistanceEngine
+from locations.geo import encode_geohash
+from locations import colocation, models as location_models
+from locations.geofences import CIRCLE, POLYGON, geofence_index
+from locations.models import Contact, DensityRollup, Geofence, GeofenceEvent, LastLocation, Location
+from locations.rtree import RTREE_TABLE, rtree_available
+from locations.views import LocationViewSet
+
+
+class TestLocationModel(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.main_character = Character.objects.create(
+            name="Walter White", date_of_birth="1970-11-01", occupation="Teacher"
+        )
+
+    # Tests that the geohash is computed when a location is saved.
+    def test_geohash_set_on_save(self):
+        """
+        Given a location is created
+        When it is saved
+        Then its geohash should match its coordinates
+        """
+        # Given / When
+        location = Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="57.649110",
+            lon="10.407440",
+        )
+
+        # Then
+        location.refresh_from_db()
+        assert location.geohash == "u4pruydqq"
+
+    # Tests that the trigonometric columns follow the coordinates.
+    def test_trigonometry_set_on_save(self):
+        """
+        Given a location is created
+        When its latitude is changed and only that field is saved
+        Then its sines and cosines should match its new coordinates in radians
+        """
+        # Given
+        location = Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="10",
+            lon="-45",
+        )
+
+        # When
+        location.lat = "30"
+        location.save(update_fields=["lat"])
+
+        # Then
+        location.refresh_from_db()
+        assert math.isclose(location.sin_lat, 0.5)
+        assert math.isclose(location.cos_lat, math.sqrt(3) / 2)
+        assert math.isclose(location.sin_lon, -math.sqrt(2) / 2)
+        assert math.isclose(location.cos_lon, math.sqrt(2) / 2)
+
+    # Tests that the geohash is kept in sync on the bulk write paths.
+    def test_geohash_kept_in_sync_on_bulk_writes(self):
+        """
+        Given locations written with bulk_create
+        When their coordinates are changed with bulk_update and update
+        Then their geohash should follow the new coordinates
+        """
+        # Given
+        Location.objects.bulk_create(
+            [
+                Location(character=self.main_character, timestamp="2020-01-01T00:00:00Z", lat="10", lon="10"),
+                Location(character=self.main_character, timestamp="2020-01-01T00:00:00Z", lat="20", lon="20"),
+            ]
+        )
+        first, second = Location.objects.order_by("lat")
+        assert first.geohash == encode_geohash(10, 10)
+
+        # When
+        first.lat = "-30"
+        Location.objects.bulk_update([first], ["lat"])
+        Location.objects.filter(pk=second.pk).update(lon="-40")
+
+        # Then
+        first.refresh_from_db()
+        second.refresh_from_db()
+        assert first.geohash == encode_geohash(-30, 10)
+        assert second.geohash == encode_geohash(20, -40)
+
+    # Tests that the R*Tree index follows inserts, updates and deletes.
+    def test_rtree_index_kept_in_sync(self):
+        """
+        Given the R*Tree index is available
+        When a location is created, moved and deleted
+        Then the index should hold its current coordinates and forget it once deleted
+        """
+        if not rtree_available():
+            self.skipTest("SQLite was built without the R*Tree module")
+
+        def indexed(location_id):
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT min_lat, min_lon FROM {RTREE_TABLE} WHERE id = %s", [location_id])
+                return cursor.fetchone()
+
+        # Given / When
+        location = Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="10",
+            lon="10",
+        )
+        assert indexed(location.id) == (10, 10)
+
+        Location.objects.filter(pk=location.pk).update(lat="-20")
+        assert indexed(location.id) == (-20, 10)
+
+        location.delete()
+
+        # Then
+        assert indexed(location.id) is None
+
+
+class TestLocationQueryPlans(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.main_character = Character.objects.create(
+            name="Walter White", date_of_birth="1970-11-01", occupation="Teacher"
+        )
+
+    def get_filtered_queryset(self, query):
+        view = LocationViewSet()
+        view.request = Request(APIRequestFactory().get("/locations/", query))
+        return view.filter_by_date_range(view.filter_by_character(Location.objects.all()))
+
+    # Tests that the character and date range filters are index range scans.
+    def test_history_filters_use_indexes(self):
+        """
+        Given the character and date range filters of the locations view
+        When the query plans of a character history and of a global date range are explained
+        Then both should be range searches on the timestamp indexes instead of scans
+        """
+        # Given
+        date_range = "2020-01-01T00:00:00Z,2021-01-01T00:00:00Z"
+
+        # When
+        history = self.get_filtered_queryset({"character": self.main_character.id, "date_range": date_range}).explain()
+        everyone = self.get_filtered_queryset({"date_range": date_range}).explain()
+
+        # Then
+        assert "USING INDEX location_character_ts_idx (character_id=? AND timestamp>? AND timestamp<?)" in history
+        assert "USING INDEX location_timestamp_idx (timestamp>? AND timestamp<?)" in everyone
+
+    # Tests that the spherical distance keys are computed from the precomputed sines and cosines.
+    def test_distance_keys_use_precomputed_trigonometry(self):
+        """
+        Given the SQL distance engine
+        When the queries of near searches with the cosines and haversine formulas are built
+        Then neither should convert or take the sine of the coordinates of every row
+        """
+        for formula in ("cosines", "haversine"):
+            with self.subTest(formula=formula):
+                # When
+                queryset = SQLDistanceEngine().near(Location.objects.all(), 10, 10, 1000, formula=formula)
+                where = str(queryset.query).split(" WHERE ", 1)[1]
+
+                # Then
+                assert "RADIANS(" not in where
+                assert not re.search(r"\bSIN\(", where)
+
+
+class TestLastLocation(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.main_character = Character.objects.create(
+            name="Walter White", date_of_birth="1970-11-01", occupation="Teacher"
+        )
+        cls.other_character = Character.objects.create(
+            name="Jesse Pinkman", date_of_birth="1984-09-24", occupation="Cook"
+        )
+
+    def create_location(self, timestamp, character=None):
+        return Location.objects.create(
+            character=character or self.main_character, timestamp=timestamp, lat="10", lon="10"
+        )
+
+    def last_location_id(self, character=None):
+        character = character or self.main_character
+        return LastLocation.objects.filter(character=character).values_list("location_id", flat=True).first()
+
+    # Tests that the last location follows newer locations and ignores older ones.
+    def test_last_location_follows_newest_timestamp(self):
+        """
+        Given locations of a character are written out of order
+        When the last location of the character is read
+        Then it should be the one with the greatest timestamp
+        """
+        # Given
+        self.create_location("2020-01-02T00:00:00Z")
+        newest = self.create_location("2020-01-03T00:00:00Z")
+        self.create_location("2020-01-01T00:00:00Z")
+
+        # When / Then
+        assert self.last_location_id() == newest.id
+
+    # Tests that the last location is repaired when locations are deleted, moved back in time or reassigned.
+    def test_last_location_repaired(self):
+        """
+        Given locations of a character exist
+        When the latest one is deleted, moved back in time or given to another character
+        Then the last location of every character should be looked up again
+        """
+        # Given
+        oldest = self.create_location("2020-01-01T00:00:00Z")
+        middle = self.create_location("2020-01-02T00:00:00Z")
+        newest = self.create_location("2020-01-03T00:00:00Z")
+
+        # When / Then
+        newest.delete()
+        assert self.last_location_id() == middle.id
+
+        middle.timestamp = "2019-01-01T00:00:00Z"
+        middle.save()
+        assert self.last_location_id() == oldest.id
+
+        oldest.character = self.other_character
+        oldest.save()
+        assert self.last_location_id() == middle.id
+        assert self.last_location_id(self.other_character) == oldest.id
+
+        middle.delete()
+        assert self.last_location_id() is None
+
+    # Tests that the bulk write paths keep the last location in sync.
+    def test_last_location_on_bulk_writes(self):
+        """
+        Given locations are bulk created
+        When they are bulk updated and updated through a queryset
+        Then the last location of every character should follow
+        """
+        # Given
+        locations = Location.objects.bulk_create(
+            Location(character=character, timestamp=timestamp, lat="10", lon="10")
+            for character, timestamp in [
+                (self.main_character, "2020-01-02T00:00:00Z"),
+                (self.main_character, "2020-01-03T00:00:00Z"),
+                (self.other_character, "2020-01-01T00:00:00Z"),
+            ]
+        )
+        assert self.last_location_id() == locations[1].id
+        assert self.last_location_id(self.other_character) == locations[2].id
+
+        # When / Then
+        locations[0].timestamp = "2020-01-04T00:00:00Z"
+        Location.objects.bulk_update([locations[0]], ["timestamp"])
+        assert self.last_location_id() == locations[0].id
+
+        Location.objects.filter(id=locations[0].id).update(character=self.other_character)
+        assert self.last_location_id() == locations[1].id
+        assert self.last_location_id(self.other_character) == locations[0].id
+
+    # Tests that bulk created locations are rolled back when their last location cannot be written.
+    def test_last_location_in_bulk_create_transaction(self):
+        """
+        Given advancing the last location of a character fails
+        When locations are bulk created
+        Then the locations should be rolled back with it
+        """
+        # Given
+        with mock.patch.object(
+            location_models.LastLocationManager, "advance_to", side_effect=RuntimeError("unexpected")
+        ), self.assertRaises(RuntimeError):
+            # When
+            Location.objects.bulk_create(
+                [Location(character=self.main_character, timestamp="2020-01-01T00:00:00Z", lat="10", lon="10")]
+            )
+
+        # Then
+        assert not Location.objects.exists()
+        assert self.last_location_id() is None
+
+
+class TestDensityRollup(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.main_character = Character.objects.create(
+            name="Walter White", date_of_birth="1970-11-01", occupation="Teacher"
+        )
+
+    @staticmethod
+    def rollups(step=1_000_000):
+        return sorted(
+            (hour.isoformat(), lat_index, lon_index, count)
+            for hour, lat_index, lon_index, count in DensityRollup.objects.filter(step=step).values_list(
+                "hour", "lat_index", "lon_index", "count"
+            )
+        )
+
+    @staticmethod
+    def rebuilt():
+        incremental = sorted(DensityRollup.objects.values_list("step", "hour", "lat_index", "lon_index", "count"))
+        call_command("rebuild_rollups", stdout=StringIO())
+        return incremental, sorted(DensityRollup.objects.values_list("step", "hour", "lat_index", "lon_index", "count"))
+
+    # Tests that the density rollups follow every write path of the locations.
+    def test_rollups_kept_in_sync(self):
+        """
+        Given locations are created, bulk created, moved, bulk updated, updated and deleted
+        When the density rollups are read after each write
+        Then they should count the locations of every cell and hour, and equal the rebuilt ones
+        """
+        # Given / When / Then
+        location = Location.objects.create(
+            character=self.main_character, timestamp="2020-01-01T10:30:00Z", lat="10.5", lon="-0.5"
+        )
+        assert self.rollups() == [("2020-01-01T10:00:00+00:00", 10, -1, 1)]
+        assert DensityRollup.objects.filter(step=10_000).values_list("lat_index", "lon_index").get() == (1050, -50)
+
+        others = Location.objects.bulk_create(
+            Location(character=self.main_character, timestamp=timestamp, lat=lat, lon=lon)
+            for timestamp, lat, lon in [
+                ("2020-01-01T10:59:59Z", "10.9", "-0.1"),
+                ("2020-01-01T11:00:00Z", "10.9", "-0.1"),
+            ]
+        )
+        assert self.rollups() == [("2020-01-01T10:00:00+00:00", 10, -1, 2), ("2020-01-01T11:00:00+00:00", 10, -1, 1)]
+
+        location.lat = "-20.5"
+        location.save()
+        assert self.rollups() == [
+            ("2020-01-01T10:00:00+00:00", -21, -1, 1),
+            ("2020-01-01T10:00:00+00:00", 10, -1, 1),
+            ("2020-01-01T11:00:00+00:00", 10, -1, 1),
+        ]
+
+        others[0].timestamp = "2020-01-01T11:30:00Z"
+        Location.objects.bulk_update([others[0]], ["timestamp"])
+        Location.objects.filter(id=location.id).update(lon="20")
+        assert self.rollups() == [("2020-01-01T10:00:00+00:00", -21, 20, 1), ("2020-01-01T11:00:00+00:00", 10, -1, 2)]
+
+        others[1].delete()
+        assert self.rollups() == [("2020-01-01T10:00:00+00:00", -21, 20, 1), ("2020-01-01T11:00:00+00:00", 10, -1, 1)]
+
+        incremental, rebuilt = self.rebuilt()
+        assert incremental == rebuilt
+        assert len(rebuilt) == 6
+
+
+@override_settings(LOCATIONS_CONTACTS=True)
+class TestContact(TestCase):
+    # Tests that the contacts recorded as locations are created equal the contacts recomputed from scratch.
+    def test_contacts_recorded_incrementally(self):
+        """
+        Given random locations of a few characters created one by one and in bulk, out of timestamp order
+        When the contacts are rebuilt from every location
+        Then they should equal the contacts recorded as the locations were created
+        """
+        # Given
+        characters = [
+            Character.objects.create(name=f"Character {i}", date_of_birth="1970-11-01", occupation="Cook")
+            for i in range(5)
+        ]
+        generator = random.Random(7)
+        locations = [
+            Location(
+                character=generator.choice(characters),
+                timestamp=f"2020-01-01T{generator.randrange(3):02d}:{generator.randrange(60):02d}:00Z",
+                lat=f"{10 + generator.randrange(20) * 0.0002:.6f}",
+                lon="10",
+            )
+            for _ in range(200)
+        ]
+        for location in locations[:20]:
+            location.save()
+        Location.objects.bulk_create(locations[20:120])
+        Location.objects.bulk_create(locations[120:])
+        recorded = sorted(Contact.objects.values_list("character", "contact", "first_seen", "last_seen", "count"))
+
+        # When
+        call_command("rebuild_contacts", stdout=StringIO())
+
+        # Then
+        rebuilt = sorted(Contact.objects.values_list("character", "contact", "first_seen", "last_seen", "count"))
+        assert len(rebuilt) == 20
+        assert recorded == rebuilt
+
+    # Tests that the locations probed for contacts are only those near the new locations.
+    def test_contact_probe_bounded(self):
+        """
+        Given locations at the same time spread over every longitude of a parallel
+        When a location is created in the middle of them
+        Then only the locations within the contact distance of it should be read, across the antimeridian too
+        """
+        # Given
+        walter, jesse = (
+            Character.objects.create(name=name, date_of_birth="1970-11-01", occupation="Cook")
+            for name in ["Walter White", "Jesse Pinkman"]
+        )
+        Location.objects.bulk_create(
+            Location(character=jesse, timestamp="2020-01-01T00:00:00Z", lat="10", lon=str(lon))
+            for lon in range(-180, 180)
+        )
+        probed = []
+
+        def points_of(queryset):
+            points = list(colocation.points_of(queryset))
+            probed.extend(point[0] for point in points)
+            return points
+
+        # When
+        with mock.patch.object(location_models, "points_of", points_of):
+            near = Location.objects.create(
+                character=walter, timestamp="2020-01-01T00:01:00Z", lat="10", lon="25.0001"
+            )
+            across = Location.objects.create(
+                character=walter, timestamp="2020-01-01T00:02:00Z", lat="10", lon="179.9999"
+            )
+
+        # Then
+        lons = sorted(float(lon) for lon in Location.objects.filter(id__in=probed).values_list("lon", flat=True))
+        assert lons == [-180.0, 25.0, 25.0001, 179.9999]
+        assert set(probed) >= {near.id, across.id}
+        assert Contact.objects.filter(character=walter).values_list("contact", "count").get() == (jesse.id, 2)
+
+    # Tests that the contacts of the locations moved or deleted are taken back.
+    def test_contacts_taken_back(self):
+        """
+        Given random locations of a few characters with their contacts recorded
+        When locations are moved, handed to other characters and deleted through every write path
+        Then the contact counts should equal the counts recomputed from scratch, without the pairs left with none
+        """
+        # Given
+        characters = [
+            Character.objects.create(name=f"Character {i}", date_of_birth="1970-11-01", occupation="Cook")
+            for i in range(5)
+        ]
+        generator = random.Random(11)
+        locations = Location.objects.bulk_create(
+            Location(
+                character=generator.choice(characters),
+                timestamp=f"2020-01-01T00:{generator.randrange(60):02d}:00Z",
+                lat=f"{10 + generator.randrange(20) * 0.0002:.6f}",
+                lon="10",
+            )
+            for _ in range(100)
+        )
+        gus, mike = (
+            Character.objects.create(name=name, date_of_birth="1970-11-01", occupation="Cook")
+            for name in ["Gus Fring", "Mike Ehrmantraut"]
+        )
+        Location.objects.create(character=gus, timestamp="2020-01-01T12:00:00Z", lat="40", lon="40")
+        met = Location.objects.create(character=mike, timestamp="2020-01-01T12:00:00Z", lat="40", lon="40")
+        assert Contact.objects.filter(character=gus, contact=mike).exists()
+
+        # When
+        Location.objects.filter(id__in=[location.id for location in locations[:10]]).update(lon="10.5")
+        for location in locations[10:20]:
+            location.lat = "11"
+        Location.objects.bulk_update(locations[10:20], ["lat"])
+        locations[20].timestamp = "2020-01-01T06:00:00Z"
+        locations[20].save()
+        locations[21].character = characters[4] if locations[21].character != characters[4] else characters[3]
+        locations[21].save(update_fields=["character"])
+        Location.objects.filter(id__in=[location.id for location in locations[30:40]]).delete()
+        locations[40].delete()
+        met.delete()
+        recorded = sorted(Contact.objects.values_list("character", "contact", "count"))
+
+        # Then
+        call_command("rebuild_contacts", stdout=StringIO())
+        assert recorded == sorted(Contact.objects.values_list("character", "contact", "count"))
+        assert not Contact.objects.filter(character__in=[gus, mike]).exists()
+
+
+class TestGeofenceEvent(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.characters = [
+            Character.objects.create(name=name, date_of_birth="1970-11-01", occupation="Cook")
+            for name in ["Walter White", "Jesse Pinkman"]
+        ]
+        cls.circle = Geofence.objects.create(name="Car wash", kind=CIRCLE, lat="10", lon="10", radius=1000)
+        cls.square = Geofence.objects.create(
+            name="Lab", kind=POLYGON, polygon=[[10, 10], [10, 10.1], [10.1, 10.1], [10.1, 10]]
+        )
+
+    def setUp(self):
+        geofence_index.clear()
+        self.addCleanup(geofence_index.clear)
+
+    def events(self):
+        return list(
+            GeofenceEvent.objects.order_by("timestamp", "id").values_list("fence", "character", "kind", "timestamp__hour")
+        )
+
+    # Tests that the geofences entered and left are recorded as locations are created, in timestamp order.
+    def test_events_recorded_on_create(self):
+        """
+        Given a circle and a square overlapping at one corner
+        When locations of two characters are created one by one and in bulk, moving in and out of them, and one out of order
+        Then an event should be recorded for every fence entered or left, following the timestamps, the late location ignored
+        """
+        walter, jesse = self.characters
+
+        # Given / When
+        Location.objects.create(character=walter, timestamp="2020-01-01T01:00:00Z", lat="0", lon="0")
+        Location.objects.create(character=walter, timestamp="2020-01-01T02:00:00Z", lat="10.001", lon="10.001")
+        Location.objects.bulk_create(
+            [
+                Location(character=walter, timestamp="2020-01-01T04:00:00Z", lat="0", lon="0"),
+                Location(character=jesse, timestamp="2020-01-01T05:00:00Z", lat="10.05", lon="10.05"),
+                Location(character=walter, timestamp="2020-01-01T03:00:00Z", lat="10.05", lon="10.05"),
+            ]
+        )
+        Location.objects.create(character=walter, timestamp="2020-01-01T00:00:00Z", lat="10", lon="10")
+
+        # Then
+        assert self.events() == [
+            (self.circle.id, walter.id, GeofenceEvent.ENTER, 2),
+            (self.square.id, walter.id, GeofenceEvent.ENTER, 2),
+            (self.circle.id, walter.id, GeofenceEvent.EXIT, 3),
+            (self.square.id, walter.id, GeofenceEvent.EXIT, 4),
+            (self.square.id, jesse.id, GeofenceEvent.ENTER, 5),
+        ]
+        assert GeofenceEvent.objects.filter(location__isnull=True).count() == 0
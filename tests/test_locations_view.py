@@ -1,7 +1,12 @@
+import json
+
+from django.test import override_settings
 from rest_framework.test import APITestCase
 from rest_framework import status
 
+from locations.geofences import geofence_index
 from locations.models import Location
+from locations.tiles import tile_cache
 from characters.models import Character
 
 
@@ -291,3 +296,692 @@ class TestLocationViewSet(APITestCase):
         # Then
         assert response.status_code == status.HTTP_404_NOT_FOUND
         assert "Not found." in response.data["detail"]
+
+    # Tests that locations within the distance are returned ordered by distance.
+    def test_near_locations_successfully(self):
+        """
+        Given multiple locations exist in the database
+        When a GET request is made to locations/near with valid query parameters
+        Then the response should have a status code of 200 and contain only the locations within the distance
+        """
+        # Given
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="10.01",
+            lon="10",
+        )
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="10",
+            lon="10",
+        )
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="11",
+            lon="10",
+        )
+        url = "/locations/near/?coordinates=10,10&distance=5000"
+
+        # When
+        response = self.client.get(url)
+
+        # Then
+        assert response.status_code == status.HTTP_200_OK
+        assert [location["lat"] for location in response.data["results"]] == ["10.000000", "10.010000"]
+
+    # Tests that the search circle is not cut off at the antimeridian.
+    def test_near_locations_across_antimeridian(self):
+        """
+        Given locations exist on both sides of the antimeridian
+        When a GET request is made to locations/near with coordinates next to the antimeridian
+        Then the response should contain the locations on both sides
+        """
+        # Given
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="0",
+            lon="179.999",
+        )
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="0",
+            lon="-179.999",
+        )
+        url = "/locations/near/?coordinates=0,179.9995&distance=1000&ascending=0"
+
+        # When
+        response = self.client.get(url)
+
+        # Then
+        assert response.status_code == status.HTTP_200_OK
+        assert [location["lon"] for location in response.data["results"]] == ["-179.999000", "179.999000"]
+
+    # Tests that every longitude is considered when the search circle contains a pole.
+    def test_near_locations_around_pole(self):
+        """
+        Given locations exist near the north pole at opposite longitudes
+        When a GET request is made to locations/near with a circle containing the pole
+        Then the response should contain the locations at every longitude
+        """
+        # Given
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="89.99",
+            lon="0",
+        )
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="89.99",
+            lon="180",
+        )
+        url = "/locations/near/?coordinates=89.995,90&distance=5000"
+
+        # When
+        response = self.client.get(url)
+
+        # Then
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data["results"]) == 2
+
+    # Tests that the near query gives the same results without the R*Tree index.
+    @override_settings(LOCATIONS_RTREE_INDEX=False)
+    def test_near_locations_without_rtree_index(self):
+        """
+        Given the R*Tree index is disabled
+        When a GET request is made to locations/near with valid query parameters
+        Then the response should contain only the locations within the distance
+        """
+        # Given
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="10",
+            lon="10",
+        )
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="11",
+            lon="10",
+        )
+        url = "/locations/near/?coordinates=10,10&distance=5000"
+
+        # When
+        response = self.client.get(url)
+
+        # Then
+        assert response.status_code == status.HTTP_200_OK
+        assert [location["lat"] for location in response.data["results"]] == ["10.000000"]
+
+    # Tests that near queries with a date range only return the locations within it, with every spatial index.
+    def test_near_locations_in_date_range(self):
+        """
+        Given locations at the same coordinates in several months
+        When GET requests are made to locations/near with a date range, with and without the R*Tree index
+        Then the response should only contain the locations recorded within the date range
+        """
+        # Given
+        for timestamp in ["2020-01-15T00:00:00Z", "2020-02-15T00:00:00Z", "2020-03-15T00:00:00Z", "2021-02-15T00:00:00Z"]:
+            Location.objects.create(character=self.main_character, timestamp=timestamp, lat="10", lon="10")
+        url = "/locations/near/?coordinates=10,10&distance=5000&date_range=2020-02-01T00:00:00Z,2020-03-31T00:00:00Z"
+
+        for use_rtree in (True, False):
+            with self.subTest(use_rtree=use_rtree), override_settings(LOCATIONS_RTREE_INDEX=use_rtree):
+                # When
+                response = self.client.get(url)
+
+                # Then
+                assert response.status_code == status.HTTP_200_OK
+                assert sorted(location["timestamp"] for location in response.data["results"]) == [
+                    "2020-02-15T00:00:00Z",
+                    "2020-03-15T00:00:00Z",
+                ]
+
+    # Tests that the k closest locations are returned ordered by distance.
+    def test_nearest_locations_successfully(self):
+        """
+        Given locations exist in the database at growing distances, for two characters
+        When a GET request is made to locations/nearest with a character filter
+        Then the response should contain the k closest locations of that character ordered by distance
+        """
+        # Given
+        other_character = Character.objects.create(
+            name="Jesse Pinkman", date_of_birth="1984-09-24", occupation="Cook"
+        )
+        Location.objects.create(
+            character=other_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="10",
+            lon="10",
+        )
+        for lat in ("-60", "10.5", "10.001", "30"):
+            Location.objects.create(
+                character=self.main_character,
+                timestamp="2020-01-01T00:00:00Z",
+                lat=lat,
+                lon="10",
+            )
+        url = f"/locations/nearest/?coordinates=10,10&k=3&character={self.main_character.id}"
+
+        # When
+        response = self.client.get(url)
+
+        # Then
+        assert response.status_code == status.HTTP_200_OK
+        assert [location["lat"] for location in response.data] == ["10.001000", "10.500000", "30.000000"]
+
+    # Tests that an error is returned when invalid query parameters are used to nearest locations.
+    def test_nearest_locations_with_invalid_query_params(self):
+        """
+        Given the nearest endpoint
+        When a GET request is made to locations/nearest without `k`
+        Then the response should have a status code of 400 and contain an error message
+        """
+        # When
+        response = self.client.get("/locations/nearest/?coordinates=10,10")
+
+        # Then
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "The query parameters `coordinates` and `k` are obligatory" in response.data["detail"]
+
+    # Tests that many near queries can be answered in a single request.
+    def test_near_batch_locations_successfully(self):
+        """
+        Given multiple locations exist in the database
+        When a POST request is made to locations/near/batch with several queries
+        Then the response should contain the locations found for each query, in the order of the queries
+        """
+        # Given
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="10",
+            lon="10",
+        )
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2022-01-01T00:00:00Z",
+            lat="10.01",
+            lon="10",
+        )
+        Location.objects.create(
+            character=self.main_character,
+            timestamp="2020-01-01T00:00:00Z",
+            lat="-30",
+            lon="-60",
+        )
+        data = [
+            {"coordinates": "10,10", "distance": 5000, "ascending": False},
+            {"coordinates": "10,10", "distance": 5000, "date_range": "2019-01-01T00:00:00Z,2021-01-01T00:00:00Z"},
+            {"coordinates": "-30,-60", "distance": 10, "character": self.main_character.id},
+            {"coordinates": "0,0", "distance": 10},
+        ]
+
+        # When
+        response = self.client.post("/locations/near/batch/", data=data, format="json")
+
+        # Then
+        assert response.status_code == status.HTTP_200_OK
+        assert [[location["lat"] for location in result["locations"]] for result in response.data] == [
+            ["10.010000", "10.000000"],
+            ["10.000000"],
+            ["-30.000000"],
+            [],
+        ]
+
+    # Tests that an error is returned when a query of the batch is invalid.
+    def test_near_batch_locations_with_invalid_query(self):
+        """
+        Given a batch with a query missing its distance
+        When a POST request is made to locations/near/batch
+        Then the response should have a status code of 400 and contain an error message
+        """
+        # Given
+        data = [{"coordinates": "10,10"}]
+
+        # When
+        response = self.client.post("/locations/near/batch/", data=data, format="json")
+
+        # Then
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "This field is required." in response.data["detail"][0]["distance"]
+
+    # Tests that locations can be created in bulk from JSON, NDJSON and CSV bodies.
+    def test_bulk_create_locations_successfully(self):
+        """
+        Given locations as a JSON array, NDJSON and CSV, some of them invalid
+        When POST requests are made to locations/bulk
+        Then the valid locations should be created and the invalid rows reported with their index
+        """
+        # Given
+        character_id = self.main_character.id
+        rows = [
+            {"character": character_id, "timestamp": "2020-01-01T00:00:00Z", "lat": "10", "lon": "10"},
+            {"character": character_id + 100, "timestamp": "2020-01-01T00:00:00Z", "lat": "10", "lon": "10"},
+            {"character": character_id, "lat": "10.1234567", "lon": "10"},
+            {"character": character_id, "timestamp": "2020-01-02T00:00:00Z", "lat": "11", "lon": "11"},
+        ]
+        ndjson = "\n".join(json.dumps(row) for row in rows[:1]) + "\n\n"
+        csv = f"character,timestamp,lat,lon\n{character_id},2020-01-03T00:00:00Z,12,12\n{character_id},yesterday,12,12\n"
+
+        # When
+        response = self.client.post("/locations/bulk/", data=rows, format="json")
+        ndjson_response = self.client.post("/locations/bulk/", data=ndjson, content_type="application/x-ndjson")
+        csv_response = self.client.post("/locations/bulk/", data=csv, content_type="text/csv")
+
+        # Then
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.data["created"] == 2
+        assert [error["index"] for error in response.data["errors"]] == [1, 2]
+        assert "object does not exist" in response.data["errors"][0]["errors"]["character"][0]
+        assert set(response.data["errors"][1]["errors"]) == {"timestamp", "lat"}
+        assert ndjson_response.data == {"created": 1, "errors": []}
+        assert csv_response.data["created"] == 1
+        assert [error["index"] for error in csv_response.data["errors"]] == [1]
+        assert Location.objects.filter(character=self.main_character).count() == 4
+        assert self.main_character.last_location.timestamp.isoformat() == "2020-01-03T00:00:00+00:00"
+
+    # Tests that an error is returned when a bulk body is not a list of valid locations.
+    def test_bulk_create_locations_with_invalid_data(self):
+        """
+        Given bodies that are not lists, not parsable or without any valid location
+        When POST requests are made to locations/bulk
+        Then the responses should have a status code of 400
+        """
+        # When
+        responses = [
+            self.client.post("/locations/bulk/", data={"character": 1}, format="json"),
+            self.client.post("/locations/bulk/", data="{\n", content_type="application/x-ndjson"),
+            self.client.post("/locations/bulk/", data=[{"character": 1}], format="json"),
+        ]
+
+        # Then
+        assert [response.status_code for response in responses] == [status.HTTP_400_BAD_REQUEST] * 3
+        assert Location.objects.count() == 0
+
+    # Tests that locations are counted per grid cell.
+    def test_heatmap_successfully(self):
+        """
+        Given locations of two characters spread over a few cells, on both sides of the antimeridian
+        When GET requests are made to locations/heatmap over a bounding box, across the antimeridian and per character
+        Then the response should contain the count of locations of each non empty cell
+        """
+        # Given
+        other_character = Character.objects.create(
+            name="Jesse Pinkman", date_of_birth="1984-09-24", occupation="Cook"
+        )
+        for character, lat, lon in [
+            (self.main_character, "10.2", "10.2"),
+            (self.main_character, "10.7", "10.9"),
+            (other_character, "10.5", "10.5"),
+            (self.main_character, "-0.5", "11.5"),
+            (self.main_character, "30", "30"),
+            (self.main_character, "0.5", "179.5"),
+            (other_character, "0.5", "-179.5"),
+        ]:
+            Location.objects.create(character=character, timestamp="2020-01-01T00:00:00Z", lat=lat, lon=lon)
+
+        # When
+        response = self.client.get("/locations/heatmap/?bbox=-1,9,11,12&cell=1")
+        per_character = self.client.get(
+            f"/locations/heatmap/?bbox=-1,9,11,12&cell=1&per_character=1&character={other_character.id}"
+        )
+        antimeridian = self.client.get("/locations/heatmap/?bbox=0,179,1,-179&cell=0.5")
+
+        # Then
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data["cells"] == [
+            {"lat": -1.0, "lon": 11.0, "count": 1},
+            {"lat": 10.0, "lon": 10.0, "count": 3},
+        ]
+        assert per_character.data["cells"] == [{"lat": 10.0, "lon": 10.0, "count": 1, "character": other_character.id}]
+        assert antimeridian.data["cells"] == [
+            {"lat": 0.5, "lon": -179.5, "count": 1},
+            {"lat": 0.5, "lon": 179.5, "count": 1},
+        ]
+
+    # Tests that the heatmap read from the density rollups counts the same locations as the raw one.
+    def test_heatmap_from_rollups(self):
+        """
+        Given locations spread over a few hours and cells
+        When heatmaps are requested over date ranges starting and ending within hours, from the rollups and from the locations
+        Then both should count the same locations, those of the partial hours included
+        """
+        # Given
+        for timestamp, lat, lon in [
+            ("2020-01-01T09:59:59Z", "10.25", "10.25"),
+            ("2020-01-01T10:15:00Z", "10.25", "10.25"),
+            ("2020-01-01T11:00:00Z", "10.75", "10.25"),
+            ("2020-01-01T12:30:00Z", "10.75", "10.75"),
+            ("2020-01-01T13:45:00Z", "10.25", "10.75"),
+            ("2020-01-01T14:00:00Z", "-10.3", "-10.3"),
+        ]:
+            Location.objects.create(character=self.main_character, timestamp=timestamp, lat=lat, lon=lon)
+
+        # When
+        responses = {}
+        for date_range in ["2020-01-01T10:10:00Z,2020-01-01T13:50:00Z", "2020-01-01T10:00:00Z,2020-01-01T12:30:00Z"]:
+            url = f"/locations/heatmap/?bbox=-11,-11,11,11&cell=0.5&date_range={date_range}"
+            responses[date_range] = (
+                self.client.get(url).data["cells"],
+                self.client.get(f"{url}&character={self.main_character.id}").data["cells"],
+            )
+        everything = self.client.get("/locations/heatmap/?cell=10").data["cells"]
+
+        # Then
+        for rollups, locations in responses.values():
+            assert rollups == locations
+        assert responses["2020-01-01T10:10:00Z,2020-01-01T13:50:00Z"][0] == [
+            {"lat": 10.0, "lon": 10.0, "count": 1},
+            {"lat": 10.0, "lon": 10.5, "count": 1},
+            {"lat": 10.5, "lon": 10.0, "count": 1},
+            {"lat": 10.5, "lon": 10.5, "count": 1},
+        ]
+        assert everything == [{"lat": -20.0, "lon": -20.0, "count": 1}, {"lat": 10.0, "lon": 10.0, "count": 5}]
+
+    # Tests that an error is returned when invalid query parameters are used to get a heatmap.
+    def test_heatmap_with_invalid_query_params(self):
+        """
+        Given the heatmap endpoint
+        When GET requests are made without a cell, with an invalid bounding box, too many cells or a cell below a microdegree
+        Then the responses should have a status code of 400
+        """
+        # When
+        responses = [
+            self.client.get("/locations/heatmap/"),
+            self.client.get("/locations/heatmap/?cell=1&bbox=10,10,0,20"),
+            self.client.get("/locations/heatmap/?cell=0.0001"),
+            self.client.get("/locations/heatmap/?cell=0.0000001&bbox=0,0,1,1"),
+        ]
+
+        # Then
+        assert [response.status_code for response in responses] == [status.HTTP_400_BAD_REQUEST] * 4
+
+
+def read_message(data: bytes) -> dict:
+    """
+    Decodes the fields of a protobuf message, as lists of integers or of undecoded bytes
+    """
+
+    def varint(position):
+        value, shift = 0, 0
+        while True:
+            byte = data[position]
+            value |= (byte & 0x7F) << shift
+            position, shift = position + 1, shift + 7
+            if not byte & 0x80:
+                return value, position
+
+    fields, position = {}, 0
+    while position < len(data):
+        key, position = varint(position)
+        if key & 7 == 0:
+            value, position = varint(position)
+        else:
+            length, position = varint(position)
+            value, position = data[position:position + length], position + length
+        fields.setdefault(key >> 3, []).append(value)
+    return fields
+
+
+class TestLocationTiles(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.main_character = Character.objects.create(
+            name="Walter White", date_of_birth="1970-11-01", occupation="Teacher"
+        )
+
+    def setUp(self):
+        tile_cache.clear()
+        self.addCleanup(tile_cache.clear)
+
+    def features(self, url):
+        response = self.client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response["Content-Type"] == "application/vnd.mapbox-vector-tile"
+        layer = read_message(read_message(response.content)[3][0])
+        assert layer[1] == [b"locations"] and layer[5] == [4096]
+        counts = [read_message(value)[5][0] for value in layer.get(4, [])]
+        features = []
+        for feature in layer.get(2, []):
+            feature = read_message(feature)
+            features.append((feature.get(1, [None])[0], counts[feature[2][0][1]]))
+        return sorted(features, key=lambda feature: (feature[0] is None, feature))
+
+    # Tests that the locations of a tile are encoded as vector tile points, from the cache until they change.
+    def test_tile_successfully(self):
+        """
+        Given locations of two characters, two of them at the same place
+        When vector tiles are requested, filtered, again and after a location of the tile moved
+        Then the points of the tile should be encoded, cached, and evicted once the location moved
+        """
+        # Given
+        other_character = Character.objects.create(
+            name="Jesse Pinkman", date_of_birth="1984-09-24", occupation="Cook"
+        )
+        first = Location.objects.create(
+            character=self.main_character, timestamp="2020-01-01T00:00:00Z", lat="10", lon="10"
+        )
+        shared = Location.objects.create(
+            character=other_character, timestamp="2020-02-01T00:00:00Z", lat="10", lon="10"
+        )
+        single = Location.objects.create(
+            character=self.main_character, timestamp="2020-01-01T00:00:00Z", lat="20", lon="20"
+        )
+        south = Location.objects.create(
+            character=self.main_character, timestamp="2020-01-01T00:00:00Z", lat="-20", lon="20"
+        )
+
+        # When / Then
+        assert self.features("/locations/tiles/1/1/0.mvt") == [(single.id, 1), (None, 2)]
+        assert self.features(f"/locations/tiles/1/1/0.mvt?character={self.main_character.id}") == [
+            (first.id, 1),
+            (single.id, 1),
+        ]
+        assert self.features("/locations/tiles/1/1/0.mvt?date_range=2020-02-01T00:00:00Z,2020-03-01T00:00:00Z") == [
+            (shared.id, 1)
+        ]
+        assert self.features("/locations/tiles/4/8/8.mvt") == [(south.id, 1)]
+        assert self.features("/locations/tiles/4/0/0.mvt") == []
+
+        with self.assertNumQueries(0):
+            assert self.features("/locations/tiles/1/1/0.mvt") == [(single.id, 1), (None, 2)]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.lat = "-10"
+            first.save()
+        assert self.features("/locations/tiles/1/1/0.mvt") == [(shared.id, 1), (single.id, 1)]
+        assert self.features("/locations/tiles/4/8/8.mvt") == [(first.id, 1), (south.id, 1)]
+
+    # Tests that an error is returned when a tile does not exist.
+    def test_tile_with_invalid_coordinates(self):
+        """
+        Given the vector tile endpoint
+        When tiles beyond the maximum zoom or outside of their zoom are requested
+        Then the responses should have a status code of 400
+        """
+        # When
+        responses = [
+            self.client.get("/locations/tiles/23/0/0.mvt"),
+            self.client.get("/locations/tiles/1/2/0.mvt"),
+            self.client.get("/locations/tiles/1/0/2.mvt"),
+        ]
+
+        # Then
+        assert [response.status_code for response in responses] == [status.HTTP_400_BAD_REQUEST] * 3
+
+
+class TestColocations(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.characters = [
+            Character.objects.create(name=name, date_of_birth="1970-11-01", occupation="Cook")
+            for name in ["Walter White", "Jesse Pinkman", "Gustavo Fring", "Saul Goodman"]
+        ]
+
+    def create_location(self, character, timestamp, lat, lon):
+        Location.objects.create(character=self.characters[character], timestamp=timestamp, lat=lat, lon=lon)
+
+    # Tests that the characters that met are found with their meeting times.
+    def test_colocations_successfully(self):
+        """
+        Given characters meeting close in space and time, others close in space only, and a meeting across the antimeridian
+        When GET requests are made to locations/colocations, for every character and for one of them
+        Then the pairs that met within the distance and time window should be returned with their meeting times
+        """
+        # Given
+        self.create_location(0, "2020-01-01T10:00:00Z", "10", "10")
+        self.create_location(1, "2020-01-01T10:04:00Z", "10.0003", "10")
+        self.create_location(1, "2020-01-01T10:20:00Z", "10.0003", "10")
+        self.create_location(0, "2020-01-01T10:24:00Z", "10", "10.0001")
+        self.create_location(2, "2020-01-01T12:00:00Z", "10", "10")
+        self.create_location(2, "2020-01-02T00:00:00Z", "0", "179.9999")
+        self.create_location(3, "2020-01-02T00:01:00Z", "0", "-179.9999")
+
+        # When
+        response = self.client.get("/locations/colocations/?distance=50&time_window=5")
+        for_character = self.client.get(
+            f"/locations/colocations/?distance=50&time_window=5&character={self.characters[3].id}"
+        )
+        within_range = self.client.get(
+            "/locations/colocations/?distance=50&time_window=5&date_range=2020-01-01T10:10:00Z,2020-01-01T23:00:00Z"
+        )
+
+        # Then
+        assert response.status_code == status.HTTP_200_OK
+        pairs = [
+            (pair["character_a"], pair["character_b"], pair["first_seen"], pair["last_seen"], pair["meetings"])
+            for pair in response.json()["pairs"]
+        ]
+        ids = [character.id for character in self.characters]
+        assert pairs == [
+            (ids[0], ids[1], "2020-01-01T10:00:00Z", "2020-01-01T10:24:00Z", 2),
+            (ids[2], ids[3], "2020-01-02T00:00:00Z", "2020-01-02T00:01:00Z", 1),
+        ]
+        assert 33 < response.data["pairs"][0]["closest"] < 34
+        assert [(pair["character_a"], pair["character_b"]) for pair in for_character.data["pairs"]] == [(ids[2], ids[3])]
+        assert [pair["meetings"] for pair in within_range.data["pairs"]] == [1]
+
+    # Tests that an error is returned when invalid query parameters are used to find co-locations.
+    def test_colocations_with_invalid_query_params(self):
+        """
+        Given the co-locations endpoint
+        When GET requests are made without a distance or time window, or with values out of range
+        Then the responses should have a status code of 400
+        """
+        # When
+        responses = [
+            self.client.get("/locations/colocations/?distance=50"),
+            self.client.get("/locations/colocations/?time_window=5"),
+            self.client.get("/locations/colocations/?distance=100000&time_window=5"),
+            self.client.get("/locations/colocations/?distance=50&time_window=-1"),
+            self.client.get("/locations/colocations/?distance=50&time_window=5&character=walter"),
+        ]
+
+        # Then
+        assert [response.status_code for response in responses] == [status.HTTP_400_BAD_REQUEST] * 5
+
+
+class TestGeofences(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.characters = [
+            Character.objects.create(name=name, date_of_birth="1970-11-01", occupation="Cook")
+            for name in ["Walter White", "Jesse Pinkman"]
+        ]
+
+    def setUp(self):
+        geofence_index.clear()
+        self.addCleanup(geofence_index.clear)
+
+    def create_location(self, character, timestamp, lat, lon):
+        response = self.client.post(
+            "/locations/",
+            {"character": self.characters[character].id, "timestamp": timestamp, "lat": lat, "lon": lon},
+            format="json",
+        )
+        assert response.status_code == status.HTTP_201_CREATED
+
+    # Tests that the entries and exits of geofences created through the API can be queried.
+    def test_geofence_events_successfully(self):
+        """
+        Given a circle and a polygon created through the API
+        When characters move in and out of them and GET requests are made to geofences/events with filters and pages
+        Then the events should be returned in timestamp order, filtered by fence, character and date range
+        """
+        # Given
+        with self.captureOnCommitCallbacks(execute=True):
+            circle = self.client.post(
+                "/geofences/", {"name": "Car wash", "kind": "circle", "lat": "10", "lon": "10", "radius": 500}, format="json"
+            )
+            polygon = self.client.post(
+                "/geofences/",
+                {"name": "Desert", "kind": "polygon", "polygon": [[20, 20], [20, 21], [21, 20]]},
+                format="json",
+            )
+        assert circle.status_code == polygon.status_code == status.HTTP_201_CREATED
+        circle, polygon = circle.data["id"], polygon.data["id"]
+
+        # When
+        self.create_location(0, "2020-01-01T00:00:00Z", "10.001", "10")
+        self.create_location(1, "2020-01-01T01:00:00Z", "20.1", "20.1")
+        self.create_location(0, "2020-01-01T02:00:00Z", "20.2", "20.2")
+        self.create_location(1, "2020-01-01T03:00:00Z", "0", "0")
+        every_event = self.client.get("/geofences/events/")
+        for_fence = self.client.get(f"/geofences/events/?fence={polygon}")
+        for_character = self.client.get(f"/geofences/events/?character={self.characters[0].id}")
+        within_range = self.client.get("/geofences/events/?date_range=2020-01-01T01:30:00Z,2020-01-01T04:00:00Z")
+        first_page = self.client.get("/geofences/events/?page_size=3")
+        next_page = self.client.get(first_page.data["next"])
+
+        # Then
+        assert every_event.status_code == status.HTTP_200_OK
+        walter, jesse = (character.id for character in self.characters)
+        assert [(event["fence"], event["character"], event["kind"]) for event in every_event.data["results"]] == [
+            (circle, walter, "enter"),
+            (polygon, jesse, "enter"),
+            (circle, walter, "exit"),
+            (polygon, walter, "enter"),
+            (polygon, jesse, "exit"),
+        ]
+        assert every_event.data["next"] is None
+        assert [event["character"] for event in for_fence.data["results"]] == [jesse, walter, jesse]
+        assert [event["kind"] for event in for_character.data["results"]] == ["enter", "exit", "enter"]
+        assert [event["timestamp"] for event in within_range.data["results"]] == [
+            "2020-01-01T02:00:00Z", "2020-01-01T02:00:00Z", "2020-01-01T03:00:00Z"
+        ]
+        assert first_page.data["results"] + next_page.data["results"] == every_event.data["results"]
+        assert next_page.data["next"] is None
+
+    # Tests that an error is returned when invalid geofences are created or invalid filters are used.
+    def test_geofences_with_invalid_params(self):
+        """
+        Given the geofences endpoints
+        When circles without a radius, polygons with too few or invalid vertices, or events with invalid filters are requested
+        Then the responses should have a status code of 400
+        """
+        # When
+        responses = [
+            self.client.post("/geofences/", {"name": "A", "kind": "circle", "lat": "10", "lon": "10"}, format="json"),
+            self.client.post(
+                "/geofences/", {"name": "A", "kind": "circle", "lat": "10", "lon": "10", "radius": 0}, format="json"
+            ),
+            self.client.post("/geofences/", {"name": "A", "kind": "polygon", "polygon": [[0, 0], [1, 1]]}, format="json"),
+            self.client.post(
+                "/geofences/", {"name": "A", "kind": "polygon", "polygon": [[0, 0], [1, 1], [91, 0]]}, format="json"
+            ),
+            self.client.post("/geofences/", {"name": "A", "kind": "polygon", "polygon": "0,0"}, format="json"),
+            self.client.get("/geofences/events/?fence=first"),
+            self.client.get("/geofences/events/?date_range=2020-01-01"),
+            self.client.get("/geofences/events/?page_size=0"),
+        ]
+
+        # Then
+        assert [response.status_code for response in responses] == [status.HTTP_400_BAD_REQUEST] * len(responses)
@@ -0,0 +1,231 @@
+import json
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+
+from django.db import OperationalError
+from django.test import SimpleTestCase, override_settings
+from rest_framework import status
+from rest_framework.test import APITransactionTestCase
+
+from characters.models import Character
+from locations.models import Location
+from locations import write_behind
+from locations.write_behind import AppendLog, WriteBehindBuffer, write_behind_buffer
+
+
+@override_settings(LOCATIONS_WRITE_BEHIND=True, LOCATIONS_WRITE_BEHIND_FLUSH_INTERVAL=0.01)
+class TestWriteBehindBuffer(APITransactionTestCase):
+    # The flusher thread writes through its own connection, so the data must be committed
+    def setUp(self):
+        self.main_character = Character.objects.create(
+            name="Walter White", date_of_birth="1970-11-01", occupation="Teacher"
+        )
+        self.addCleanup(write_behind_buffer.stop)
+
+    def location_data(self, timestamp="2020-01-01T00:00:00Z"):
+        return {"character": self.main_character.id, "timestamp": timestamp, "lat": "10", "lon": "10"}
+
+    # Tests that created locations are queued and written in the background.
+    def test_create_location_write_behind(self):
+        """
+        Given the write-behind buffer is enabled
+        When POST requests are made to create locations
+        Then the responses should have a status code of 202 and the locations should be written shortly after
+        """
+        # When
+        responses = [
+            self.client.post("/locations/", data=self.location_data(f"2020-01-0{day}T00:00:00Z")) for day in range(1, 4)
+        ]
+        write_behind_buffer.join()
+        metrics = self.client.get("/locations/buffer/metrics/")
+
+        # Then
+        assert [response.status_code for response in responses] == [status.HTTP_202_ACCEPTED] * 3
+        assert responses[0].data["lat"] == "10.000000"
+        assert Location.objects.count() == 3
+        assert self.main_character.last_location.timestamp.isoformat() == "2020-01-03T00:00:00+00:00"
+        assert metrics.data["queued"] == metrics.data["written"] == 3
+        assert metrics.data["depth"] == 0
+
+    # Tests that locations are rejected when the buffer is full.
+    @override_settings(LOCATIONS_WRITE_BEHIND_MAX_SIZE=2)
+    def test_create_location_with_full_buffer(self):
+        """
+        Given the write-behind buffer is enabled and nothing is taken out of it
+        When more locations than it holds are created
+        Then the locations above its capacity should be rejected with a status code of 429
+        """
+        with mock.patch.object(WriteBehindBuffer, "_take", return_value=[]):
+            # When
+            responses = [self.client.post("/locations/", data=self.location_data()) for _ in range(3)]
+            metrics = write_behind_buffer.metrics()
+
+        # Then
+        assert [response.status_code for response in responses] == [
+            status.HTTP_202_ACCEPTED,
+            status.HTTP_202_ACCEPTED,
+            status.HTTP_429_TOO_MANY_REQUESTS,
+        ]
+        assert responses[2]["Retry-After"] == "1"
+        assert metrics["depth"] == 2
+        assert metrics["rejected"] == 1
+
+    # Tests that the locations left in the append log are written on start, and the log cleaned up.
+    def test_replay_append_log(self):
+        """
+        Given an append log with locations a crashed process did not write, the last line truncated
+        When the write-behind buffer is started and a location is created
+        Then every complete logged location should be written and the log segments deleted
+        """
+        # Given
+        directory = tempfile.mkdtemp()
+        Path(directory, "crashed").mkdir()
+        Path(directory, "crashed", "000000000001.ndjson").write_text(json.dumps(self.location_data()) + '\n{"charac')
+
+        with override_settings(LOCATIONS_WRITE_BEHIND_LOG_DIR=directory):
+            # When
+            response = self.client.post("/locations/", data=self.location_data("2020-01-02T00:00:00Z"))
+            write_behind_buffer.join()
+            write_behind_buffer.stop()
+
+        # Then
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert Location.objects.count() == 2
+        assert list(Path(directory).iterdir()) == []
+
+    # Tests that the locations are still written after the replay and a flush failed once.
+    def test_write_after_failures(self):
+        """
+        Given an append log with a location, and writes failing once on a locked database and once on an unexpected error
+        When the write-behind buffer is started and locations are created
+        Then every location should be written and the flusher should keep running
+        """
+        # Given
+        directory = tempfile.mkdtemp()
+        Path(directory, "crashed").mkdir()
+        Path(directory, "crashed", "000000000001.ndjson").write_text(json.dumps(self.location_data()) + "\n")
+        # The replay fails once, then the first flush
+        failures = [OperationalError("database is locked"), None, RuntimeError("unexpected")]
+        write = write_behind.ingest
+
+        def ingest(*args, **kwargs):
+            failure = failures.pop(0) if failures else None
+            if failure is not None:
+                raise failure
+            return write(*args, **kwargs)
+
+        with override_settings(LOCATIONS_WRITE_BEHIND_LOG_DIR=directory), mock.patch.object(
+            write_behind, "ingest", ingest
+        ), self.assertLogs("locations.write_behind", level="WARNING") as logs:
+            # When
+            responses = [
+                self.client.post("/locations/", data=self.location_data(f"2020-01-0{day}T00:00:00Z"))
+                for day in range(2, 5)
+            ]
+            write_behind_buffer.join()
+            metrics = write_behind_buffer.metrics()
+
+        # Then
+        assert [response.status_code for response in responses] == [status.HTTP_202_ACCEPTED] * 3
+        assert failures == []
+        messages = [record.getMessage() for record in logs.records]
+        assert messages[0] == "Writing the locations of the append log failed"
+        assert messages[1].endswith("buffered locations failed")
+        assert Location.objects.count() == 4
+        assert metrics["running"] is True
+        assert metrics["replayed"] == 1
+        assert metrics["written"] == 3
+
+    # Tests that a flusher stopped by an error is restarted with the locations left in the queue.
+    @override_settings(LOCATIONS_WRITE_BEHIND_MAX_SIZE=3)
+    def test_restart_stopped_flusher(self):
+        """
+        Given a flusher stopped by an error before taking a queued location out
+        When another location is created
+        Then the flusher should be restarted and both locations written
+        """
+        # Given
+        with mock.patch.object(WriteBehindBuffer, "_take", side_effect=RuntimeError("unexpected")), self.assertLogs(
+            "locations.write_behind", level="ERROR"
+        ):
+            first = self.client.post("/locations/", data=self.location_data())
+            write_behind_buffer._thread.join()
+        stopped = write_behind_buffer.metrics()
+
+        # When
+        second = self.client.post("/locations/", data=self.location_data("2020-01-02T00:00:00Z"))
+        write_behind_buffer.join()
+
+        # Then
+        assert first.status_code == second.status_code == status.HTTP_202_ACCEPTED
+        assert stopped["running"] is False
+        assert Location.objects.count() == 2
+        assert write_behind_buffer.metrics()["running"] is True
+
+
+class TestAppendLog(SimpleTestCase):
+    # Tests that only the logs of stopped processes are replayed.
+    def test_replay_stopped_logs_only(self):
+        """
+        Given an append log of a running process holding a row
+        When another log is opened in the same directory, before and after the running process crashed
+        Then the row should only be replayed after the crash, and every directory deleted once replayed
+        """
+        # Given
+        directory = tempfile.mkdtemp()
+        running = AppendLog(directory)
+        running.append({"lat": "10"})
+
+        # When
+        started = AppendLog(directory)
+        _, rows_while_running = started.replay()
+        started.close()
+        # A crash releases the lock and leaves the segment
+        running._lock_file.close()
+        restarted = AppendLog(directory)
+        paths, rows = restarted.replay()
+        restarted.replayed(paths)
+        restarted.close()
+
+        # Then
+        assert rows_while_running == []
+        assert rows == [{"lat": "10"}]
+        assert list(Path(directory).iterdir()) == []
+
+    # Tests that the rows appended while an fsync runs share the next one.
+    def test_appends_share_fsync(self):
+        """
+        Given an append log whose first fsync blocks
+        When rows are appended from several threads meanwhile
+        Then a single fsync should follow for all of them
+        """
+        # Given
+        log = AppendLog(tempfile.mkdtemp())
+        syncing, synced = threading.Event(), threading.Event()
+        fsyncs = []
+
+        def fsync(descriptor):
+            fsyncs.append(descriptor)
+            syncing.set()
+            synced.wait(5)
+
+        # When
+        with mock.patch.object(write_behind.os, "fsync", fsync):
+            writers = [threading.Thread(target=log.append, args=({"row": row},)) for row in range(6)]
+            writers[0].start()
+            assert syncing.wait(5)
+            for writer in writers[1:]:
+                writer.start()
+            deadline = time.monotonic() + 5
+            while log._written < len(writers) and time.monotonic() < deadline:
+                time.sleep(0.001)
+            synced.set()
+            for writer in writers:
+                writer.join(5)
+        log.close()
+
+        # Then
+        assert len(fsyncs) == 2